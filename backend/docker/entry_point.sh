@@ -17,6 +17,13 @@ fi;
 # impossible
 export PYTHONUNBUFFERED=1
 
+if [[ "$COLLECTOR_ASGI" == "true" ]]; then
+  echo "starting gunicorn with uvicorn workers"
+  # Run the asyncio collector, see objectiv_backend/asgi.py
+  exec gunicorn --config /etc/gunicorn.conf.py --worker-class uvicorn.workers.UvicornWorker \
+  objectiv_backend.asgi:app
+fi;
+
 echo "starting gunicorn"
 # Run gunicorn. $USER and $PORT are set in the Dockerfile
 exec gunicorn --config /etc/gunicorn.conf.py \
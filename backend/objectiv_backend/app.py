@@ -1,11 +1,12 @@
 from flask import Flask
 from flask_cors import CORS
 
-from objectiv_backend.common.config import init_collector_config
+from objectiv_backend.common.config import METRICS_ENDPOINT, init_collector_config
 
 
 def create_app() -> Flask:
     from objectiv_backend.end_points import collector
+    from objectiv_backend.end_points import metrics
     from objectiv_backend.end_points import schema
 
     # load config - this will raise an error if there are configuration problems, and will cache the
@@ -16,6 +17,8 @@ def create_app() -> Flask:
     flask_app.add_url_rule(rule='/schema', view_func=schema.schema, methods=['GET'])
     flask_app.add_url_rule(rule='/jsonschema', view_func=schema.json_schema, methods=['GET'])
     flask_app.add_url_rule(rule='/', view_func=collector.collect, methods=['POST'])
+    if METRICS_ENDPOINT:
+        flask_app.add_url_rule(rule='/metrics', view_func=metrics.metrics, methods=['GET'])
     init_cors(flask_app)
     return flask_app
 
@@ -26,8 +29,9 @@ def init_cors(app: Flask):
     # are not afraid of any CSRF attacks, nor of people reusing our request-responses in other pages, and
     # we don't want to be strict in the origin of request. As such we don't have need for CORS protections,
     # and we can tell the browser to disable it altogether for this origin, coming from all origins.
+    # The exception is /metrics, which is meant for monitoring, not for web pages.
     CORS(app,
-         resources={r'/*': {
+         resources={r'^(?!/metrics$)/.*': {
              'origins': '*',
              'supports_credentials': True,  # needed for cookies
              # Setting max_age to a higher values is probably useless, as most browsers cap this time.
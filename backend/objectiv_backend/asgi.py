@@ -0,0 +1,260 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+ASGI entry point of the collector, an alternative to the Flask app in app.py. Run it with an ASGI server,
+e.g.: `uvicorn objectiv_backend.asgi:app`, or `gunicorn -k uvicorn.workers.UvicornWorker objectiv_backend.asgi:app`
+
+Requests are handled on an asyncio event loop, so a single process can keep thousands of tracker
+connections open. Parsing, validation and enrichment of the events is done by the same code as the Flask
+app. Writing to the database and the other outputs is blocking, that is handed off to a bounded pool of
+threads that shares the process' database connection pool. While a request waits for its events to be
+written, the event loop keeps serving other requests.
+"""
+import asyncio
+import io
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from flask import Request, Response
+
+from objectiv_backend.common.config import METRICS_ENDPOINT, get_collector_config, init_collector_config
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import CONTENT_TYPE, EVENTS, REQUESTS, STAGE_SECONDS
+from objectiv_backend.common.types import EventDataList, EventList
+from objectiv_backend.end_points.collector import DATA_MAX_SIZE_BYTES, _get_event_data, \
+    _get_collector_response, add_enriched_contexts, set_time_in_events, write_async_events, \
+    write_sync_events
+from objectiv_backend.end_points.common import get_json_response
+from objectiv_backend.end_points.metrics import get_metrics_text
+from objectiv_backend.end_points.schema import get_schema_msg, get_json_schema_msg
+from objectiv_backend.workers.worker_entry import process_events_entry
+
+logger = get_logger(__name__)
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Number of threads for writing events, if there is no Postgres output. With Postgres output, there are as
+# many threads as the maximum number of connections in the connection pool.
+_DEFAULT_IO_THREADS = 10
+
+# Same as the Flask app's CORS settings, see app.init_cors()
+_CORS_MAX_AGE = 3600 * 24
+_CORS_METHODS = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+
+class CollectorApp:
+    """ ASGI application with the same endpoints as the Flask app in app.py. """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+    def startup(self):
+        """ Load the config and start the threads for writing events. Called at startup of the server. """
+        if self._executor is None:
+            # this will raise an error if there are configuration problems, and will cache the result
+            init_collector_config()
+            pg_config = get_collector_config().output.postgres
+            max_workers = pg_config.pool_max_size if pg_config else _DEFAULT_IO_THREADS
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='collector-io')
+
+    def shutdown(self):
+        """ Wait for events that are being written. Called at shutdown of the server. """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.startup()
+                except Exception as exc:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(exc)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send):
+        # Not all ASGI servers support the lifespan protocol, in which case we start on the first request
+        self.startup()
+        method = scope['method']
+        path = scope['path']
+        try:
+            if method == 'OPTIONS':
+                response = Response(status=200)
+            elif path == '/' and method == 'POST':
+                response = await self._collect(scope, receive)
+            elif path in ('/schema', '/jsonschema') and method in ('GET', 'HEAD'):
+                msg = get_schema_msg() if path == '/schema' else get_json_schema_msg()
+                response = get_json_response(status=200, msg=msg, cookie_id=_get_cookie_id(_make_request(scope)))
+            elif path == '/metrics' and METRICS_ENDPOINT and method in ('GET', 'HEAD'):
+                text = await self._run_blocking(get_metrics_text)
+                response = Response(text, status=200, content_type=CONTENT_TYPE)
+            elif path in ('/', '/schema', '/jsonschema'):
+                response = Response(status=405)
+            else:
+                response = Response(status=404)
+        except Exception:
+            logger.exception(f'Error handling {method} {path}')
+            response = Response(status=500)
+        if path != '/metrics':
+            _add_cors_headers(scope, response)
+        await _send_response(send, response, include_body=method != 'HEAD')
+
+    async def _collect(self, scope: Scope, receive: Receive) -> Response:
+        """ Same as collector.collect(), but doesn't block the event loop while writing the events. """
+        current_millis = round(time.time() * 1000)
+        request = _make_request(scope)
+        cookie_id = _get_cookie_id(request)
+        try:
+            body = await _read_body(scope, receive, max_size=DATA_MAX_SIZE_BYTES)
+            request = _make_request(scope, body=body)
+            event_data: EventList = _get_event_data(request)
+            events: EventDataList = event_data['events']
+            transport_time: int = event_data['transport_time']
+        except ValueError as exc:
+            logger.info(f'Data problem: {exc}')
+            REQUESTS.inc(result='data_error')
+            return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__(),
+                                           cookie_id=cookie_id)
+        REQUESTS.inc(result='ok')
+        EVENTS.inc(len(events), result='received')
+
+        # Do all the enrichment steps that can only be done in this phase
+        with STAGE_SECONDS.time(stage='enrich'):
+            add_enriched_contexts(events, request=request, cookie_id=cookie_id)
+            set_time_in_events(events, current_millis, transport_time)
+
+        if not get_collector_config().async_mode:
+            ok_events, nok_events, event_errors = process_events_entry(events=events,
+                                                                       current_millis=current_millis)
+            logger.debug(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
+            duplicate_events = await self._run_blocking(write_sync_events, ok_events, nok_events, event_errors)
+            return _get_collector_response(error_count=len(nok_events), event_count=len(events),
+                                           event_errors=event_errors, cookie_id=cookie_id,
+                                           duplicate_count=len(duplicate_events))
+        else:
+            await self._run_blocking(write_async_events, events)
+            return _get_collector_response(error_count=0, event_count=len(events), cookie_id=cookie_id)
+
+    async def _run_blocking(self, func: Callable, *args):
+        """ Run func in one of the threads for writing events, and wait for it without blocking the loop. """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+async def _read_body(scope: Scope, receive: Receive, max_size: int) -> bytes:
+    """
+    Read the request body. Stops reading as soon as the body is bigger than max_size.
+    :raise ValueError: if the body is bigger than max_size, or the client disconnected
+    """
+    content_length = _get_header(scope, b'content-length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+        raise ValueError('Data size exceeds limit')
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ValueError('Client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError('Data size exceeds limit')
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def _make_request(scope: Scope, body: bytes = b'') -> Request:
+    """ Create a Flask Request object for the request, so we can reuse the code of the Flask app. """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ: Dict[str, Any] = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+    }
+    for name, value in _get_headers(scope):
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    # The body has been read already, this is its actual length
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return Request(environ)
+
+
+def _get_cookie_id(request: Request) -> Optional[str]:
+    """ Same as common.get_cookie_id(), for a request outside of a Flask request context. """
+    cookie_config = get_collector_config().cookie
+    if not cookie_config:
+        return None
+    cookie_id = request.cookies.get(cookie_config.name)
+    if not cookie_id:
+        cookie_id = str(uuid.uuid4())
+        logger.debug(f'Generating cookie_id: {cookie_id}')
+    return cookie_id
+
+
+def _get_headers(scope: Scope) -> List[Tuple[str, str]]:
+    return [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope.get('headers', [])]
+
+
+def _get_header(scope: Scope, name: bytes) -> Optional[str]:
+    for header_name, value in scope.get('headers', []):
+        if header_name.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _add_cors_headers(scope: Scope, response: Response):
+    """
+    Add the same CORS headers as the Flask app does: all origins are allowed, including cookies. Not for
+    /metrics, see app.init_cors()
+    """
+    origin = _get_header(scope, b'origin')
+    if origin is None:
+        return
+    response.headers['Access-Control-Allow-Origin'] = origin
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    response.vary.add('Origin')
+    if scope['method'] == 'OPTIONS':
+        response.headers['Access-Control-Allow-Methods'] = _CORS_METHODS
+        request_headers = _get_header(scope, b'access-control-request-headers')
+        if request_headers:
+            response.headers['Access-Control-Allow-Headers'] = request_headers
+        response.headers['Access-Control-Max-Age'] = str(_CORS_MAX_AGE)
+
+
+async def _send_response(send: Send, response: Response, include_body: bool = True):
+    body = response.get_data()
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in response.headers.to_wsgi_list()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body if include_body else b''})
+
+
+app = CollectorApp()
@@ -9,11 +9,15 @@ from typing import NamedTuple, Optional
 # complete overview.
 # These settings should not be accessed by the constants here, but through the functions defined
 # below (e.g. get_config_output())
-from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema, get_event_list_schema
+from objectiv_backend.schema.event_schemas import EventSchema, get_event_list_schema
+from objectiv_backend.schema.schema_registry import SchemaRegistry
 from objectiv_backend.common.types import EventListSchema
 
 LOAD_BASE_SCHEMA = os.environ.get('LOAD_BASE_SCHEMA', 'true') == 'true'
 SCHEMA_EXTENSION_DIRECTORY = os.environ.get('SCHEMA_EXTENSION_DIRECTORY')
+# Interval in seconds at which SCHEMA_EXTENSION_DIRECTORY is checked for changes, and a changed schema is
+# loaded without restarting. Set to 0 to disable
+SCHEMA_RELOAD_SECONDS = float(os.environ.get('SCHEMA_RELOAD_SECONDS', 0))
 
 # when set to true, the collector will return detailed validation errors per event
 SCHEMA_VALIDATION_ERROR_REPORTING = os.environ.get('SCHEMA_VALIDATION_ERROR_REPORTING', 'false') == 'true'
@@ -21,6 +25,12 @@ SCHEMA_VALIDATION_ERROR_REPORTING = os.environ.get('SCHEMA_VALIDATION_ERROR_REPO
 # Number of ms before an event is considered too old. set to 0 to disable
 MAX_DELAYED_EVENTS_MILLIS = 1000 * 3600
 
+# Level of the messages that the collector and workers log per request or batch, e.g. DEBUG, INFO, or WARNING
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Whether the collector serves metrics on /metrics, in the Prometheus text format. Off by default, as the
+# endpoint is not authenticated.
+METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT', 'false') == 'true'
+
 # Whether to run in sync mode (default) or async-mode.
 _ASYNC_MODE = os.environ.get('ASYNC_MODE', '') == 'true'
 
@@ -32,6 +42,25 @@ _PG_PORT = os.environ.get('POSTGRES_PORT', '5432')
 _PG_DATABASE_NAME = os.environ.get('POSTGRES_DB', 'objectiv')
 _PG_USER = os.environ.get('POSTGRES_USER', 'objectiv')
 _PG_PASSWORD = os.environ.get('POSTGRES_PASSWORD', '')
+# Connection pool settings, per process
+_PG_POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 1))
+_PG_POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10))
+# Seconds to wait for a free connection if all connections in the pool are in use
+_PG_POOL_TIMEOUT_SECONDS = float(os.environ.get('POSTGRES_POOL_TIMEOUT_SECONDS', 5))
+# Connections that were idle in the pool for longer than this are checked with a query before they are used
+_PG_POOL_CHECK_IDLE_SECONDS = float(os.environ.get('POSTGRES_POOL_CHECK_IDLE_SECONDS', 30))
+# Seconds to wait for a new connection to be established. If 0, the spool's latency budget is used if there is
+# one, and otherwise the pool timeout.
+_PG_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('POSTGRES_CONNECT_TIMEOUT_SECONDS', 0))
+# Batches of at least this many events are written with `copy` instead of `insert`. Set to 0 to disable.
+_PG_COPY_THRESHOLD = int(os.environ.get('POSTGRES_COPY_THRESHOLD', 0))
+# In sync mode, gather the events of concurrent requests for this many milliseconds, and write them in one
+# transaction. Set to 0 to disable. A batch is written early if it has POSTGRES_COALESCE_MAX_EVENTS events.
+_PG_COALESCE_MILLIS = float(os.environ.get('POSTGRES_COALESCE_MILLIS', 0))
+_PG_COALESCE_MAX_EVENTS = int(os.environ.get('POSTGRES_COALESCE_MAX_EVENTS', 1000))
+# Number of recently inserted event_ids that each process remembers, to recognize duplicate events without
+# a round-trip to the database. Set to 0 to disable.
+_PG_RECENT_EVENT_IDS = int(os.environ.get('POSTGRES_RECENT_EVENT_IDS', 0))
 
 # ### AWS S3 values, for writing data to S3.
 # default access keys to an empty string, otherwise the boto library will default ot user defaults.
@@ -46,6 +75,48 @@ _AWS_S3_PREFIX = os.environ.get('AWS_S3_PREFIX', '')
 _OUTPUT_ENABLE_FILESYSTEM = os.environ.get('OUTPUT_ENABLE_FILESYSTEM', '') == 'true'
 _FILESYSTEM_OUTPUT_DIR = os.environ.get('FILESYSTEM_OUTPUT_DIR')
 
+# ### Settings for writing the S3 and filesystem outputs to rolling files
+# If enabled, events are appended to a file per prefix and hour, instead of writing a file per request. A file
+# is completed, and only then visible to readers, when it reaches OUTPUT_FILES_SEGMENT_MAX_BYTES, when it is
+# OUTPUT_FILES_SEGMENT_MAX_SECONDS old, or when the hour is over.
+_OUTPUT_FILES_ROLLING = os.environ.get('OUTPUT_FILES_ROLLING', '') == 'true'
+# 'ndjson' (a json object per line) or 'parquet' (requires pyarrow)
+_OUTPUT_FILES_FORMAT = os.environ.get('OUTPUT_FILES_FORMAT', 'ndjson')
+_OUTPUT_FILES_SEGMENT_MAX_BYTES = int(os.environ.get('OUTPUT_FILES_SEGMENT_MAX_BYTES', 64_000_000))
+_OUTPUT_FILES_SEGMENT_MAX_SECONDS = float(os.environ.get('OUTPUT_FILES_SEGMENT_MAX_SECONDS', 300))
+# Local directory for files that are not yet uploaded to S3. Defaults to the system's temporary directory.
+_OUTPUT_FILES_STAGING_DIR = os.environ.get('OUTPUT_FILES_STAGING_DIR', '')
+
+# ### Settings for writing to the S3, filesystem and Snowplow outputs in the background
+# If enabled, events are handed to background threads that write them in batches, so the collector doesn't
+# wait for these outputs before responding. Events that are waiting are lost if the process is killed, and
+# events are dropped if an output can't keep up.
+_OUTPUT_ASYNC_SINKS = os.environ.get('OUTPUT_ASYNC_SINKS', 'false') == 'true'
+# A batch is written when it has this many events, or when the first event in it is this old
+_OUTPUT_ASYNC_BATCH_MAX_EVENTS = int(os.environ.get('OUTPUT_ASYNC_BATCH_MAX_EVENTS', 500))
+_OUTPUT_ASYNC_BATCH_MAX_SECONDS = float(os.environ.get('OUTPUT_ASYNC_BATCH_MAX_SECONDS', 1))
+# Maximum number of events waiting per output. If reached, requests wait up to
+# OUTPUT_ASYNC_QUEUE_TIMEOUT_SECONDS for room, after which the events are dropped for that output.
+_OUTPUT_ASYNC_QUEUE_MAX_EVENTS = int(os.environ.get('OUTPUT_ASYNC_QUEUE_MAX_EVENTS', 10_000))
+_OUTPUT_ASYNC_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('OUTPUT_ASYNC_QUEUE_TIMEOUT_SECONDS', 1))
+# Number of times writing a batch is retried, before giving up on it
+_OUTPUT_ASYNC_MAX_RETRIES = int(os.environ.get('OUTPUT_ASYNC_MAX_RETRIES', 3))
+
+# ### Settings for the local spool
+# If a directory is set, the collector writes events to files in that directory if Postgres is unavailable,
+# and replays them into Postgres once it is available again.
+_SPOOL_DIRECTORY = os.environ.get('SPOOL_DIRECTORY', '')
+# When to fsync spool files: 'always' (after every write), 'rotate' (when a file is complete), or 'never'
+_SPOOL_FSYNC = os.environ.get('SPOOL_FSYNC', 'always')
+# A new spool file is started when the current one reaches this size
+_SPOOL_SEGMENT_MAX_BYTES = int(os.environ.get('SPOOL_SEGMENT_MAX_BYTES', 16_000_000))
+# Maximum total size of the spool files. If reached, writing events fails as if there is no spool.
+_SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 1_000_000_000))
+# If set, Postgres writes of the collector that take longer than this are cancelled, and the events spooled
+_SPOOL_LATENCY_BUDGET_SECONDS = float(os.environ.get('SPOOL_LATENCY_BUDGET_SECONDS', 0))
+# Interval at which each collector process tries to replay spool files
+_SPOOL_REPLAY_INTERVAL_SECONDS = float(os.environ.get('SPOOL_REPLAY_INTERVAL_SECONDS', 10))
+
 # ### Snowplow settings
 _SP_SCHEMA_COLLECTOR_PAYLOAD = 'iglu:com.snowplowanalytics.snowplow/CollectorPayload/thrift/1-0-0'
 _SP_SCHEMA_CONTEXTS = 'iglu:com.snowplowanalytics.snowplow/contexts/jsonschema/1-0-0'
@@ -65,10 +136,26 @@ _OBJ_COOKIE = 'obj_user_id'
 # default cookie duration is 1 year, can be overridden by setting `COOKIE_DURATION`
 _OBJ_COOKIE_DURATION = int(os.environ.get('COOKIE_DURATION', 60 * 60 * 24 * 365 * 1))
 
-# Maximum number of events that a worker will process in a single batch. Only relevant in async mode
+# Number of events that a worker will initially process in a single batch. Only relevant in async mode.
+# When looping, workers adapt the batch size between WORKER_BATCH_SIZE_MIN and WORKER_BATCH_SIZE_MAX: it
+# grows if batches are full and take less than WORKER_BATCH_TARGET_SECONDS, and shrinks if they take longer.
 WORKER_BATCH_SIZE = 200
-# Time to sleep, if there is no work to do for the workers. Only relevant in async mode
+WORKER_BATCH_SIZE_MIN = int(os.environ.get('WORKER_BATCH_SIZE_MIN', 10))
+WORKER_BATCH_SIZE_MAX = int(os.environ.get('WORKER_BATCH_SIZE_MAX', 5000))
+WORKER_BATCH_TARGET_SECONDS = float(os.environ.get('WORKER_BATCH_TARGET_SECONDS', 1))
+# Maximum time to sleep, if there is no work to do for the workers. Only relevant in async mode.
+# Workers start with sleeping WORKER_SLEEP_MIN_SECONDS, and double that every time there is no work.
 WORKER_SLEEP_SECONDS = 5
+WORKER_SLEEP_MIN_SECONDS = 0.1
+# Whether workers wait for notifications of new events (postgres LISTEN/NOTIFY) instead of polling. They
+# still poll every WORKER_SLEEP_SECONDS.
+WORKER_LISTEN = os.environ.get('WORKER_LISTEN', 'true') == 'true'
+# Interval at which the worker supervisor reports throughput metrics
+WORKER_SUPERVISOR_REPORT_SECONDS = 10
+
+# Events of the same cookie that are at most this many seconds apart belong to the same session. Only used if
+# the database has the sessions tables, see db_init's --sessions option.
+SESSION_GAP_SECONDS = int(os.environ.get('SESSION_GAP_SECONDS', 1800))
 
 
 class AwsOutputConfig(NamedTuple):
@@ -83,12 +170,29 @@ class FileSystemOutputConfig(NamedTuple):
     path: str
 
 
+class RollingFilesConfig(NamedTuple):
+    # 'ndjson' or 'parquet'
+    format: str
+    segment_max_bytes: int
+    segment_max_seconds: float
+    staging_directory: str
+
+
 class PostgresConfig(NamedTuple):
     hostname: str
     port: int
     database_name: str
     user: str
     password: str
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_timeout_seconds: float = 5
+    pool_check_idle_seconds: float = 30
+    connect_timeout_seconds: float = 5
+    copy_threshold: int = 0
+    coalesce_millis: float = 0
+    coalesce_max_events: int = 1000
+    recent_event_ids: int = 0
 
 
 class SnowplowConfig(NamedTuple):
@@ -109,11 +213,35 @@ class SnowplowConfig(NamedTuple):
     schema_schema_violations: str
 
 
+class AsyncSinksConfig(NamedTuple):
+    batch_max_events: int
+    batch_max_seconds: float
+    queue_max_events: int
+    queue_timeout_seconds: float
+    max_retries: int
+
+
+class SpoolConfig(NamedTuple):
+    directory: str
+    # 'always', 'rotate', or 'never'
+    fsync: str
+    segment_max_bytes: int
+    max_bytes: int
+    latency_budget_seconds: float
+    replay_interval_seconds: float
+
+
 class OutputConfig(NamedTuple):
     postgres: Optional[PostgresConfig]
     aws: Optional[AwsOutputConfig]
     file_system: Optional[FileSystemOutputConfig]
     snowplow: SnowplowConfig
+    # If set, the aws, file_system, and snowplow outputs are written in the background
+    async_sinks: Optional[AsyncSinksConfig] = None
+    # If set, events are spooled to local files if postgres is unavailable
+    spool: Optional[SpoolConfig] = None
+    # If set, the aws and file_system outputs append events to rolling files, instead of a file per request
+    rolling_files: Optional[RollingFilesConfig] = None
 
 
 class CookieConfig(NamedTuple):
@@ -132,6 +260,8 @@ class CollectorConfig(NamedTuple):
     error_reporting: bool
     output: OutputConfig
     event_schema: EventSchema
+    # Hash of the schema extension files of event_schema, see SchemaRegistry
+    event_schema_version: str
     event_list_schema: EventListSchema
 
 
@@ -159,18 +289,50 @@ def get_config_output_file_system() -> Optional[FileSystemOutputConfig]:
     return FileSystemOutputConfig(path=_FILESYSTEM_OUTPUT_DIR)
 
 
+def get_config_output_rolling_files() -> Optional[RollingFilesConfig]:
+    if not _OUTPUT_FILES_ROLLING:
+        return None
+    if _OUTPUT_FILES_FORMAT not in ('ndjson', 'parquet'):
+        raise ValueError(f'Invalid OUTPUT_FILES_FORMAT: {_OUTPUT_FILES_FORMAT}. Must be ndjson or parquet.')
+    return RollingFilesConfig(
+        format=_OUTPUT_FILES_FORMAT,
+        segment_max_bytes=_OUTPUT_FILES_SEGMENT_MAX_BYTES,
+        segment_max_seconds=_OUTPUT_FILES_SEGMENT_MAX_SECONDS,
+        staging_directory=_OUTPUT_FILES_STAGING_DIR
+    )
+
+
 def get_config_postgres() -> Optional[PostgresConfig]:
     if not _OUTPUT_ENABLE_PG:
         return None
     if not _PG_HOSTNAME or not _PG_PORT or not _PG_DATABASE_NAME or not _PG_USER:
         raise ValueError(f'OUTPUT_ENABLE_PG = true, but not all required values specified. '
                          f'Must specify PG_HOSTNAME, PG_PORT, PG_DATABASE_NAME, PG_USER, and PG_PASSWORD')
+    if _PG_POOL_MIN_SIZE < 0 or _PG_POOL_MAX_SIZE < 1 or _PG_POOL_MIN_SIZE > _PG_POOL_MAX_SIZE:
+        raise ValueError(f'Invalid connection pool size. POSTGRES_POOL_MIN_SIZE ({_PG_POOL_MIN_SIZE}) must be '
+                         f'between 0 and POSTGRES_POOL_MAX_SIZE ({_PG_POOL_MAX_SIZE}), which must be at least 1.')
+    connect_timeout_seconds = _PG_CONNECT_TIMEOUT_SECONDS
+    if not connect_timeout_seconds:
+        # Connecting shouldn't take longer than we're willing to wait for the whole write
+        if _SPOOL_DIRECTORY and _SPOOL_LATENCY_BUDGET_SECONDS:
+            connect_timeout_seconds = _SPOOL_LATENCY_BUDGET_SECONDS
+        else:
+            connect_timeout_seconds = _PG_POOL_TIMEOUT_SECONDS
     return PostgresConfig(
         hostname=_PG_HOSTNAME,
         port=int(_PG_PORT),
         database_name=_PG_DATABASE_NAME,
         user=_PG_USER,
-        password=_PG_PASSWORD
+        password=_PG_PASSWORD,
+        pool_min_size=_PG_POOL_MIN_SIZE,
+        pool_max_size=_PG_POOL_MAX_SIZE,
+        pool_timeout_seconds=_PG_POOL_TIMEOUT_SECONDS,
+        pool_check_idle_seconds=_PG_POOL_CHECK_IDLE_SECONDS,
+        connect_timeout_seconds=connect_timeout_seconds,
+        copy_threshold=_PG_COPY_THRESHOLD,
+        coalesce_millis=_PG_COALESCE_MILLIS,
+        coalesce_max_events=_PG_COALESCE_MAX_EVENTS,
+        recent_event_ids=_PG_RECENT_EVENT_IDS
     )
 
 
@@ -208,13 +370,43 @@ def get_config_output_snowplow() -> SnowplowConfig:
     return config
 
 
+def get_config_output_async_sinks() -> Optional[AsyncSinksConfig]:
+    if not _OUTPUT_ASYNC_SINKS:
+        return None
+    return AsyncSinksConfig(
+        batch_max_events=_OUTPUT_ASYNC_BATCH_MAX_EVENTS,
+        batch_max_seconds=_OUTPUT_ASYNC_BATCH_MAX_SECONDS,
+        queue_max_events=_OUTPUT_ASYNC_QUEUE_MAX_EVENTS,
+        queue_timeout_seconds=_OUTPUT_ASYNC_QUEUE_TIMEOUT_SECONDS,
+        max_retries=_OUTPUT_ASYNC_MAX_RETRIES
+    )
+
+
+def get_config_output_spool() -> Optional[SpoolConfig]:
+    if not _SPOOL_DIRECTORY:
+        return None
+    if _SPOOL_FSYNC not in ('always', 'rotate', 'never'):
+        raise ValueError(f'Invalid SPOOL_FSYNC: {_SPOOL_FSYNC}. Must be always, rotate, or never.')
+    return SpoolConfig(
+        directory=_SPOOL_DIRECTORY,
+        fsync=_SPOOL_FSYNC,
+        segment_max_bytes=_SPOOL_SEGMENT_MAX_BYTES,
+        max_bytes=_SPOOL_MAX_BYTES,
+        latency_budget_seconds=_SPOOL_LATENCY_BUDGET_SECONDS,
+        replay_interval_seconds=_SPOOL_REPLAY_INTERVAL_SECONDS
+    )
+
+
 def get_config_output() -> OutputConfig:
     """ Get the Collector's output settings. Raises an error if none of the outputs are configured. """
     output_config = OutputConfig(
         postgres=get_config_postgres(),
         aws=get_config_output_aws(),
         file_system=get_config_output_file_system(),
-        snowplow=get_config_output_snowplow()
+        snowplow=get_config_output_snowplow(),
+        async_sinks=get_config_output_async_sinks(),
+        spool=get_config_output_spool(),
+        rolling_files=get_config_output_rolling_files()
     )
     if not output_config.postgres \
             and not output_config.aws \
@@ -232,10 +424,6 @@ def get_config_cookie() -> CookieConfig:
     )
 
 
-def get_config_event_schema() -> EventSchema:
-    return get_event_schema(SCHEMA_EXTENSION_DIRECTORY)
-
-
 def get_config_event_list_schema() -> EventListSchema:
     return get_event_list_schema()
 
@@ -247,17 +435,20 @@ def get_config_timestamp_validation() -> TimestampValidationConfig:
 # creating these configuration structures is not heavy, but it's pointless to do it for each request.
 # so we have some super simple caching here
 _CACHED_COLLECTOR_CONFIG: Optional[CollectorConfig] = None
+_SCHEMA_REGISTRY: Optional[SchemaRegistry] = None
 
 
 def init_collector_config():
     """ Load collector config into cache. """
-    global _CACHED_COLLECTOR_CONFIG
+    global _CACHED_COLLECTOR_CONFIG, _SCHEMA_REGISTRY
+    _SCHEMA_REGISTRY = SchemaRegistry(SCHEMA_EXTENSION_DIRECTORY, on_change=_set_event_schema)
     _CACHED_COLLECTOR_CONFIG = CollectorConfig(
         async_mode=_ASYNC_MODE,
         cookie=get_config_cookie(),
         error_reporting=SCHEMA_VALIDATION_ERROR_REPORTING,
         output=get_config_output(),
-        event_schema=get_config_event_schema(),
+        event_schema=_SCHEMA_REGISTRY.event_schema,
+        event_schema_version=_SCHEMA_REGISTRY.version,
         event_list_schema=get_config_event_list_schema()
     )
 
@@ -268,4 +459,21 @@ def get_collector_config() -> CollectorConfig:
     if not _CACHED_COLLECTOR_CONFIG:
         init_collector_config()
         assert _CACHED_COLLECTOR_CONFIG is not None  # help out mypy
+    if SCHEMA_RELOAD_SECONDS and _SCHEMA_REGISTRY is not None:
+        _SCHEMA_REGISTRY.start_watching(SCHEMA_RELOAD_SECONDS)
     return _CACHED_COLLECTOR_CONFIG
+
+
+def _set_event_schema(event_schema: EventSchema, version: str):
+    """
+    Swap a new event schema into the cached collector config. Code that already got the config keeps using
+    the old schema, so a request or batch is processed with a single schema.
+    """
+    global _CACHED_COLLECTOR_CONFIG
+    if _CACHED_COLLECTOR_CONFIG is None:
+        return
+    _CACHED_COLLECTOR_CONFIG = _CACHED_COLLECTOR_CONFIG._replace(event_schema=event_schema,
+                                                                 event_schema_version=version)
+    # Build the validation of event lists for the new schema now, instead of in the first request
+    from objectiv_backend.schema import validate_events
+    validate_events.get_event_list_schema()
@@ -1,11 +1,21 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import io
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
 import psycopg2
 from psycopg2 import extras
-from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, TRANSACTION_STATUS_IDLE, \
+    TRANSACTION_STATUS_UNKNOWN
 
 from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.serialization import loads
 
 
 def get_db_connection(pg_config: PostgresConfig):
@@ -14,12 +24,15 @@ def get_db_connection(pg_config: PostgresConfig):
      * read committed isolation level
      * 5 second lock_timeout
      * uuids enabled.
+
+    Connecting fails with an OperationalError if it takes longer than pg_config.connect_timeout_seconds.
     """
     conn = psycopg2.connect(user=pg_config.user,
                             password=pg_config.password,
                             host=pg_config.hostname,
                             port=pg_config.port,
-                            database=pg_config.database_name)
+                            database=pg_config.database_name,
+                            connect_timeout=_get_connect_timeout(pg_config))
     # The code in pg_storage.py and pg_queues.py assumes the read_committed isolation level
     # Additionally, the function insert_events_into_data() might block if another transaction tries to
     # insert the same event_id and that other transaction. We set lock-timeout to guarantee unblocking,
@@ -29,5 +42,204 @@ def get_db_connection(pg_config: PostgresConfig):
     # than 5 seconds, something is wrong.
     with conn.cursor() as cursor:
         cursor.execute("set lock_timeout='5s';")
+    # set lock_timeout implicitly started a transaction, end it so the connection is idle
+    conn.commit()
     extras.register_uuid()
+    # Parse json values with the fast json parser, if available
+    extras.register_default_json(conn, loads=loads)
+    extras.register_default_jsonb(conn, loads=loads)
     return conn
+
+
+def _get_connect_timeout(pg_config: PostgresConfig) -> int:
+    """ libpq's connect_timeout is in whole seconds, and it uses at least 2 seconds. """
+    return max(2, math.ceil(pg_config.connect_timeout_seconds))
+
+
+class PoolTimeout(Exception):
+    """ No connection became available in the pool in time. """
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections, as created by get_db_connection().
+
+    The session settings of get_db_connection() are applied once per connection, when the connection is
+    created. Connections are checked when taken from the pool; connections that are closed or in an
+    unknown state are discarded and replaced by a new connection. Connections that were idle for longer than
+    pool_check_idle_seconds are also checked with a query, as the server might have closed them.
+
+    A pool is bound to the process that created it, use get_connection_pool() to get the pool for the
+    current process.
+    """
+
+    def __init__(self, pg_config: PostgresConfig):
+        self.pg_config = pg_config
+        self._lock = threading.Lock()
+        # Limits the total number of connections (idle and in use) to pool_max_size
+        self._slots = threading.BoundedSemaphore(pg_config.pool_max_size)
+        # idle connections, with the time they were given back
+        self._idle: List[Tuple[Any, float]] = []
+        for _ in range(pg_config.pool_min_size):
+            self._idle.append((get_db_connection(pg_config), time.monotonic()))
+
+    def get_connection(self):
+        """
+        Take a connection from the pool, creating a new connection if there is no healthy idle connection.
+        The connection must be given back with put_connection().
+
+        :raise PoolTimeout: if no connection becomes available within pool_timeout_seconds
+        """
+        if not self._slots.acquire(timeout=self.pg_config.pool_timeout_seconds):
+            raise PoolTimeout(f'No database connection available within '
+                              f'{self.pg_config.pool_timeout_seconds} seconds')
+        try:
+            while True:
+                with self._lock:
+                    connection, idle_since = self._idle.pop() if self._idle else (None, 0.0)
+                if connection is None:
+                    return get_db_connection(self.pg_config)
+                check = time.monotonic() - idle_since > self.pg_config.pool_check_idle_seconds
+                if _is_healthy(connection, check_server=check):
+                    return connection
+                _close_quietly(connection)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def put_connection(self, connection, discard: bool = False):
+        """
+        Give a connection back to the pool.
+        :param connection: connection as returned by get_connection()
+        :param discard: If True, close the connection instead of reusing it
+        """
+        try:
+            if not discard and not connection.closed:
+                if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    # don't leak uncommitted state to the next user of this connection
+                    connection.rollback()
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+                return
+        except psycopg2.Error:
+            pass
+        finally:
+            self._slots.release()
+        _close_quietly(connection)
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Context manager that takes a connection from the pool, and gives it back on exit. If a database
+        error occurred the connection is discarded. Does not do any transaction management.
+        """
+        connection = self.get_connection()
+        discard = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.put_connection(connection, discard=discard)
+
+    def close_all(self):
+        """ Close all idle connections. Connections that are in use are closed when they are given back. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            _close_quietly(connection)
+
+
+def _is_healthy(connection, check_server: bool = False) -> bool:
+    """
+    Check whether a connection can be reused.
+    :param check_server: If True, also do a round-trip to the database. Otherwise only the client side state
+        is checked, which doesn't notice connections that were closed by the server.
+    """
+    if connection.closed or connection.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if not check_server:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('select 1')
+        # end the implicitly started transaction, so the connection is idle
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except psycopg2.Error:
+        pass
+
+
+# One pool per process and configuration. Connections cannot be shared between processes, so a pool that
+# was inherited through a fork is not reused.
+_POOLS: Dict[PostgresConfig, ConnectionPool] = {}
+_POOLS_PID: Optional[int] = None
+_POOLS_LOCK = threading.Lock()
+
+
+def get_connection_pool(pg_config: PostgresConfig) -> ConnectionPool:
+    """ Get the connection pool of the current process for the given configuration. """
+    global _POOLS_PID
+    with _POOLS_LOCK:
+        if _POOLS_PID != os.getpid():
+            _POOLS.clear()
+            _POOLS_PID = os.getpid()
+        if pg_config not in _POOLS:
+            _POOLS[pg_config] = ConnectionPool(pg_config)
+        return _POOLS[pg_config]
+
+
+@contextmanager
+def get_pooled_db_connection(pg_config: PostgresConfig) -> Iterator:
+    """
+    Context manager that gives a connection, as created by get_db_connection(), from the process' pool.
+    The connection is returned to the pool on exit. Does not do any transaction management, use the
+    connection itself as a context manager for that.
+    """
+    with get_connection_pool(pg_config).connection() as connection:
+        yield connection
+
+
+def set_local_statement_timeout(connection, seconds: float):
+    """
+    Cancel statements in the current transaction that take longer than the given time. Statements that are
+    cancelled raise psycopg2.errors.QueryCanceled, which is an OperationalError.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('set local statement_timeout = %s', (f'{max(1, round(seconds * 1000))}ms',))
+
+
+def copy_rows(cursor, table_name: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]):
+    """
+    Write rows to a table using `copy ... from stdin`, which is a lot faster than insert statements for
+    large numbers of rows. Does not do any transaction management.
+    :param cursor: psycopg2 cursor
+    :param table_name: table to write to
+    :param columns: names of the columns to write, in the same order as the values in each row
+    :param rows: rows of values. Values are converted with str(), except for None which becomes null.
+    """
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_text_value(value) for value in row))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_expert(f'copy {table_name} ({", ".join(columns)}) from stdin', data)
+
+
+def _copy_text_value(value: Any) -> str:
+    """ Format a value for the text format of `copy`, see https://www.postgresql.org/docs/13/sql-copy.html """
+    if value is None:
+        return '\\N'
+    return str(value)\
+        .replace('\\', '\\\\')\
+        .replace('\t', '\\t')\
+        .replace('\n', '\\n')\
+        .replace('\r', '\\r')
@@ -1,7 +1,8 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-from typing import Optional, List, cast
+from itertools import chain
+from typing import Optional, List, Dict, Iterable, Iterator, cast
 
 from objectiv_backend.common.types import EventData, ContextData, ContextType
 from objectiv_backend.schema.schema import AbstractGlobalContext
@@ -9,29 +10,32 @@ from objectiv_backend.schema.schema import AbstractGlobalContext
 
 def get_optional_context(event: EventData, context_type: ContextType) -> Optional[ContextData]:
     """ Get the first Context of the given type, or None if there is none. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
-        return None
-    return result[0]
+    return next(_iter_contexts(event=event, context_type=context_type), None)
 
 
 def get_context(event: EventData, context_type: ContextType) -> ContextData:
     """ Get the first Context of the given type. """
-    result = get_contexts(event=event, context_type=context_type)
-    if not result:
+    result = get_optional_context(event=event, context_type=context_type)
+    if result is None:
         raise ValueError(f'context-type {context_type} not present in event. data: {event}')
-    return result[0]
+    return result
 
 
 def get_contexts(event: EventData, context_type: ContextType) -> List[ContextData]:
     """ Given all the Contexts of the given type."""
-    contexts = get_global_contexts(event) + get_location_stack(event)
-    result = []
-    for context in contexts:
-        _contexts_types = cast(List[ContextType], context.get("_types", []))
-        if context.get("_type") == context_type or context_type in _contexts_types:
-            result.append(context)
-    return result
+    return list(_iter_contexts(event=event, context_type=context_type))
+
+
+def _iter_contexts(event: EventData, context_type: ContextType) -> Iterator[ContextData]:
+    for context in chain(get_global_contexts(event), get_location_stack(event)):
+        if context_type in _get_context_types(context):
+            yield context
+
+
+def _get_context_types(context: ContextData) -> Iterable[ContextType]:
+    """ Give the type and (if hydrated) parent types of a context. """
+    _contexts_types = cast(List[ContextType], context.get("_types", []))
+    return chain((cast(ContextType, context.get("_type")),), _contexts_types)
 
 
 def get_global_contexts(event: EventData) -> List[ContextData]:
@@ -44,8 +48,60 @@ def get_location_stack(event: EventData) -> List[ContextData]:
     return event.get("location_stack", [])
 
 
-def add_global_context_to_event(event: EventData, context: AbstractGlobalContext) -> EventData:
-    """ Add the global context to the event. Returns the modified event """
+def add_global_context_to_event(event: EventData,
+                                context: AbstractGlobalContext,
+                                index: Optional['ContextIndex'] = None) -> EventData:
+    """
+    Add the global context to the event. Returns the modified event
+    :param index: optional ContextIndex of the event, that will be updated with the new context
+    """
     event['global_contexts'].append(context)
+    if index is not None:
+        index.add_global_context(context)
     return event
 
+
+class ContextIndex:
+    """
+    Index of the contexts of a single event, by type and parent types. Use this instead of the functions
+    above if multiple contexts are looked up in the same event; those functions scan all contexts of the
+    event on every call, while this scans them once.
+
+    The index is not updated if the event is modified. Global contexts that are added to the event with
+    add_global_context_to_event(event, context, index) are added to the index too.
+    """
+
+    def __init__(self, event: EventData):
+        # Global contexts and location contexts are kept apart, to keep the same order as get_contexts()
+        self._global_contexts: Dict[ContextType, List[ContextData]] = {}
+        self._location_contexts: Dict[ContextType, List[ContextData]] = {}
+        for context in get_global_contexts(event):
+            self.add_global_context(context)
+        for context in get_location_stack(event):
+            _add_to_index(self._location_contexts, context)
+
+    def add_global_context(self, context: ContextData):
+        """ Add a context to the index, that was added to the end of the event's global contexts. """
+        _add_to_index(self._global_contexts, context)
+
+    def get_optional_context(self, context_type: ContextType) -> Optional[ContextData]:
+        """ Get the first Context of the given type, or None if there is none. """
+        contexts = self._global_contexts.get(context_type) or self._location_contexts.get(context_type)
+        return contexts[0] if contexts else None
+
+    def get_context(self, context_type: ContextType) -> ContextData:
+        """ Get the first Context of the given type. """
+        result = self.get_optional_context(context_type)
+        if result is None:
+            raise ValueError(f'context-type {context_type} not present in event')
+        return result
+
+    def get_contexts(self, context_type: ContextType) -> List[ContextData]:
+        """ Given all the Contexts of the given type."""
+        return self._global_contexts.get(context_type, []) + self._location_contexts.get(context_type, [])
+
+
+def _add_to_index(index: Dict[ContextType, List[ContextData]], context: ContextData):
+    # set(), as _types might include the _type itself
+    for context_type in set(_get_context_types(context)):
+        index.setdefault(context_type, []).append(context)
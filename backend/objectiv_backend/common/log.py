@@ -0,0 +1,95 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Leveled logging for the collector and the workers, for messages that are logged per request or per batch.
+
+Messages are written to stdout by a background thread, so that handling a request doesn't wait for a
+write to stdout. The level is set with LOG_LEVEL, e.g. `DEBUG` to see details of every request.
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from typing import IO, Optional
+
+from objectiv_backend.common.config import LOG_LEVEL
+
+# Maximum number of messages waiting to be written. If the stream can't keep up, messages are dropped
+# instead of slowing down the collector.
+_MAX_PENDING_MESSAGES = 10_000
+
+
+class BufferedStreamHandler(logging.Handler):
+    """ Handler that writes formatted messages to a stream in a background thread. """
+
+    def __init__(self, stream: Optional[IO[str]] = None):
+        super().__init__()
+        self.stream = stream
+        self._queue: queue.Queue = queue.Queue(maxsize=_MAX_PENDING_MESSAGES)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._thread_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            pass
+
+    def flush(self):
+        """ Wait until all pending messages are written. """
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._queue.join()
+
+    def _ensure_thread(self):
+        # The thread doesn't survive a fork, start one per process
+        if self._thread_pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._thread_pid != os.getpid():
+                self._queue = queue.Queue(maxsize=_MAX_PENDING_MESSAGES)
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+    def _run(self):
+        pending = self._queue
+        while True:
+            messages = [pending.get()]
+            # Write everything that is waiting at once
+            while True:
+                try:
+                    messages.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(''.join(f'{message}\n' for message in messages))
+                stream.flush()
+            except Exception:
+                pass
+            for _ in messages:
+                pending.task_done()
+
+
+_HANDLER = BufferedStreamHandler()
+_HANDLER.setFormatter(logging.Formatter('%(message)s'))
+atexit.register(_HANDLER.flush)
+
+_ROOT_LOGGER = logging.getLogger('objectiv_backend')
+_ROOT_LOGGER.setLevel(LOG_LEVEL)
+_ROOT_LOGGER.addHandler(_HANDLER)
+_ROOT_LOGGER.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """ Get the logger for a module, e.g. get_logger(__name__). """
+    return logging.getLogger(name)
@@ -0,0 +1,238 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Counters, gauges and histograms for the collector and the workers, in the Prometheus text format.
+
+The metrics are kept per process. The collector serves the metrics of the process that handles the request
+on `/metrics`, so with several (gunicorn) worker processes behind one port, consecutive scrapes can show
+different processes. The workers can serve them on a separate port, see start_metrics_server().
+"""
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from objectiv_backend.common.log import get_logger
+
+logger = get_logger(__name__)
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """ Collection of metrics that are rendered together. Thread-safe. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, '_Metric'] = {}
+        self._collect_hooks: Dict[str, Callable[[], None]] = {}
+
+    def register(self, metric: '_Metric'):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+
+    def set_collect_hook(self, name: str, hook: Callable[[], None]):
+        """
+        Set a function that is called before rendering, e.g. to update gauges of queue sizes. Setting a
+        hook with the same name again replaces it.
+        """
+        with self._lock:
+            self._collect_hooks[name] = hook
+
+    def render(self) -> str:
+        """ Give all metrics in the Prometheus text format. """
+        with self._lock:
+            hooks = list(self._collect_hooks.items())
+            metrics = list(self._metrics.values())
+        for name, hook in hooks:
+            try:
+                hook()
+            except Exception as exc:
+                logger.warning(f'Error collecting {name} metrics: {exc}')
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {_escape(self.documentation, quote=False)}',
+                f'# TYPE {self.name} {self.type}']
+
+    def _get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f'Metric {self.name} has labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    """ Value that only goes up, e.g. the number of processed events. """
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._get_key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return super().render() + [f'{self.name}{self._format_labels(key)} {_format_value(value)}'
+                                   for key, value in values]
+
+
+class Gauge(Counter):
+    """ Value that can go up and down, e.g. the number of events in a queue. """
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, e.g. durations, in cumulative buckets. """
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: count per bucket (the last one is +Inf), and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._get_key(labels)
+        index = len(self.buckets)
+        for bucket_index, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = bucket_index
+                break
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._values[key]
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """ Observe the duration of the with block, in seconds. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels: str) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._get_key(labels), ([0], [0.0]))
+            return sum(counts)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        lines = super().render()
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+                cumulative += count
+                labels = self._format_labels(key, extra=[('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return lines
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def start_metrics_server(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """ Serve the metrics on http://0.0.0.0:port/metrics, in a background thread. """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Don't log every scrape
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+# ### Metrics of the collector and the workers
+REQUESTS = Counter('objectiv_collector_requests_total', 'Requests with events to the collector', ['result'])
+EVENTS = Counter('objectiv_events_total', 'Events, by result: received, ok, nok, or duplicate', ['result'])
+STAGE_SECONDS = Histogram(
+    'objectiv_stage_seconds',
+    'Time per request or batch of the processing stages: parse, validate_structure, enrich, validate_schema, '
+    'and hydrate',
+    ['stage'])
+DB_SECONDS = Histogram('objectiv_db_seconds', 'Time of reading and writing events per table', ['operation', 'table'])
+SINK_SECONDS = Histogram('objectiv_sink_write_seconds', 'Time of writing events to an output', ['sink'])
+SINK_ERRORS = Counter('objectiv_sink_errors_total', 'Failed writes to an output', ['sink'])
+SINK_DROPPED_EVENTS = Counter('objectiv_sink_dropped_events_total', 'Events dropped by an output', ['sink'])
+QUEUE_EVENTS = Gauge('objectiv_queue_events', 'Events waiting in a queue', ['queue'])
+WORKER_BATCH_SECONDS = Histogram('objectiv_worker_batch_seconds', 'Time per batch of a worker', ['worker'])
+WORKER_EVENTS = Counter('objectiv_worker_events_total', 'Events processed by a worker', ['worker'])
+# Totals of all worker processes of the supervisor, see run_supervisor()
+WORKER_STAGE_EVENTS = Gauge('objectiv_worker_stage_events', 'Events processed by all workers of a stage', ['stage'])
+WORKER_STAGE_BUSY_SECONDS = Gauge('objectiv_worker_stage_busy_seconds', 'Time that all workers of a stage were busy',
+                                  ['stage'])
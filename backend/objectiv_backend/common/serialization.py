@@ -0,0 +1,67 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+JSON serialization of events. Uses orjson if it is installed, which is a lot faster than the standard
+library's json module. Falls back to the json module otherwise.
+
+The output of dumps() is compact, and might differ in whitespace from json.dumps(), but represents the same
+data.
+"""
+import json
+from typing import Any, List, Optional, Union
+
+from objectiv_backend.common.types import EventDataList
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+def dumps(value: Any) -> str:
+    """ Serialize value to a JSON string. """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:
+            # orjson doesn't support everything that json does, e.g. integers of more than 64 bits
+            pass
+    return json.dumps(value, separators=(',', ':'))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Deserialize a JSON string.
+    :raise ValueError: if data is not valid JSON
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson doesn't support everything that json does, e.g. integers of more than 64 bits. Let json
+            # decide whether the data is really invalid.
+            pass
+    return json.loads(data)
+
+
+def serialize_events(events: EventDataList) -> List[str]:
+    """ Serialize each event to a JSON string. """
+    return [dumps(event) for event in events]
+
+
+def get_serialized_events(events: EventDataList, serialized_events: Optional[List[str]]) -> List[str]:
+    """
+    Give serialized_events if set, or else serialize the events. Functions that write events can use this
+    to accept events that were already serialized by the caller, so that every event is only serialized once
+    no matter how many outputs it is written to.
+    """
+    if serialized_events is None:
+        return serialize_events(events)
+    if len(serialized_events) != len(events):
+        raise ValueError(f'Got {len(serialized_events)} serialized events for {len(events)} events')
+    return serialized_events
+
+
+def join_serialized_events(serialized_events: List[str]) -> str:
+    """ Combine serialized events into a JSON array, without serializing the events again. """
+    return '[' + ','.join(serialized_events) + ']'
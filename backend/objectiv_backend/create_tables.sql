@@ -12,6 +12,8 @@ create table queue_finalize (
     value json not null
 );
 
+-- begin data table
+-- db_init replaces this block with data_partitioned.sql if run with --partition-by
 create table data (
     event_id uuid not null,
     day date not null, -- This is for query convenience; a possible sharding key? We might well put an index on this badboy
@@ -22,6 +24,7 @@ create table data (
 );
 
 create index on data(day);
+-- end data table
 
 create type failure_reason as enum('failed validation', 'duplicate');
 
@@ -99,5 +102,19 @@ grant insert on data, nok_data to obj_worker_role;
 create role obj_reader_role noinherit;
 grant select on data, data_with_sessions to obj_reader_role;
 
+-- only exist if data is partitioned (see data_partitioned.sql), or if sessions are maintained (see sessions.sql)
+do $$
+begin
+    if to_regclass('data_event_ids') is not null then
+        grant select, insert on data_event_ids to obj_collector_role, obj_worker_role;
+    end if;
+    if to_regclass('session_events') is not null then
+        grant select, insert, update, delete on sessions, session_events to obj_collector_role, obj_worker_role;
+        grant usage on sequence sessions_session_id_seq to obj_collector_role, obj_worker_role;
+        grant select on sessions, session_events to obj_reader_role;
+    end if;
+end
+$$;
+
 
 commit;
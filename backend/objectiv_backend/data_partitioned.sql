@@ -0,0 +1,34 @@
+-- Partitioned layout of the data table, used instead of the data table in create_tables.sql if db_init is
+-- run with --partition-by. The partitions are managed by objectiv_backend/tools/db_partitions.
+create table data (
+    event_id uuid not null,
+    day date not null,
+    moment timestamp not null,
+    cookie_id uuid not null,
+    value json not null,
+    -- The primary key of a partitioned table must include the partition key
+    primary key(event_id, day)
+) partition by range (day);
+
+create index on data(day);
+
+-- Catches events for which there is no partition yet. db_partitions moves these events to the right
+-- partition when it creates that partition.
+create table data_default partition of data default;
+
+-- The primary key of data only guarantees unique event_ids within a partition. This table guarantees that
+-- event_ids are unique across all partitions, see insert_events_into_data().
+create table data_event_ids (
+    event_id uuid not null,
+    day date not null,
+    primary key(event_id)
+);
+
+create index on data_event_ids(day);
+
+-- Size of the partitions of data: 'day' or 'month'
+create table data_partitioning (
+    partition_by text not null check (partition_by in ('day', 'month'))
+);
+
+insert into data_partitioning(partition_by) values ('{partition_by}');
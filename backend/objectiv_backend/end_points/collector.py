@@ -1,29 +1,38 @@
-import json
 import urllib.parse
 from datetime import datetime
 
 import flask
 import time
 from urllib.parse import urlparse, parse_qs
-from typing import List
+from typing import Callable, List, Optional, Tuple, TypeVar
 
 from flask import Response, Request
 
-from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.config import PostgresConfig, get_collector_config
 from objectiv_backend.common.types import EventData, EventDataList, EventList
-from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.common.db import get_pooled_db_connection, set_local_statement_timeout
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import EVENTS, REQUESTS, STAGE_SECONDS
+from objectiv_backend.common.serialization import dumps, loads, serialize_events
 from objectiv_backend.common.event_utils import add_global_context_to_event, get_contexts
-from objectiv_backend.end_points.common import get_json_response, get_cookie_id
+from objectiv_backend.end_points.common import get_json_response, get_cookie_id, decode_body
 from objectiv_backend.end_points.extra_output import events_to_json, write_data_to_fs_if_configured, \
     write_data_to_s3_if_configured, write_data_to_snowplow_if_configured
+from objectiv_backend.end_points.rolling_files import get_rolling_files
+from objectiv_backend.end_points.sink_dispatcher import get_sink_dispatcher
+from objectiv_backend.end_points.spool import KIND_ENTRY, KIND_NOK, KIND_OK, SPOOL_ERRORS, get_spool
+from objectiv_backend.end_points.write_coalescer import get_write_coalescer
 from objectiv_backend.schema.validate_events import validate_structure_event_list, EventError
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
 from objectiv_backend.workers.pg_storage import insert_events_into_nok_data
+from objectiv_backend.workers.recent_event_ids import get_recent_event_ids
 from objectiv_backend.workers.worker_entry import process_events_entry
 from objectiv_backend.workers.worker_finalize import insert_events_into_data
 
 from objectiv_backend.schema.schema import HttpContext, CookieIdContext, MarketingContext
 
+logger = get_logger(__name__)
+
 # Some limits on the inputs we accept
 DATA_MAX_SIZE_BYTES = 1_000_000
 DATA_MAX_EVENT_COUNT = 1_000
@@ -39,19 +48,23 @@ def collect() -> Response:
         events: EventDataList = event_data['events']
         transport_time: int = event_data['transport_time']
     except ValueError as exc:
-        print(f'Data problem: {exc}')  # todo: real error logging
+        logger.info(f'Data problem: {exc}')
+        REQUESTS.inc(result='data_error')
         return _get_collector_response(error_count=1, event_count=-1, data_error=exc.__str__())
+    REQUESTS.inc(result='ok')
+    EVENTS.inc(len(events), result='received')
 
     # Do all the enrichment steps that can only be done in this phase
-    add_enriched_contexts(events)
-
-    set_time_in_events(events, current_millis, transport_time)
+    with STAGE_SECONDS.time(stage='enrich'):
+        add_enriched_contexts(events)
+        set_time_in_events(events, current_millis, transport_time)
 
     if not get_collector_config().async_mode:
         ok_events, nok_events, event_errors = process_events_entry(events=events, current_millis=current_millis)
-        print(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
-        write_sync_events(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors)
-        return _get_collector_response(error_count=len(nok_events), event_count=len(events), event_errors=event_errors)
+        logger.debug(f'ok_events: {len(ok_events)}, nok_events: {len(nok_events)}')
+        duplicate_events = write_sync_events(ok_events=ok_events, nok_events=nok_events, event_errors=event_errors)
+        return _get_collector_response(error_count=len(nok_events), event_count=len(events), event_errors=event_errors,
+                                       duplicate_count=len(duplicate_events))
     else:
         write_async_events(events=events)
         return _get_collector_response(error_count=0, event_count=len(events))
@@ -62,8 +75,8 @@ def _get_event_data(request: Request) -> EventList:
     Parse the requests data as json and return as a list
 
     :raise ValueError:
-        1) the data structure is bigger than DATA_MAX_SIZE_BYTES
-        2) the data could not be parsed as JSON
+        1) the data structure is bigger than DATA_MAX_SIZE_BYTES, before or after decompression
+        2) the data could not be decompressed or parsed as JSON
         3) the parsed data isn't a valid dictionary
         4) the key 'events' could not be found in the dictionary
         5) event_data['events'] is not a list
@@ -73,11 +86,17 @@ def _get_event_data(request: Request) -> EventList:
     :param request: Request from which to parse the data
     :return: the parsed data, an EventList (structure as sent by the tracker)
     """
-    post_data = request.data
+    if request.content_length is not None and request.content_length > DATA_MAX_SIZE_BYTES:
+        raise ValueError(f'Data size exceeds limit')
+    # Don't read more than needed to know that the data is too big
+    post_data = request.stream.read(DATA_MAX_SIZE_BYTES + 1)
     if len(post_data) > DATA_MAX_SIZE_BYTES:
         # if it's more than a megabyte, we'll refuse to process
         raise ValueError(f'Data size exceeds limit')
-    event_data: EventList = json.loads(post_data)
+    with STAGE_SECONDS.time(stage='parse'):
+        # The tracker can compress the data. The size limit also applies to the decompressed data.
+        post_data = decode_body(post_data, request.headers.get('Content-Encoding'), max_size=DATA_MAX_SIZE_BYTES)
+        event_data: EventList = loads(post_data)
     if not isinstance(event_data, dict):
         raise ValueError('Parsed post data is not a dict')
     if 'events' not in event_data:
@@ -86,7 +105,8 @@ def _get_event_data(request: Request) -> EventList:
         raise ValueError('events is not a list')
     if len(event_data['events']) > DATA_MAX_EVENT_COUNT:
         raise ValueError('Events exceeds limit')
-    error_info = validate_structure_event_list(event_data=event_data)
+    with STAGE_SECONDS.time(stage='validate_structure'):
+        error_info = validate_structure_event_list(event_data=event_data)
     if error_info:
         raise ValueError(f'List of Events not structured well: {error_info[0].info}')
 
@@ -94,9 +114,17 @@ def _get_event_data(request: Request) -> EventList:
 
 
 def _get_collector_response(
-        error_count: int, event_count: int, event_errors: List[EventError] = None, data_error: str = '') -> Response:
+        error_count: int,
+        event_count: int,
+        event_errors: Optional[List[EventError]] = None,
+        data_error: str = '',
+        cookie_id: Optional[str] = None,
+        duplicate_count: int = 0) -> Response:
     """
     Create a Response object, with a json message with event counts, and a cookie set if needed.
+    :param cookie_id: tracking cookie uuid to set. If not set, get_cookie_id() is used.
+    :param duplicate_count: number of events that were already stored before, and were written to the
+        nok_data table instead of the data table. These are not errors.
     """
 
     if not get_collector_config().error_reporting:
@@ -107,37 +135,45 @@ def _get_collector_response(
             event_errors = []
 
     status = 200 if error_count == 0 else 400
-    msg = json.dumps({
+    msg = dumps({
         "status": f"{status}",
         "error_count": error_count,
         "event_count": event_count,
         "event_errors": event_errors,
-        "data_error": data_error
+        "data_error": data_error,
+        "duplicate_count": duplicate_count
     })
     # we always return a HTTP 200 status code, so we can handle any errors
     # on the application layer.
-    return get_json_response(status=200, msg=msg)
+    return get_json_response(status=200, msg=msg, cookie_id=cookie_id)
 
 
-def add_enriched_contexts(events: EventDataList):
+def add_enriched_contexts(events: EventDataList,
+                          request: Optional[Request] = None,
+                          cookie_id: Optional[str] = None):
     """
     Enrich the list of events
+    :param request: request that contained the events. If not set, the current flask request is used.
+    :param cookie_id: tracking cookie uuid of the request. If not set, get_cookie_id() is used.
     """
-
-    add_cookie_id_contexts(events)
+    if request is None:
+        request = flask.request
+    add_cookie_id_contexts(events, cookie_id=cookie_id)
     for event in events:
-        add_http_context_to_event(event=event, request=flask.request)
+        add_http_context_to_event(event=event, request=request)
         add_marketing_context_to_event(event=event)
 
 
-def add_cookie_id_contexts(events: EventDataList):
+def add_cookie_id_contexts(events: EventDataList, cookie_id: Optional[str] = None):
     """
     Modify the given list of events: Add the CookieIdContext to each event, if cookies are enabled.
+    :param cookie_id: tracking cookie uuid of the request. If not set, get_cookie_id() is used.
     """
     cookie_config = get_collector_config().cookie
     if not cookie_config:
         return
-    cookie_id = get_cookie_id()
+    if cookie_id is None:
+        cookie_id = get_cookie_id()
     cookie_id_context = CookieIdContext(id=cookie_id, cookie_id=cookie_id)
     for event in events:
         add_global_context_to_event(event, cookie_id_context)
@@ -158,7 +194,7 @@ def set_time_in_events(events: EventDataList, current_millis: int, client_millis
         client_millis = current_millis
 
     offset = current_millis - client_millis
-    print(f'debug - time offset: {offset}')
+    logger.debug(f'time offset: {offset}')
     for event in events:
         # here we correct the tracking time with the calculated offset
         # the assumption here is that transport time should be the same as the server time (current_millis)
@@ -282,36 +318,49 @@ def add_marketing_context_to_event(event: EventData) -> None:
                 pass
 
 
-def write_sync_events(ok_events: EventDataList, nok_events: EventDataList, event_errors: List[EventError] = None):
+def write_sync_events(ok_events: EventDataList,
+                      nok_events: EventDataList,
+                      event_errors: List[EventError] = None) -> EventDataList:
     """
     Write the events to the following sinks, if configured:
         * postgres
         * aws
         * file system
+        * snowplow
+
+    If output_config.async_sinks is set, then all outputs but postgres are written in the background.
+    If output_config.rolling_files is set, then aws and file system are appended to rolling files, see RollingFiles.
+    If postgres.coalesce_millis is set, then the postgres writes are combined with those of concurrent
+    requests, see WriteCoalescer.
+    If output_config.spool is set, then the events are spooled if postgres is unavailable, see Spool.
+
+    :return: the events of ok_events that were duplicates, see insert_events_into_data(). Empty if the
+        events were not written to postgres, or were spooled.
     """
     output_config = get_collector_config().output
+    duplicate_events: EventDataList = []
+    # Serialize the events once, for all outputs that store the events as json
+    serialized_ok_events = serialize_events(ok_events)
+    serialized_nok_events = serialize_events(nok_events)
     # todo: add exception handling. if one output fails, continue to next if configured.
     if output_config.postgres:
-        connection = get_db_connection(output_config.postgres)
-        try:
-            with connection:
-                insert_events_into_data(connection, events=ok_events)
-                insert_events_into_nok_data(connection, events=nok_events)
-        finally:
-            connection.close()
-
-    if output_config.snowplow:
+        pg_config = output_config.postgres
+        duplicate_events = _write_to_postgres_or_spool(
+            write=lambda timeout: _write_sync_events_to_postgres(
+                pg_config, ok_events, nok_events, serialized_ok_events, serialized_nok_events, timeout),
+            records=[(KIND_OK, serialized_ok_events), (KIND_NOK, serialized_nok_events)]) or []
+
+    if output_config.async_sinks:
+        dispatcher = get_sink_dispatcher(output_config)
+        dispatcher.submit_snowplow(events=ok_events, good=True)
+        dispatcher.submit_snowplow(events=nok_events, good=False, event_errors=event_errors)
+    elif output_config.snowplow:
         write_data_to_snowplow_if_configured(events=ok_events, good=True)
         write_data_to_snowplow_if_configured(events=nok_events, good=False, event_errors=event_errors)
 
-    if not output_config.file_system and not output_config.aws:
-        return
-    for prefix, events in ('OK', ok_events), ('NOK', nok_events):
-        if events:
-            data = events_to_json(events)
-            moment = datetime.utcnow()
-            write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
-            write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+    _write_files(prefix='OK', events=ok_events, serialized_events=serialized_ok_events)
+    _write_files(prefix='NOK', events=nok_events, serialized_events=serialized_nok_events)
+    return duplicate_events
 
 
 def write_async_events(events: EventDataList):
@@ -320,24 +369,114 @@ def write_async_events(events: EventDataList):
         * postgres - To the entry queue
         * aws - to the 'RAW' prefix
         * file system - to the 'RAW' directory
+
+    If output_config.async_sinks is set, then aws and file system are written in the background.
+    If output_config.rolling_files is set, then aws and file system are appended to rolling files, see RollingFiles.
+    If output_config.spool is set, then the events are spooled if postgres is unavailable, see Spool.
     """
     output_config = get_collector_config().output
+    # Serialize the events once, for all outputs
+    serialized_events = serialize_events(events)
     # todo: add exception handling. if one output fails, continue to next if configured.
     if output_config.postgres:
-        connection = get_db_connection(output_config.postgres)
-        try:
-            with connection:
-                pg_queue = PostgresQueues(connection=connection)
-                pg_queue.put_events(queue=ProcessingStage.ENTRY, events=events)
-        finally:
-            connection.close()
-
-    if not output_config.file_system and not output_config.aws:
+        pg_config = output_config.postgres
+        _write_to_postgres_or_spool(
+            write=lambda timeout: _write_async_events_to_postgres(pg_config, events, serialized_events, timeout),
+            records=[(KIND_ENTRY, serialized_events)])
+
+    _write_files(prefix='RAW', events=events, serialized_events=serialized_events)
+
+
+def _write_files(prefix: str, events: EventDataList, serialized_events: List[str]):
+    """
+    Write events to the S3 and file system outputs, if configured. Depending on the configuration the
+    events are appended to rolling files, written in the background, or written directly to a new file.
+    :param prefix: prefix for the S3 object names and file system directories
+    :param serialized_events: the events serialized with serialize_events()
+    """
+    output_config = get_collector_config().output
+    if not events or (not output_config.file_system and not output_config.aws):
         return
-    prefix = 'RAW'
-    if events:
-        data = events_to_json(events)
+    rolling_files = get_rolling_files(output_config)
+    if rolling_files is not None:
+        rolling_files.append(prefix=prefix, serialized_events=serialized_events)
+    elif output_config.async_sinks:
+        get_sink_dispatcher(output_config).submit_files(prefix=prefix, serialized_events=serialized_events)
+    else:
+        data = events_to_json(events, serialized_events=serialized_events)
         moment = datetime.utcnow()
         write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
         write_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
 
+
+_T = TypeVar('_T')
+
+
+def _write_to_postgres_or_spool(write: Callable[[float], _T], records: List[Tuple[str, List[str]]]) -> Optional[_T]:
+    """
+    Call write(statement_timeout_seconds). If a spool is configured and the database is unavailable or
+    exceeds the latency budget, then the records are written to the spool instead.
+    :param write: function that writes the events to postgres, with the given statement timeout in
+        seconds (0 for no timeout)
+    :param records: the events, as records for Spool.append()
+    :return: the result of write(), or None if the records were spooled
+    """
+    output_config = get_collector_config().output
+    if not output_config.spool or not output_config.postgres:
+        return write(0)
+    spool = get_spool(output_config.spool, output_config.postgres)
+    try:
+        result = write(output_config.spool.latency_budget_seconds)
+    except SPOOL_ERRORS as exc:
+        logger.warning(f'Could not write events to postgres, spooling them: {exc}')
+        spool.append(records)
+        return None
+    # Postgres is available again, complete the current segment so it can be replayed
+    spool.rotate()
+    return result
+
+
+def _write_sync_events_to_postgres(pg_config: PostgresConfig,
+                                   ok_events: EventDataList,
+                                   nok_events: EventDataList,
+                                   serialized_ok_events: List[str],
+                                   serialized_nok_events: List[str],
+                                   statement_timeout_seconds: float) -> EventDataList:
+    """
+    Write events to the data table, and events to the nok_data table.
+    :return: the events of ok_events that were duplicates, see insert_events_into_data()
+    """
+    if pg_config.coalesce_millis:
+        coalescer = get_write_coalescer(pg_config, statement_timeout_seconds=statement_timeout_seconds)
+        return coalescer.write(
+            ok_events=ok_events, nok_events=nok_events,
+            serialized_ok_events=serialized_ok_events, serialized_nok_events=serialized_nok_events)
+    recent_event_ids = get_recent_event_ids(pg_config)
+    with get_pooled_db_connection(pg_config) as connection:
+        with connection:
+            if statement_timeout_seconds:
+                set_local_statement_timeout(connection, statement_timeout_seconds)
+            copy_threshold = pg_config.copy_threshold
+            duplicate_events = insert_events_into_data(connection, events=ok_events,
+                                                       copy_threshold=copy_threshold,
+                                                       serialized_events=serialized_ok_events,
+                                                       recent_event_ids=recent_event_ids)
+            insert_events_into_nok_data(connection, events=nok_events, copy_threshold=copy_threshold,
+                                        serialized_events=serialized_nok_events)
+    if recent_event_ids is not None:
+        # Now that the transaction is committed, all ok_events are in the data table
+        recent_event_ids.add(str(event['id']) for event in ok_events)
+    return duplicate_events
+
+
+def _write_async_events_to_postgres(pg_config: PostgresConfig,
+                                    events: EventDataList,
+                                    serialized_events: List[str],
+                                    statement_timeout_seconds: float):
+    """ Write events to the entry queue. """
+    with get_pooled_db_connection(pg_config) as connection:
+        with connection:
+            if statement_timeout_seconds:
+                set_local_statement_timeout(connection, statement_timeout_seconds)
+            pg_queue = PostgresQueues(connection=connection, copy_threshold=pg_config.copy_threshold)
+            pg_queue.put_events(queue=ProcessingStage.ENTRY, events=events, serialized_events=serialized_events)
@@ -2,22 +2,29 @@
 Copyright 2021 Objectiv B.V.
 """
 import uuid
+import zlib
+from typing import Optional
+
 import flask
 from flask import Response
 from objectiv_backend.common.config import get_collector_config
+from objectiv_backend.common.log import get_logger
 
+logger = get_logger(__name__)
 
-def get_json_response(status: int, msg: str) -> Response:
+def get_json_response(status: int, msg: str, cookie_id: Optional[str] = None) -> Response:
     """
     Create a Response object, with json content, and a cookie set if needed.
     :param status: http status code
     :param msg: valid json string
+    :param cookie_id: tracking cookie uuid to set. If not set, get_cookie_id() is used.
     """
     response = Response(mimetype='application/json', status=status, response=msg)
 
     cookie_config = get_collector_config().cookie
     if cookie_config:
-        cookie_id = get_cookie_id()
+        if cookie_id is None:
+            cookie_id = get_cookie_id()
         response.set_cookie(key=cookie_config.name, value=f'{cookie_id}',
                             max_age=cookie_config.duration, samesite='Lax')
     return response
@@ -45,6 +52,72 @@ def get_cookie_id() -> str:
         # use uuid4 (random), so there is no predictability and bad actors cannot ruin sessions of others
         cookie_id = str(uuid.uuid4())
         flask.g.G_COOKIE_ID = cookie_id
-        print(f'Generating cookie_id: {cookie_id}')
+        logger.debug(f'Generating cookie_id: {cookie_id}')
 
     return str(cookie_id)
+
+
+def decode_body(data: bytes, content_encoding: Optional[str], max_size: int) -> bytes:
+    """
+    Decompress a request body according to its Content-Encoding header. Supported encodings are gzip,
+    deflate and identity.
+
+    Decompression stops as soon as the output exceeds max_size, so a small compressed body that would
+    decompress to a huge amount of data (a 'zip bomb') never takes more than max_size bytes of memory.
+
+    :param data: request body, as received
+    :param content_encoding: value of the Content-Encoding header, or None if not set
+    :param max_size: maximum size of the decompressed body
+    :raise ValueError: if the encoding is not supported, the data cannot be decompressed, or the
+        decompressed data is bigger than max_size
+    """
+    if not content_encoding:
+        return data
+    # Encodings are listed in the order in which they were applied
+    encodings = [encoding.strip().lower() for encoding in content_encoding.split(',')]
+    for encoding in reversed(encodings):
+        if encoding == 'identity':
+            continue
+        if encoding in ('gzip', 'x-gzip'):
+            # A gzip body can consist of multiple members, which are concatenated when decompressed
+            data = _decompress(data, wbits=16 + zlib.MAX_WBITS, max_size=max_size, multi_member=True)
+        elif encoding == 'deflate':
+            # Some clients send raw deflate data, without the zlib header
+            wbits = zlib.MAX_WBITS if _has_zlib_header(data) else -zlib.MAX_WBITS
+            data = _decompress(data, wbits=wbits, max_size=max_size, multi_member=False)
+        else:
+            raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+    return data
+
+
+def _decompress(data: bytes, wbits: int, max_size: int, multi_member: bool) -> bytes:
+    """
+    Decompress data, producing at most max_size + 1 bytes of output in total.
+
+    :param multi_member: if True, data after the end of the compressed stream is decompressed as another
+        stream (e.g. the members of a gzip file). If False, such data is an error.
+    :raise ValueError: if the data cannot be decompressed, is incomplete, is followed by unexpected data,
+        or the decompressed data is bigger than max_size
+    """
+    result = b''
+    while True:
+        decompressor = zlib.decompressobj(wbits=wbits)
+        try:
+            # max_length is at least 1 here, as 0 would mean no limit
+            result += decompressor.decompress(data, max_size + 1 - len(result))
+        except zlib.error as exc:
+            raise ValueError(f'Could not decompress data: {exc}')
+        if len(result) > max_size:
+            raise ValueError('Decompressed data size exceeds limit')
+        if not decompressor.eof:
+            raise ValueError('Compressed data is incomplete')
+        data = decompressor.unused_data
+        if not data:
+            return result
+        if not multi_member:
+            raise ValueError('Unexpected data after compressed data')
+
+
+def _has_zlib_header(data: bytes) -> bool:
+    """ Check whether data starts with a zlib header (RFC 1950) that specifies the deflate method. """
+    return len(data) >= 2 and data[0] & 0x0f == 8 and ((data[0] << 8) + data[1]) % 31 == 0
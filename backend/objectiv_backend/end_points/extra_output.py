@@ -5,14 +5,16 @@ Functions to write data to S3 and the local filesystem.
 
 This is experimental code, and not ready for production use.
 """
-import json
 from datetime import datetime
 from io import BytesIO
 
-from typing import List
+from typing import List, Any, Optional
 
 
 from objectiv_backend.common.config import get_collector_config, SnowplowConfig
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import SINK_ERRORS, SINK_SECONDS
+from objectiv_backend.common.serialization import get_serialized_events, join_serialized_events
 from objectiv_backend.common.types import EventDataList
 from objectiv_backend.schema.validate_events import EventError
 from objectiv_backend.snowplow.snowplow_helper import write_data_to_aws_pipeline, write_data_to_gcp_pubsub
@@ -21,14 +23,17 @@ if get_collector_config().output.aws:
     import boto3
     from botocore.exceptions import ClientError
 
+logger = get_logger(__name__)
 
-def events_to_json(events: EventDataList) -> str:
+
+def events_to_json(events: EventDataList, serialized_events: Optional[List[str]] = None) -> str:
     """
     Convert list of events to a string with on each line a json object representing a single event.
     Note that the returned string is not a json list; This format makes it suitable as raw input to AWS
     Athena.
+    :param serialized_events: optional, the events serialized with serialize_events()
     """
-    return json.dumps(events)
+    return join_serialized_events(get_serialized_events(events, serialized_events))
 
 
 def write_data_to_fs_if_configured(data: str, prefix: str, moment: datetime) -> None:
@@ -44,7 +49,7 @@ def write_data_to_fs_if_configured(data: str, prefix: str, moment: datetime) ->
         return
     timestamp = moment.timestamp()
     path = f'{fs_config.path}/{prefix}/{timestamp}.json'
-    with open(path, 'w') as of:
+    with SINK_SECONDS.time(sink='file_system'), open(path, 'w') as of:
         of.write(data)
 
 
@@ -57,6 +62,18 @@ def write_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) ->
         before /filename.json
     :param moment: timestamp that the data arrived
     """
+    try:
+        upload_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+    except ClientError as e:
+        logger.warning(f'Error uploading to s3: {e}')
+        SINK_ERRORS.inc(sink='s3')
+
+
+def upload_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) -> None:
+    """
+    Same as write_data_to_s3_if_configured(), but raises an exception if the upload fails.
+    :raise botocore.exceptions.ClientError: if the upload fails
+    """
     aws_config = get_collector_config().output.aws
     if not aws_config:
         return
@@ -65,31 +82,59 @@ def write_data_to_s3_if_configured(data: str, prefix: str, moment: datetime) ->
     datestamp = moment.strftime('%Y/%m/%d')
     object_name = f'{aws_config.s3_prefix}/{datestamp}/{prefix}/{timestamp}.json'
     file_obj = BytesIO(data.encode('utf-8'))
-    s3_client = boto3.client(
-        service_name='s3',
-        region_name=aws_config.region,
-        aws_access_key_id=aws_config.access_key_id,
-        aws_secret_access_key=aws_config.secret_access_key)
-    try:
-        s3_client.upload_fileobj(file_obj, aws_config.bucket, object_name)
-    except ClientError as e:
-        print(f'Error uploading to s3: {e} ')
+    with SINK_SECONDS.time(sink='s3'):
+        _get_s3_client().upload_fileobj(file_obj, aws_config.bucket, object_name)
+
+
+def upload_file_to_s3(path: str, object_name: str) -> None:
+    """
+    Upload a local file to the configured S3 bucket.
+    :param path: path of the file to upload
+    :param object_name: full key name of the object in the bucket
+    :raise botocore.exceptions.ClientError: if the upload fails
+    """
+    aws_config = get_collector_config().output.aws
+    assert aws_config is not None
+    with SINK_SECONDS.time(sink='s3'):
+        _get_s3_client().upload_file(path, aws_config.bucket, object_name)
+
+
+# Creating a boto3 client is expensive, and clients are thread-safe. So we create one per process.
+_CACHED_S3_CLIENT: Optional[Any] = None
+
+
+def _get_s3_client():
+    global _CACHED_S3_CLIENT
+    aws_config = get_collector_config().output.aws
+    assert aws_config is not None
+    if _CACHED_S3_CLIENT is None:
+        _CACHED_S3_CLIENT = boto3.client(
+            service_name='s3',
+            region_name=aws_config.region,
+            aws_access_key_id=aws_config.access_key_id,
+            aws_secret_access_key=aws_config.secret_access_key)
+    return _CACHED_S3_CLIENT
 
 
 def write_data_to_snowplow_if_configured(events: EventDataList,
                                          good: bool,
-                                         event_errors: List[EventError] = None) -> None:
+                                         event_errors: List[EventError] = None,
+                                         background: bool = False) -> None:
     """
     Write data to Snowplow pipeline if either GCP or AWS for Snowplow if configures
     :param events: EventDataList
     :param prefix: should be either OK or NOK
     :param event_errors: list of errors, if any
+    :param background: True if called from a background thread, see write_data_to_gcp_pubsub()
     :return:
     """
     config: SnowplowConfig = get_collector_config().output.snowplow
 
     if config.aws_enabled:
-        write_data_to_aws_pipeline(events=events, config=config, good=good, event_errors=event_errors)
+        with SINK_SECONDS.time(sink='snowplow_aws'):
+            write_data_to_aws_pipeline(events=events, config=config, good=good, event_errors=event_errors)
 
     if config.gcp_enabled:
-        write_data_to_gcp_pubsub(events=events, config=config, good=good, event_errors=event_errors)
+        with SINK_SECONDS.time(sink='snowplow_gcp'):
+            write_data_to_gcp_pubsub(events=events, config=config, good=good, event_errors=event_errors,
+                                     background=background)
@@ -0,0 +1,53 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import threading
+import time
+
+from flask import Response
+
+from objectiv_backend.common.config import PostgresConfig, get_collector_config
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import CONTENT_TYPE, REGISTRY
+from objectiv_backend.workers.pg_queues import update_queue_metrics
+
+logger = get_logger(__name__)
+
+# Counting the events in the queue tables takes a full scan of each table, so the queue sizes are updated at
+# most once per this many seconds, however often the metrics are scraped.
+_QUEUE_SIZES_MAX_AGE_SECONDS = 15
+
+_QUEUE_SIZES_UPDATED: float = 0
+_QUEUE_SIZES_LOCK = threading.Lock()
+
+
+def metrics() -> Response:
+    """ Endpoint that returns the metrics of this process, in the Prometheus text format. """
+    return Response(get_metrics_text(), status=200, content_type=CONTENT_TYPE)
+
+
+def get_metrics_text() -> str:
+    """ Give the metrics of this process. In async mode this includes the sizes of the queues. """
+    collector_config = get_collector_config()
+    pg_config = collector_config.output.postgres
+    if collector_config.async_mode and pg_config:
+        _update_queue_metrics(pg_config)
+    return REGISTRY.render()
+
+
+def _update_queue_metrics(pg_config: PostgresConfig):
+    """ Update the queue sizes, unless that was done less than _QUEUE_SIZES_MAX_AGE_SECONDS ago. """
+    global _QUEUE_SIZES_UPDATED
+    # Concurrent scrapes don't wait for each other, the ones that don't get the lock use the current values
+    if not _QUEUE_SIZES_LOCK.acquire(blocking=False):
+        return
+    try:
+        if time.monotonic() - _QUEUE_SIZES_UPDATED < _QUEUE_SIZES_MAX_AGE_SECONDS:
+            return
+        # Also if it fails, so that an unavailable database isn't queried on every scrape
+        _QUEUE_SIZES_UPDATED = time.monotonic()
+        update_queue_metrics(pg_config)
+    except Exception as exc:
+        logger.warning(f'Could not get the queue sizes: {exc}')
+    finally:
+        _QUEUE_SIZES_LOCK.release()
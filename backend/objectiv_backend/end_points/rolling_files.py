@@ -0,0 +1,319 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Write the S3 and file system outputs to rolling files, instead of a file per request.
+
+Events are appended to a segment file per prefix (e.g. OK, NOK, RAW) and hour. A segment is completed when it
+reaches segment_max_bytes, when it is segment_max_seconds old, or when its hour is over. Only then it becomes
+visible to readers: for the file system output it is renamed to its final name, for the S3 output it is
+uploaded. Until then it has a name starting with a dot, which batch readers such as Spark and Athena ignore.
+
+Segments are written as NDJSON (a json object per line), or as Parquet with pyarrow.
+
+This is experimental code, and not ready for production use.
+"""
+import atexit
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+from objectiv_backend.common.config import AwsOutputConfig, FileSystemOutputConfig, OutputConfig, \
+    RollingFilesConfig
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import SINK_ERRORS
+from objectiv_backend.common.serialization import loads
+from objectiv_backend.end_points.extra_output import upload_file_to_s3
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # type: ignore
+
+logger = get_logger(__name__)
+
+# Interval at which segments are checked for completion
+_CHECK_INTERVAL_SECONDS = 1
+# Number of events per row group in Parquet segments
+_PARQUET_ROW_GROUP_SIZE = 10_000
+
+
+class _NdjsonFile:
+    """ Segment file with a json object per line. """
+    extension = 'ndjson'
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+
+    def write(self, serialized_events: List[str]) -> int:
+        """ Append the events, return the number of bytes written. """
+        data = ''.join(f'{serialized_event}\n' for serialized_event in serialized_events).encode('utf-8')
+        self._file.write(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetFile:
+    """
+    Segment file in Parquet format, with the columns event_id, event_type, time, and value (the event as json).
+    Events are written in row groups of _PARQUET_ROW_GROUP_SIZE events.
+    """
+    extension = 'parquet'
+
+    def __init__(self, path: str):
+        if pyarrow is None:
+            raise Exception('OUTPUT_FILES_FORMAT = parquet, but pyarrow is not installed')
+        self._schema = pyarrow.schema([
+            ('event_id', pyarrow.string()),
+            ('event_type', pyarrow.string()),
+            ('time', pyarrow.int64()),
+            ('value', pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._rows: List[str] = []
+
+    def write(self, serialized_events: List[str]) -> int:
+        """ Append the events, return the number of bytes of json written. """
+        self._rows.extend(serialized_events)
+        if len(self._rows) >= _PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+        return sum(len(serialized_event) for serialized_event in serialized_events)
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+    def _write_row_group(self):
+        if not self._rows:
+            return
+        events = [loads(serialized_event) for serialized_event in self._rows]
+        table = pyarrow.Table.from_pydict({
+            'event_id': [str(event.get('id')) for event in events],
+            'event_type': [event.get('_type') for event in events],
+            'time': [event.get('time') for event in events],
+            'value': self._rows,
+        }, schema=self._schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+
+class _Segment:
+    """ Segment file that events are appended to, until it is complete. """
+
+    def __init__(self, prefix: str, hour: datetime, filename: str, staging_path: str, file_format: str):
+        self.prefix = prefix
+        self.hour = hour
+        self.filename = filename
+        self.staging_path = staging_path
+        self.file = _ParquetFile(staging_path) if file_format == 'parquet' else _NdjsonFile(staging_path)
+        self.size = 0
+        self.created = time.monotonic()
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self.closed = True
+
+
+class FileSystemTarget:
+    """ Completed segments are moved to {path}/{prefix}/{yyyy}/{mm}/{dd}/{hh}/ """
+
+    def __init__(self, config: FileSystemOutputConfig):
+        self.config = config
+
+    def get_staging_path(self, prefix: str, hour: datetime, filename: str) -> str:
+        # Same directory as the final path, so that the rename is atomic
+        return os.path.join(self._get_directory(prefix, hour), f'.{filename}.tmp')
+
+    def publish(self, staging_path: str, prefix: str, hour: datetime, filename: str):
+        os.rename(staging_path, os.path.join(self._get_directory(prefix, hour), filename))
+
+    def _get_directory(self, prefix: str, hour: datetime) -> str:
+        directory = os.path.join(self.config.path, prefix, hour.strftime('%Y/%m/%d/%H'))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+
+class S3Target:
+    """
+    Segments are written to a local staging directory. Completed segments are uploaded to
+    {s3_prefix}/{yyyy}/{mm}/{dd}/{prefix}/{hh}/ in the bucket.
+    """
+
+    def __init__(self, config: AwsOutputConfig, staging_directory: str):
+        self.config = config
+        self.staging_directory = os.path.join(staging_directory or tempfile.gettempdir(), 'objectiv-s3-segments')
+        os.makedirs(self.staging_directory, exist_ok=True)
+
+    def get_staging_path(self, prefix: str, hour: datetime, filename: str) -> str:
+        return os.path.join(self.staging_directory, f'.{prefix}-{filename}.tmp')
+
+    def publish(self, staging_path: str, prefix: str, hour: datetime, filename: str):
+        object_name = f'{self.config.s3_prefix}/{hour.strftime("%Y/%m/%d")}/{prefix}/{hour.strftime("%H")}/' \
+                      f'{filename}'
+        upload_file_to_s3(path=staging_path, object_name=object_name)
+        os.remove(staging_path)
+
+
+class RollingFileWriter:
+    """
+    Appends events to segment files, and publishes completed segments to a target. Thread-safe.
+
+    Appending only writes to a local file. Completed segments are closed and published by a background
+    thread, so a slow upload doesn't hold up the collector. Segments that fail to publish are retried.
+    """
+
+    def __init__(self, name: str, target: Union[FileSystemTarget, S3Target], config: RollingFilesConfig):
+        """
+        :param name: name of the output, for logging
+        :param target: FileSystemTarget or S3Target
+        :param config: rolling files settings
+        """
+        self.name = name
+        self.target = target
+        self.config = config
+        self._lock = threading.Lock()
+        self._segments: Dict[Tuple[str, datetime], _Segment] = {}
+        self._completed: List[_Segment] = []
+        self._sequence = 0
+        self._wake_up = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'rolling-files-{name}', daemon=True)
+        self._thread.start()
+
+    def append(self, prefix: str, serialized_events: List[str], moment: datetime):
+        """
+        Append events to the segment for prefix and the hour of moment.
+        :param serialized_events: the events serialized with serialize_events()
+        :param moment: timestamp that the events arrived, in UTC
+        """
+        if not serialized_events:
+            return
+        hour = moment.replace(minute=0, second=0, microsecond=0)
+        with self._lock:
+            key = (prefix, hour)
+            segment = self._segments.get(key)
+            if segment is not None and segment.size >= self.config.segment_max_bytes:
+                self._complete(key)
+                segment = None
+            if segment is None:
+                segment = self._new_segment(prefix, hour)
+                self._segments[key] = segment
+            segment.size += segment.file.write(serialized_events)
+
+    def rotate(self, force: bool = False):
+        """
+        Complete the segments that are too big, too old, or of a past hour, and publish all completed
+        segments.
+        :param force: complete all segments
+        """
+        current_hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        now = time.monotonic()
+        with self._lock:
+            for key, segment in list(self._segments.items()):
+                if force \
+                        or segment.size >= self.config.segment_max_bytes \
+                        or now - segment.created >= self.config.segment_max_seconds \
+                        or segment.hour < current_hour:
+                    self._complete(key)
+            completed = self._completed
+            self._completed = []
+        failed = [segment for segment in completed if not self._publish(segment)]
+        if failed:
+            with self._lock:
+                self._completed.extend(failed)
+
+    def close(self):
+        """ Complete and publish all segments. """
+        self.rotate(force=True)
+
+    def _new_segment(self, prefix: str, hour: datetime) -> _Segment:
+        self._sequence += 1
+        # Unique over hosts and processes, and sorted by creation time
+        filename = f'{datetime.utcnow().strftime("%Y%m%dT%H%M%S")}-{socket.gethostname()}-{os.getpid()}-' \
+                   f'{self._sequence:06d}.{_get_extension(self.config.format)}'
+        staging_path = self.target.get_staging_path(prefix, hour, filename)
+        return _Segment(prefix=prefix, hour=hour, filename=filename, staging_path=staging_path,
+                        file_format=self.config.format)
+
+    def _complete(self, key: Tuple[str, datetime]):
+        self._completed.append(self._segments.pop(key))
+        self._wake_up.set()
+
+    def _publish(self, segment: _Segment) -> bool:
+        """ Close and publish the segment. Returns False if that failed. """
+        try:
+            segment.close()
+            self.target.publish(segment.staging_path, segment.prefix, segment.hour, segment.filename)
+            return True
+        except Exception as exc:
+            logger.warning(f'Error publishing {segment.filename} to {self.name}, will retry: {exc}')
+            SINK_ERRORS.inc(sink=self.name)
+            return False
+
+    def _run(self):
+        while True:
+            self._wake_up.wait(timeout=_CHECK_INTERVAL_SECONDS)
+            self._wake_up.clear()
+            self.rotate()
+
+
+def _get_extension(file_format: str) -> str:
+    return _ParquetFile.extension if file_format == 'parquet' else _NdjsonFile.extension
+
+
+class RollingFiles:
+    """ A RollingFileWriter for each of the configured S3 and file system outputs. """
+
+    def __init__(self, output_config: OutputConfig):
+        config = output_config.rolling_files
+        assert config is not None
+        self.writers: List[RollingFileWriter] = []
+        if output_config.file_system:
+            fs_target = FileSystemTarget(output_config.file_system)
+            self.writers.append(RollingFileWriter('file_system', fs_target, config))
+        if output_config.aws:
+            s3_target = S3Target(output_config.aws, staging_directory=config.staging_directory)
+            self.writers.append(RollingFileWriter('s3', s3_target, config))
+
+    def append(self, prefix: str, serialized_events: List[str]):
+        """
+        Append events to the outputs, under the given prefix.
+        :param serialized_events: the events serialized with serialize_events()
+        """
+        moment = datetime.utcnow()
+        for writer in self.writers:
+            writer.append(prefix=prefix, serialized_events=serialized_events, moment=moment)
+
+    def close(self):
+        """ Complete and publish all segments. """
+        for writer in self.writers:
+            writer.close()
+
+
+# The threads and open files don't survive a fork, so we keep one instance per process.
+_ROLLING_FILES: Optional[RollingFiles] = None
+_ROLLING_FILES_PID: Optional[int] = None
+_ROLLING_FILES_LOCK = threading.Lock()
+
+
+def get_rolling_files(output_config: OutputConfig) -> Optional[RollingFiles]:
+    """
+    Get the RollingFiles of the current process, creating it if needed. Returns None if rolling files are
+    not configured.
+    """
+    if not output_config.rolling_files:
+        return None
+    global _ROLLING_FILES, _ROLLING_FILES_PID
+    with _ROLLING_FILES_LOCK:
+        if _ROLLING_FILES is None or _ROLLING_FILES_PID != os.getpid():
+            _ROLLING_FILES = RollingFiles(output_config)
+            _ROLLING_FILES_PID = os.getpid()
+            atexit.register(_ROLLING_FILES.close)
+        return _ROLLING_FILES
@@ -12,13 +12,25 @@ from objectiv_backend.schema.generate_json_schema import generate_json_schema
 
 def schema() -> Response:
     """ Endpoint that returns the event schema in our own notation. """
-    event_schema = get_collector_config().event_schema
-    msg = str(event_schema)
-    return get_json_response(status=200, msg=msg)
+    return get_json_response(status=200, msg=get_schema_msg())
 
 
 def json_schema() -> Response:
     """ Endpoint that returns a jsonschema that describes the event schema. """
+    return get_json_response(status=200, msg=get_json_schema_msg())
+
+
+def get_schema_msg() -> str:
+    """ Give the event schema in our own notation, and the version of the active schema, as json string. """
+    collector_config = get_collector_config()
+    schema_obj = {
+        'schema_version': collector_config.event_schema_version,
+        **json.loads(str(collector_config.event_schema))
+    }
+    return json.dumps(schema_obj, indent=4)
+
+
+def get_json_schema_msg() -> str:
+    """ Give a jsonschema that describes the event schema, as json string. """
     event_schema = get_collector_config().event_schema
-    msg = json.dumps(generate_json_schema(event_schema), indent=4)
-    return get_json_response(status=200, msg=msg)
+    return json.dumps(generate_json_schema(event_schema), indent=4)
@@ -0,0 +1,210 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Write events to the S3, file system, and Snowplow outputs in the background.
+
+Each configured output gets its own queue and thread, so a slow output doesn't hold up the others, nor the
+collector's responses. The threads write events in batches, and retry failed batches.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from objectiv_backend.common.config import AsyncSinksConfig, OutputConfig
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import QUEUE_EVENTS, REGISTRY, SINK_DROPPED_EVENTS, SINK_ERRORS
+from objectiv_backend.common.serialization import join_serialized_events
+from objectiv_backend.common.types import EventData, EventDataList
+from objectiv_backend.end_points.extra_output import write_data_to_fs_if_configured, \
+    upload_data_to_s3_if_configured, write_data_to_snowplow_if_configured
+from objectiv_backend.schema.validate_events import EventError
+
+logger = get_logger(__name__)
+
+# Maximum time to wait between retries of a batch
+_MAX_RETRY_SLEEP_SECONDS = 5
+
+
+class BatchingSink:
+    """
+    Bounded queue of items, with a background thread that writes the items in batches.
+
+    A batch is written when it has batch_max_events items, or when batch_max_seconds have passed since
+    the first item in it was taken from the queue. If writing fails, it is retried up to max_retries
+    times, after which the batch is dropped.
+    """
+
+    def __init__(self, name: str, write_batch: Callable[[List[Any]], None], config: AsyncSinksConfig):
+        self.name = name
+        self.write_batch = write_batch
+        self.config = config
+        self._queue: queue.Queue = queue.Queue(maxsize=config.queue_max_events)
+        self._thread = threading.Thread(target=self._run, name=f'sink-{name}', daemon=True)
+        self._thread.start()
+
+    def submit(self, items: List[Any]) -> int:
+        """
+        Add items to the queue. If the queue is full, waits up to queue_timeout_seconds for room. Items that
+        don't fit after that are dropped.
+        :return: number of dropped items
+        """
+        deadline = time.monotonic() + self.config.queue_timeout_seconds
+        for index, item in enumerate(items):
+            try:
+                self._queue.put(item, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                dropped = len(items) - index
+                logger.warning(f'Output {self.name} cannot keep up, dropped {dropped} events')
+                SINK_DROPPED_EVENTS.inc(dropped, sink=self.name)
+                return dropped
+        return 0
+
+    def close(self, timeout: float):
+        """ Write the remaining items, waiting at most timeout seconds. """
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout=timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.config.batch_max_seconds
+            stop = False
+            while len(batch) < self.config.batch_max_events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write_with_retries(batch)
+            if stop:
+                return
+
+    def _write_with_retries(self, batch: List[Any]):
+        for attempt in range(self.config.max_retries + 1):
+            try:
+                self.write_batch(batch)
+                return
+            except Exception as exc:
+                logger.warning(f'Error writing {len(batch)} events to {self.name} (attempt {attempt + 1}): {exc}')
+                SINK_ERRORS.inc(sink=self.name)
+            if attempt < self.config.max_retries:
+                time.sleep(min(_MAX_RETRY_SLEEP_SECONDS, 0.1 * 2 ** attempt))
+        logger.error(f'Giving up on writing {len(batch)} events to {self.name}')
+        SINK_DROPPED_EVENTS.inc(len(batch), sink=self.name)
+
+    def get_queue_size(self) -> int:
+        """ Give the number of items waiting in the queue. """
+        return self._queue.qsize()
+
+
+# Marker to stop the thread of a BatchingSink
+_STOP = object()
+
+
+class SinkDispatcher:
+    """ Hands off events to a BatchingSink per configured output. """
+
+    def __init__(self, output_config: OutputConfig):
+        assert output_config.async_sinks is not None
+        config = output_config.async_sinks
+        self.sinks: Dict[str, BatchingSink] = {}
+        # With rolling files, the S3 and file system outputs are written by RollingFiles instead
+        if output_config.file_system and not output_config.rolling_files:
+            self.sinks['file_system'] = BatchingSink('file_system', _write_files_to_fs, config)
+        if output_config.aws and not output_config.rolling_files:
+            self.sinks['s3'] = BatchingSink('s3', _write_files_to_s3, config)
+        if output_config.snowplow.aws_enabled or output_config.snowplow.gcp_enabled:
+            self.sinks['snowplow'] = BatchingSink('snowplow', _write_snowplow, config)
+        REGISTRY.set_collect_hook('sink_dispatcher', self._update_queue_metrics)
+
+    def submit_files(self, prefix: str, serialized_events: List[str]):
+        """
+        Queue events for the S3 and file system outputs, under the given prefix.
+        :param serialized_events: the events serialized with serialize_events()
+        """
+        items = [(prefix, serialized_event) for serialized_event in serialized_events]
+        for name in ('file_system', 's3'):
+            if name in self.sinks:
+                self.sinks[name].submit(items)
+
+    def submit_snowplow(self, events: EventDataList, good: bool,
+                        event_errors: Optional[List[EventError]] = None):
+        """ Queue events for the Snowplow output. """
+        if 'snowplow' not in self.sinks:
+            return
+        errors_by_id = {str(event_error.event_id): event_error for event_error in event_errors or []}
+        items = [(good, event, errors_by_id.get(str(event['id']))) for event in events]
+        self.sinks['snowplow'].submit(items)
+
+    def _update_queue_metrics(self):
+        for name, sink in self.sinks.items():
+            QUEUE_EVENTS.set(sink.get_queue_size(), queue=f'sink_{name}')
+
+    def close(self, timeout: float = 5):
+        """ Write all queued events, waiting at most timeout seconds per output. """
+        for sink in self.sinks.values():
+            sink.close(timeout=timeout)
+
+
+def _group_files(batch: List[Tuple[str, str]]) -> Dict[str, str]:
+    """ Give the data to write per prefix: the serialized events of that prefix, as a json array. """
+    events_per_prefix: Dict[str, List[str]] = defaultdict(list)
+    for prefix, serialized_event in batch:
+        events_per_prefix[prefix].append(serialized_event)
+    return {prefix: join_serialized_events(events) for prefix, events in events_per_prefix.items()}
+
+
+def _write_files_to_fs(batch: List[Tuple[str, str]]):
+    moment = datetime.utcnow()
+    for prefix, data in _group_files(batch).items():
+        write_data_to_fs_if_configured(data=data, prefix=prefix, moment=moment)
+
+
+def _write_files_to_s3(batch: List[Tuple[str, str]]):
+    moment = datetime.utcnow()
+    for prefix, data in _group_files(batch).items():
+        upload_data_to_s3_if_configured(data=data, prefix=prefix, moment=moment)
+
+
+def _write_snowplow(batch: List[Tuple[bool, EventData, Optional[EventError]]]):
+    for good in (True, False):
+        events = [event for is_good, event, _ in batch if is_good == good]
+        event_errors = [event_error for is_good, _, event_error in batch
+                        if is_good == good and event_error is not None]
+        if events:
+            write_data_to_snowplow_if_configured(events=events, good=good, event_errors=event_errors,
+                                                 background=True)
+
+
+# The threads of a dispatcher don't survive a fork, so we keep one dispatcher per process.
+_DISPATCHER: Optional[SinkDispatcher] = None
+_DISPATCHER_PID: Optional[int] = None
+_DISPATCHER_LOCK = threading.Lock()
+
+
+def get_sink_dispatcher(output_config: OutputConfig) -> SinkDispatcher:
+    """ Get the SinkDispatcher of the current process, creating it if needed. """
+    global _DISPATCHER, _DISPATCHER_PID
+    with _DISPATCHER_LOCK:
+        if _DISPATCHER is None or _DISPATCHER_PID != os.getpid():
+            _DISPATCHER = SinkDispatcher(output_config)
+            _DISPATCHER_PID = os.getpid()
+            atexit.register(_DISPATCHER.close)
+        return _DISPATCHER
@@ -0,0 +1,311 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Local spool for events that the collector cannot write to Postgres, because the database is unavailable or
+too slow. The spooled events are replayed into Postgres once the database is available again.
+
+The spool is a directory with segment files. Each line in a segment is a record: the kind of record, a tab,
+and a json array with events. The kind determines where the events are replayed to: the entry queue
+(async mode), or the data or nok_data table (sync mode).
+
+A segment is only appended to by the process that created it, which holds an exclusive lock on the file
+until the segment is complete. Replay only picks segments that are not locked, so it never reads a segment
+that is still being written, and segments of a process that died are replayed too. Replay keeps track of
+its progress per segment in an offset file, so a replay that is interrupted doesn't write events twice.
+"""
+import argparse
+import fcntl
+import glob
+import os
+import sys
+import threading
+import time
+from typing import Dict, IO, List, Optional, Tuple
+
+import psycopg2
+
+from objectiv_backend.common.config import PostgresConfig, SpoolConfig, get_collector_config
+from objectiv_backend.common.db import PoolTimeout, get_pooled_db_connection
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import SINK_SECONDS
+from objectiv_backend.common.serialization import join_serialized_events, loads
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+from objectiv_backend.workers.pg_storage import insert_events_into_data, insert_events_into_nok_data
+
+logger = get_logger(__name__)
+
+# Kinds of records
+KIND_ENTRY = 'entry'  # events for the entry queue
+KIND_OK = 'ok'  # events for the data table
+KIND_NOK = 'nok'  # events for the nok_data table
+_KINDS = (KIND_ENTRY, KIND_OK, KIND_NOK)
+
+# Errors that mean that the database is unavailable or too slow, rather than that there is a problem with
+# the events. Only in case of these errors events are spooled.
+SPOOL_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+_SEGMENT_SUFFIX = '.spool'
+_NEW_SEGMENT_SUFFIX = '.new'
+_OFFSET_SUFFIX = '.offset'
+
+# Maximum number of events that are replayed in one transaction
+_REPLAY_BATCH_MAX_EVENTS = 5000
+
+
+class SpoolFull(Exception):
+    """ The spool has reached its maximum size. """
+
+
+class Spool:
+    """ Appends records to the segments of a spool directory. Thread-safe. """
+
+    def __init__(self, config: SpoolConfig):
+        self.config = config
+        os.makedirs(config.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file: Optional[IO[bytes]] = None
+        self._file_size = 0
+        self._sequence = 0
+        self._last_append = 0.0
+        self._total_size = get_spool_size(config.directory)
+
+    def append(self, records: List[Tuple[str, List[str]]]):
+        """
+        Append records to the spool, in a single write.
+        :param records: list of (kind, serialized_events) tuples, with serialized_events the events
+            serialized with serialize_events()
+        :raise SpoolFull: if the spool would exceed its maximum size
+        """
+        data = b''.join(f'{kind}\t{join_serialized_events(serialized_events)}\n'.encode('utf-8')
+                        for kind, serialized_events in records if serialized_events)
+        if not data:
+            return
+        with SINK_SECONDS.time(sink='spool'), self._lock:
+            if self._total_size + len(data) > self.config.max_bytes:
+                # Segments might have been replayed in the meantime
+                self._total_size = get_spool_size(self.config.directory)
+                if self._total_size + len(data) > self.config.max_bytes:
+                    raise SpoolFull(f'Spool has reached its maximum size of {self.config.max_bytes} bytes')
+            if self._file is not None and self._file_size + len(data) > self.config.segment_max_bytes:
+                self._close_segment()
+            if self._file is None:
+                self._open_segment()
+                assert self._file is not None  # help out mypy
+            self._file.write(data)
+            self._file.flush()
+            if self.config.fsync == 'always':
+                os.fsync(self._file.fileno())
+            self._file_size += len(data)
+            self._total_size += len(data)
+            self._last_append = time.monotonic()
+
+    def rotate(self, min_idle_seconds: float = 0):
+        """
+        Complete the current segment, so that it can be replayed.
+        :param min_idle_seconds: only complete the segment if nothing was appended for this long
+        """
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._last_append >= min_idle_seconds:
+                self._close_segment()
+
+    def _open_segment(self):
+        self._sequence += 1
+        name = f'{time.time_ns():020d}-{os.getpid()}-{self._sequence:06d}'
+        new_path = os.path.join(self.config.directory, name + _NEW_SEGMENT_SUFFIX)
+        file = open(new_path, 'ab')
+        # Lock the file before giving it the name that replay looks for, and keep the lock until the segment
+        # is complete.
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        os.rename(new_path, os.path.join(self.config.directory, name + _SEGMENT_SUFFIX))
+        self._file = file
+        self._file_size = 0
+
+    def _close_segment(self):
+        assert self._file is not None
+        if self.config.fsync in ('always', 'rotate'):
+            os.fsync(self._file.fileno())
+        # Closing the file releases the lock
+        self._file.close()
+        self._file = None
+        self._file_size = 0
+
+
+def get_spool_size(directory: str) -> int:
+    """ Give the total size of the segments in a spool directory. """
+    size = 0
+    for path in glob.glob(os.path.join(directory, f'*{_SEGMENT_SUFFIX}')):
+        try:
+            size += os.path.getsize(path)
+        except FileNotFoundError:
+            # replayed in the meantime
+            pass
+    return size
+
+
+def replay_spool(directory: str, pg_config: PostgresConfig) -> int:
+    """
+    Write the events in all complete segments of a spool directory to Postgres, and remove the segments.
+    Segments that are being written or replayed by another process are skipped.
+    :return: number of replayed events
+    :raise Exception: if the events cannot be written. Replay can be retried later.
+    """
+    event_count = 0
+    for path in sorted(glob.glob(os.path.join(directory, f'*{_SEGMENT_SUFFIX}'))):
+        event_count += _replay_segment(path, pg_config)
+    return event_count
+
+
+def _replay_segment(path: str, pg_config: PostgresConfig) -> int:
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with file:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Still being written, or being replayed by another process
+            return 0
+        if os.fstat(file.fileno()).st_nlink == 0:
+            # Another process replayed and removed the segment, before we got the lock
+            return 0
+        offset_path = path + _OFFSET_SUFFIX
+        file.seek(_read_offset(offset_path))
+        event_count = 0
+        while True:
+            records = _read_records(file, max_events=_REPLAY_BATCH_MAX_EVENTS)
+            if not records:
+                break
+            _write_records(records, pg_config)
+            _write_offset(offset_path, file.tell())
+            event_count += sum(len(events) for _, events in records)
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+    logger.info(f'Replayed {event_count} events from spool segment {path}')
+    return event_count
+
+
+def _read_records(file: IO[bytes], max_events: int) -> List[Tuple[str, EventDataList]]:
+    """ Read records from the current position, until at least max_events events are read, or the end. """
+    records: List[Tuple[str, EventDataList]] = []
+    event_count = 0
+    while event_count < max_events:
+        line = file.readline()
+        if not line:
+            break
+        if not line.endswith(b'\n'):
+            # The process that wrote the segment died while writing this line
+            logger.warning(f'Skipping incomplete record at the end of spool segment {file.name}')
+            break
+        try:
+            kind, data = line.decode('utf-8').split('\t', 1)
+            events = loads(data)
+            if kind not in _KINDS or not isinstance(events, list):
+                raise ValueError(f'Invalid record of kind {kind}')
+        except ValueError as exc:
+            logger.warning(f'Skipping invalid record in spool segment {file.name}: {exc}')
+            continue
+        records.append((kind, events))
+        event_count += len(events)
+    return records
+
+
+def _write_records(records: List[Tuple[str, EventDataList]], pg_config: PostgresConfig):
+    """ Write the events of the records to Postgres, in one transaction. """
+    events_per_kind: Dict[str, EventDataList] = {kind: [] for kind in _KINDS}
+    for kind, events in records:
+        events_per_kind[kind].extend(events)
+    copy_threshold = pg_config.copy_threshold
+    with get_pooled_db_connection(pg_config) as connection:
+        with connection:
+            pg_queues = PostgresQueues(connection=connection, copy_threshold=copy_threshold)
+            pg_queues.put_events(queue=ProcessingStage.ENTRY, events=events_per_kind[KIND_ENTRY])
+            insert_events_into_data(connection, events=events_per_kind[KIND_OK], copy_threshold=copy_threshold)
+            insert_events_into_nok_data(connection, events=events_per_kind[KIND_NOK],
+                                        copy_threshold=copy_threshold)
+
+
+def _read_offset(offset_path: str) -> int:
+    try:
+        with open(offset_path) as file:
+            return int(file.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_offset(offset_path: str, offset: int):
+    # Write and rename, so that the offset file is never incomplete
+    new_path = offset_path + _NEW_SEGMENT_SUFFIX
+    with open(new_path, 'w') as file:
+        file.write(str(offset))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(new_path, offset_path)
+
+
+class SpoolReplayer:
+    """
+    Background thread that regularly replays the spool. It also completes the segment of the given spool if
+    it is idle, so that segments don't stay unreplayed once the collector stops spooling.
+    """
+
+    def __init__(self, spool: Spool, pg_config: PostgresConfig):
+        self.spool = spool
+        self.pg_config = pg_config
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        interval = self.spool.config.replay_interval_seconds
+        while True:
+            time.sleep(interval)
+            self.spool.rotate(min_idle_seconds=interval)
+            try:
+                replay_spool(self.spool.config.directory, self.pg_config)
+            except Exception as exc:
+                logger.warning(f'Could not replay spool, will retry in {interval} seconds: {exc}')
+
+
+# The file locks and threads don't survive a fork, so we keep one spool per process.
+_SPOOL: Optional[Spool] = None
+_SPOOL_PID: Optional[int] = None
+_SPOOL_LOCK = threading.Lock()
+
+
+def get_spool(spool_config: SpoolConfig, pg_config: PostgresConfig) -> Spool:
+    """ Get the Spool of the current process, creating it and its SpoolReplayer if needed. """
+    global _SPOOL, _SPOOL_PID
+    with _SPOOL_LOCK:
+        if _SPOOL is None or _SPOOL_PID != os.getpid():
+            _SPOOL = Spool(spool_config)
+            _SPOOL_PID = os.getpid()
+            SpoolReplayer(_SPOOL, pg_config)
+        return _SPOOL
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay the events in the spool directory into Postgres')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep running, and replay every SPOOL_REPLAY_INTERVAL_SECONDS')
+    args = parser.parse_args(sys.argv[1:])
+    output_config = get_collector_config().output
+    if not output_config.spool or not output_config.postgres:
+        logger.error('SPOOL_DIRECTORY and Postgres output must be configured')
+        return 1
+    while True:
+        try:
+            event_count = replay_spool(output_config.spool.directory, output_config.postgres)
+            logger.info(f'Replayed {event_count} events')
+        except SPOOL_ERRORS as exc:
+            if not args.loop:
+                raise
+            logger.warning(f'Could not replay spool: {exc}')
+        if not args.loop:
+            return 0
+        time.sleep(output_config.spool.replay_interval_seconds)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Combine the Postgres writes of concurrent collector requests in sync mode.
+
+Without this, every request writes its events in its own transaction, which for trackers that send one or
+two events per request means a transaction per event. The WriteCoalescer gathers the events of the requests
+that arrive within coalesce_millis, and writes them in a single transaction. Each request still waits until
+its events are committed, and gets its own result.
+
+This only helps if a process handles requests concurrently, e.g. with threaded gunicorn workers, or with
+the ASGI app (see asgi.py).
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.db import get_pooled_db_connection, set_local_statement_timeout
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.serialization import get_serialized_events
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.end_points.spool import SPOOL_ERRORS
+from objectiv_backend.workers.pg_storage import insert_events_into_data, insert_events_into_nok_data
+from objectiv_backend.workers.recent_event_ids import get_recent_event_ids
+
+logger = get_logger(__name__)
+
+
+class WriteTimeout(psycopg2.OperationalError):
+    """
+    The events of a request were not written in time. Like a statement timeout, this means that the database
+    is too slow, so it's one of the SPOOL_ERRORS.
+    """
+
+
+class _Submission:
+    """ The events of one request, and the Future that gets the result of writing them. """
+
+    def __init__(self,
+                 ok_events: EventDataList,
+                 nok_events: EventDataList,
+                 serialized_ok_events: List[str],
+                 serialized_nok_events: List[str]):
+        self.ok_events = ok_events
+        self.nok_events = nok_events
+        self.serialized_ok_events = serialized_ok_events
+        self.serialized_nok_events = serialized_nok_events
+        self.future: Future = Future()
+
+    def __len__(self) -> int:
+        return len(self.ok_events) + len(self.nok_events)
+
+
+class WriteCoalescer:
+    """
+    Writes the events of concurrent requests to the data and nok_data tables in one transaction.
+
+    Batches are written by a single background thread. A batch is written when it has coalesce_max_events
+    events, or when coalesce_millis have passed since its first request arrived. Requests that arrive while
+    a batch is being written go into the next batch, so under high load batches grow by themselves.
+    """
+
+    def __init__(self, pg_config: PostgresConfig, statement_timeout_seconds: float = 0):
+        """
+        :param pg_config: database to write to
+        :param statement_timeout_seconds: if set, statements that take longer than this are cancelled
+        """
+        self.pg_config = pg_config
+        self.statement_timeout_seconds = statement_timeout_seconds
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='pg-write-coalescer', daemon=True)
+        self._thread.start()
+
+    def write(self,
+              ok_events: EventDataList,
+              nok_events: EventDataList,
+              serialized_ok_events: Optional[List[str]] = None,
+              serialized_nok_events: Optional[List[str]] = None) -> EventDataList:
+        """
+        Write events to the data table, and events to the nok_data table, together with the events of other
+        requests. Blocks until the events are committed.
+
+        :param ok_events: events to write to the data table
+        :param nok_events: events to write to the nok_data table
+        :param serialized_ok_events: optional, ok_events serialized with serialize_events()
+        :param serialized_nok_events: optional, nok_events serialized with serialize_events()
+        :return: the events of ok_events that were duplicates, see insert_events_into_data()
+        :raise WriteTimeout: if statement_timeout_seconds is set, and the events were not written in time. If
+            the events were already being written, they might still be committed afterwards.
+        :raise Exception: if the events could not be written
+        """
+        if not ok_events and not nok_events:
+            return []
+        submission = _Submission(
+            ok_events=ok_events,
+            nok_events=nok_events,
+            serialized_ok_events=get_serialized_events(ok_events, serialized_ok_events),
+            serialized_nok_events=get_serialized_events(nok_events, serialized_nok_events)
+        )
+        self._queue.put(submission)
+        timeout = self._get_result_timeout_seconds()
+        try:
+            return submission.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # If the submission is still waiting in the queue, make sure that it's never written
+            submission.future.cancel()
+            raise WriteTimeout(f'Events were not written within {timeout:.3} seconds')
+
+    def _get_result_timeout_seconds(self) -> Optional[float]:
+        """
+        How long a request waits for its events to be written. That's at most the coalescing time, plus the
+        time to write the batch that is in progress when the request arrives, plus the time to write the
+        request's own batch. Without a statement timeout the writes have no time limit, and neither does this.
+        """
+        if not self.statement_timeout_seconds:
+            return None
+        return self.pg_config.coalesce_millis / 1000 + 2 * self.statement_timeout_seconds
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            event_count = len(batch[0])
+            deadline = time.monotonic() + self.pg_config.coalesce_millis / 1000
+            while event_count < self.pg_config.coalesce_max_events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    submission = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(submission)
+                event_count += len(submission)
+            # Skip the submissions of requests that gave up waiting, see write()
+            batch = [submission for submission in batch if submission.future.set_running_or_notify_cancel()]
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: List[_Submission]):
+        """
+        Write the batch, and set the result of each submission.
+
+        If the database is unavailable or too slow (SPOOL_ERRORS), all submissions fail right away: writing
+        them separately would fail the same way, and take that much longer.
+        """
+        try:
+            duplicate_events = self._write(batch)
+        except Exception as exc:
+            if len(batch) == 1 or isinstance(exc, SPOOL_ERRORS):
+                for submission in batch:
+                    submission.future.set_exception(exc)
+                return
+            # Don't fail all requests because of one. Retry each request in its own transaction, so that
+            # each gets its own result.
+            logger.warning(f'Error writing {len(batch)} coalesced requests, writing them separately: {exc}')
+            for submission in batch:
+                self._write_batch([submission])
+            return
+        duplicate_ids = {id(event) for event in duplicate_events}
+        for submission in batch:
+            submission.future.set_result([event for event in submission.ok_events if id(event) in duplicate_ids])
+
+    def _write(self, batch: List[_Submission]) -> EventDataList:
+        """ Write the events of all submissions in one transaction. Returns the duplicate events. """
+        ok_events: EventDataList = []
+        nok_events: EventDataList = []
+        serialized_ok_events: List[str] = []
+        serialized_nok_events: List[str] = []
+        for submission in batch:
+            ok_events.extend(submission.ok_events)
+            nok_events.extend(submission.nok_events)
+            serialized_ok_events.extend(submission.serialized_ok_events)
+            serialized_nok_events.extend(submission.serialized_nok_events)
+        copy_threshold = self.pg_config.copy_threshold
+        recent_event_ids = get_recent_event_ids(self.pg_config)
+        with get_pooled_db_connection(self.pg_config) as connection:
+            with connection:
+                if self.statement_timeout_seconds:
+                    set_local_statement_timeout(connection, self.statement_timeout_seconds)
+                duplicate_events = insert_events_into_data(connection, events=ok_events,
+                                                           copy_threshold=copy_threshold,
+                                                           serialized_events=serialized_ok_events,
+                                                           recent_event_ids=recent_event_ids)
+                insert_events_into_nok_data(connection, events=nok_events, copy_threshold=copy_threshold,
+                                            serialized_events=serialized_nok_events)
+        if recent_event_ids is not None:
+            # Now that the transaction is committed, all ok_events are in the data table
+            recent_event_ids.add(str(event['id']) for event in ok_events)
+        return duplicate_events
+
+
+# The thread of a coalescer doesn't survive a fork, so we keep the coalescers per process.
+_COALESCERS: Dict[Tuple[PostgresConfig, float], WriteCoalescer] = {}
+_COALESCERS_PID: Optional[int] = None
+_COALESCERS_LOCK = threading.Lock()
+
+
+def get_write_coalescer(pg_config: PostgresConfig, statement_timeout_seconds: float = 0) -> WriteCoalescer:
+    """ Get the WriteCoalescer of the current process for the given configuration, creating it if needed. """
+    global _COALESCERS_PID
+    key = (pg_config, statement_timeout_seconds)
+    with _COALESCERS_LOCK:
+        if _COALESCERS_PID != os.getpid():
+            _COALESCERS.clear()
+            _COALESCERS_PID = os.getpid()
+        if key not in _COALESCERS:
+            _COALESCERS[key] = WriteCoalescer(pg_config, statement_timeout_seconds=statement_timeout_seconds)
+        return _COALESCERS[key]
@@ -10,9 +10,13 @@ from copy import deepcopy
 from typing import Set, List, Dict, Any, Optional, Tuple
 import pkgutil
 
+import jsonschema
+
 from objectiv_backend.common.types import EventType, ContextType, EventListSchema
 
 MAX_HIERARCHY_DEPTH = 100
+# Files in the schema extension directory that are loaded
+SCHEMA_EXTENSION_FILENAME_REGEX = r'[a-z0-9_]+\.json'
 
 
 class EventSubSchema:
@@ -32,6 +36,8 @@ class EventSubSchema:
         self._compiled_list_event_types: List[EventType] = []
         self._compiled_all_parents_and_required_contexts: \
             Dict[EventType, Tuple[Set[EventType], Set[ContextType]]] = {}
+        self._compiled_sorted_parent_event_types: Dict[EventType, Tuple[EventType, ...]] = {}
+        self._compiled_event_schemas: Dict[EventType, Dict[str, Any]] = {}
 
     def get_extended_schema(self, event_schema: Dict[str, Any]) -> 'EventSubSchema':
         """
@@ -63,8 +69,8 @@ class EventSubSchema:
 
     def _compile(self):
         """
-        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(), and
-        get_all_required_contexts.
+        1) Pre calculate the return values of list_event_types(), get_all_parent_event_types(),
+        get_sorted_parent_event_types(), get_all_required_contexts(), and get_event_schema().
         2) Makes sure the event hierarchy has no cycles
         Must be called after the schema has changed.
         """
@@ -73,6 +79,14 @@ class EventSubSchema:
         self._compiled_all_parents_and_required_contexts = {}
         for event_type in self._compiled_list_event_types:
             self._compile_parents_and_contexts(event_type)
+        self._compiled_sorted_parent_event_types = {
+            event_type: tuple(sorted(self._compiled_all_parents_and_required_contexts[event_type][0]))
+            for event_type in self._compiled_list_event_types
+        }
+        self._compiled_event_schemas = {
+            event_type: self._compile_event_schema(event_type)
+            for event_type in self._compiled_list_event_types
+        }
 
     def _compile_parents_and_contexts(
             self,
@@ -127,6 +141,15 @@ class EventSubSchema:
             raise ValueError(f'Not a valid event_type {event_type}')
         return self._compiled_all_parents_and_required_contexts[event_type][0]
 
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        """
+        Same as get_all_parent_event_types(), but as an alphabetically sorted tuple.
+        :param event_type: event type. Must be a valid event_type
+        """
+        if not self.is_valid_event_type(event_type):
+            raise ValueError(f'Not a valid event_type {event_type}')
+        return self._compiled_sorted_parent_event_types[event_type]
+
     def get_all_required_contexts(self, event_type: EventType) -> Set[ContextType]:
         """
         Get all contexts that are required by the given event. This includes context types that are
@@ -144,9 +167,12 @@ class EventSubSchema:
     def get_event_schema(self, event_type: EventType) -> Optional[Dict[str, Any]]:
         """
         Give the json-schema for a specific event_type, or None if the event type doesn't exist.
+        The returned schema is shared, callers should not modify it.
         """
-        if event_type not in self.schema:
-            return None
+        return self._compiled_event_schemas.get(event_type)
+
+    def _compile_event_schema(self, event_type: EventType) -> Dict[str, Any]:
+        """ Build the json-schema for the given event_type. event_type must be a valid event type. """
         all_classes = self.get_all_parent_event_types(event_type)
         properties = {}
         for klass in all_classes:
@@ -182,6 +208,8 @@ class ContextSubSchema:
         self._compiled_list_context_types = []
         self._compiled_all_parent_context_types = {}
         self._compiled_all_child_context_types = {}
+        self._compiled_sorted_parent_context_types: Dict[ContextType, Tuple[ContextType, ...]] = {}
+        self._compiled_context_schemas: Dict[ContextType, Dict[str, Any]] = {}
 
     CONTEXT_NAME_REGEX = r'^[A-Z][a-zA-Z0-9]*Context$'
 
@@ -225,7 +253,7 @@ class ContextSubSchema:
     def _compile(self):
         """
         1) Pre calculate the return values of list_context_types(), get_all_parent_context_types(),
-            and get_all_child_context_types().
+            get_sorted_parent_context_types(), get_all_child_context_types(), and get_context_schema().
         2) Makes sure the event hierarchy has no cycles, and all parent-reference exist.
         Must be called after the schema has changed.
         """
@@ -244,6 +272,15 @@ class ContextSubSchema:
                     children.add(ct)
             self._compiled_all_child_context_types[context_type] = children
 
+        self._compiled_sorted_parent_context_types = {
+            context_type: tuple(sorted(self._compiled_all_parent_context_types[context_type]))
+            for context_type in self._compiled_list_context_types
+        }
+        self._compiled_context_schemas = {
+            context_type: self._compile_context_schema(context_type)
+            for context_type in self._compiled_list_context_types
+        }
+
     def _compile_parent_context_types(self,
                                       context_type: ContextType,
                                       count=MAX_HIERARCHY_DEPTH) -> Set[ContextType]:
@@ -280,6 +317,12 @@ class ContextSubSchema:
         """
         return self._compiled_all_parent_context_types.get(context_type, {context_type})
 
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        """
+        Same as get_all_parent_context_types(), but as an alphabetically sorted tuple.
+        """
+        return self._compiled_sorted_parent_context_types.get(context_type, (context_type,))
+
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         """
         Given a context_type, give a set with that context_type and all its child context_types
@@ -289,9 +332,12 @@ class ContextSubSchema:
     def get_context_schema(self, context_type: ContextType) -> Optional[Dict[str, Any]]:
         """
         Give the json-schema for a specific context_type, or None if the context type doesn't exist.
+        The returned schema is shared, callers should not modify it.
         """
-        if context_type not in self.schema:
-            return None
+        return self._compiled_context_schemas.get(context_type)
+
+    def _compile_context_schema(self, context_type: ContextType) -> Dict[str, Any]:
+        """ Build the json-schema for the given context_type. context_type must be a valid context type. """
         all_classes = self.get_all_parent_context_types(context_type)
         properties = {}
         for klass in all_classes:
@@ -327,6 +373,10 @@ class EventSchema:
         self.version = {}
         self.events = EventSubSchema()
         self.contexts = ContextSubSchema()
+        # jsonschema validators per event-type and context-type. Built on first use, or up front by
+        # calling compile_validators()
+        self._compiled_event_validators: Optional[Dict[EventType, Any]] = None
+        self._compiled_context_validators: Optional[Dict[ContextType, Any]] = None
 
     def get_extended_schema(self, schema: Dict[str, Any]) -> 'EventSchema':
         """
@@ -402,6 +452,14 @@ class EventSchema:
         """
         return self.events.get_all_parent_event_types(event_type=event_type)
 
+    def get_sorted_parent_event_types(self, event_type: EventType) -> Tuple[EventType, ...]:
+        """
+        Given an event_type, give an alphabetically sorted tuple with that event_type and all its parent
+        event_types. The tuple is precalculated, and shared between calls.
+        :param event_type: event type. Must be a valid event_type
+        """
+        return self.events.get_sorted_parent_event_types(event_type=event_type)
+
     def get_all_required_contexts(self, event_type: EventType) -> Set[ContextType]:
         return self.events.get_all_required_contexts(event_type=event_type)
 
@@ -414,6 +472,13 @@ class EventSchema:
     def get_all_parent_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_parent_context_types(context_type=context_type)
 
+    def get_sorted_parent_context_types(self, context_type: ContextType) -> Tuple[ContextType, ...]:
+        """
+        Given a context_type, give an alphabetically sorted tuple with that context_type and all its parent
+        context_types. The tuple is precalculated, and shared between calls.
+        """
+        return self.contexts.get_sorted_parent_context_types(context_type=context_type)
+
     def get_all_child_context_types(self, context_type: ContextType) -> Set[ContextType]:
         return self.contexts.get_all_child_context_types(context_type=context_type)
 
@@ -423,6 +488,48 @@ class EventSchema:
     def get_event_schema(self, event_type: EventType) -> Optional[Dict[str, Any]]:
         return self.events.get_event_schema(event_type=event_type)
 
+    def compile_validators(self) -> 'EventSchema':
+        """
+        Build a jsonschema validator for each event-type and context-type in this schema. The json-schemas
+        are checked against the meta-schema once here, so the validators can be reused for every event
+        without re-checking.
+        Calling this is optional, the validators are otherwise built on first use. Returns self.
+        """
+        self._compiled_event_validators = {
+            event_type: _create_validator(self.events.get_event_schema(event_type))
+            for event_type in self.events.list_event_types()
+        }
+        self._compiled_context_validators = {
+            context_type: _create_validator(self.contexts.get_context_schema(context_type))
+            for context_type in self.contexts.list_context_types()
+        }
+        return self
+
+    def get_event_validator(self, event_type: EventType) -> Optional[Any]:
+        """
+        Give the jsonschema validator for a specific event_type, or None if the event type doesn't exist.
+        """
+        if self._compiled_event_validators is None:
+            self.compile_validators()
+            assert self._compiled_event_validators is not None  # help out mypy
+        return self._compiled_event_validators.get(event_type)
+
+    def get_context_validator(self, context_type: ContextType) -> Optional[Any]:
+        """
+        Give the jsonschema validator for a specific context_type, or None if the context type doesn't exist.
+        """
+        if self._compiled_context_validators is None:
+            self.compile_validators()
+            assert self._compiled_context_validators is not None  # help out mypy
+        return self._compiled_context_validators.get(context_type)
+
+
+def _create_validator(schema: Optional[Dict[str, Any]]) -> Any:
+    """ Create a jsonschema validator for the given json-schema, after checking it against its meta-schema. """
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
 
 def get_event_list_schema() -> EventListSchema:
     data = pkgutil.get_data(__name__, "event_list.json5")
@@ -457,7 +564,7 @@ def get_event_schema(schema_extensions_directory: Optional[str]) -> EventSchema:
     if schema_extensions_directory:
         all_filenames = sorted(os.listdir(schema_extensions_directory))
         for filename in all_filenames:
-            if not re.match(r'[a-z0-9_]+\.json', filename):
+            if not re.match(SCHEMA_EXTENSION_FILENAME_REGEX, filename):
                 print(f'Ignoring non-schema file: {filename}', file=sys.stderr)
                 continue
             files_to_load.append(os.path.join(schema_extensions_directory, filename))
@@ -475,4 +582,4 @@ def get_event_schema(schema_extensions_directory: Optional[str]) -> EventSchema:
     event_schema = EventSchema()
     for schema_json in schema_jsons:
         event_schema = event_schema.get_extended_schema(schema_json)
-    return event_schema
\ No newline at end of file
+    return event_schema.compile_validators()
\ No newline at end of file
@@ -4,6 +4,7 @@ Copyright 2021 Objectiv B.V.
 import argparse
 import json
 import sys
+from copy import deepcopy
 from typing import List, Any, Dict, NamedTuple, Set
 
 from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
@@ -69,7 +70,8 @@ def get_schema_context_validation(event_schema: EventSchema) -> SchemaDefinition
     references = []
     definitions = {}
     for context_type in event_schema.list_context_types():
-        definition = event_schema.get_context_schema(context_type)
+        # copy, as the schema returned by get_context_schema() is shared and we modify it below
+        definition = deepcopy(event_schema.get_context_schema(context_type))
         # help mypy; we are iterating result of list_context_types, so definition should exist
         assert definition is not None
         definition["properties"]["_type"] = {"type": "string", "const": context_type}
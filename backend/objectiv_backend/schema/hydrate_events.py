@@ -20,19 +20,14 @@ def hydrate_types_into_event(event_schema: EventSchema, event: EventData) -> Eve
     :param event: event object. Must have passed event validation by validate_events.validate_event_data.
     :return: The modified event object.
     """
-    event_name = event['_type']
-    all_event_types = event_schema.get_all_parent_event_types(event_name)
-    event["_types"] = sorted(all_event_types)
-    global_contexts = event['global_contexts']
-    for context in global_contexts:
-        context["_types"] = sorted(
-            event_schema.get_all_parent_context_types(context["_type"])
-        )
-    location_stack = event['location_stack']
-    for context in location_stack:
-        context["_types"] = sorted(
-            event_schema.get_all_parent_context_types(context["_type"])
-        )
+    # The sorted types are precalculated by the schema. We only copy them, so that modifying the _types of
+    # one event cannot affect other events.
+    event["_types"] = list(event_schema.get_sorted_parent_event_types(event['_type']))
+    get_context_types = event_schema.get_sorted_parent_context_types
+    for context in event['global_contexts']:
+        context["_types"] = list(get_context_types(context["_type"]))
+    for context in event['location_stack']:
+        context["_types"] = list(get_context_types(context["_type"]))
     return event
 
 
@@ -0,0 +1,122 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Registry with the active event schema, that reloads the schema when the files in the schema extension
+directory change, without restarting the collector or the workers.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from objectiv_backend.schema.event_schemas import EventSchema, SCHEMA_EXTENSION_FILENAME_REGEX, get_event_schema
+
+# Name, modification time, and size of each schema extension file
+_Fingerprint = Tuple[Tuple[str, int, int], ...]
+
+
+def _get_logger() -> logging.Logger:
+    # Not imported at module level: config imports this module, and log imports config
+    from objectiv_backend.common.log import get_logger
+    return get_logger(__name__)
+
+
+class SchemaRegistry:
+    """
+    Holds the active EventSchema and its version. The version is a hash of the contents of the schema
+    extension files.
+
+    reload() builds a new EventSchema, including its validators, if the files changed, and then swaps it in
+    with a single assignment. Readers thus either get the old or the new schema, never a partially built
+    one. If the new files don't make a valid schema, then the old schema stays active.
+    """
+
+    def __init__(self,
+                 schema_extensions_directory: Optional[str],
+                 on_change: Optional[Callable[[EventSchema, str], None]] = None):
+        """
+        :param schema_extensions_directory: optional directory with schema extension files, see
+            get_event_schema()
+        :param on_change: optional function that is called with the new schema and version after a reload
+        """
+        self.schema_extensions_directory = schema_extensions_directory
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._fingerprint = self._get_fingerprint()
+        self.version = self._get_version()
+        self.event_schema = get_event_schema(schema_extensions_directory)
+        self._watcher_pid: Optional[int] = None
+
+    def reload(self) -> bool:
+        """
+        Load the schema again if the schema extension files changed. Returns True if a new schema is active.
+        """
+        with self._lock:
+            fingerprint = self._get_fingerprint()
+            if fingerprint == self._fingerprint:
+                return False
+            self._fingerprint = fingerprint
+            version = self._get_version()
+            if version == self.version:
+                return False
+            try:
+                event_schema = get_event_schema(self.schema_extensions_directory)
+            except Exception as exc:
+                _get_logger().error(f'Error loading schema version {version}, keeping version {self.version}: '
+                                    f'{exc}')
+                return False
+            self.event_schema, self.version = event_schema, version
+        _get_logger().info(f'Loaded schema version {version}')
+        if self.on_change is not None:
+            self.on_change(event_schema, version)
+        return True
+
+    def start_watching(self, interval_seconds: float):
+        """
+        Call reload() every interval_seconds in a background thread. Does nothing if this process already
+        has a thread for this registry. The thread doesn't survive a fork, so this should be called again in
+        a child process.
+        """
+        if self._watcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._watch, args=(interval_seconds, ), name='schema-registry',
+                                      daemon=True)
+            thread.start()
+            self._watcher_pid = os.getpid()
+
+    def _watch(self, interval_seconds: float):
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                self.reload()
+            except Exception as exc:
+                _get_logger().error(f'Error checking schema extension files: {exc}')
+
+    def _get_filenames(self) -> List[str]:
+        if not self.schema_extensions_directory:
+            return []
+        return [filename for filename in sorted(os.listdir(self.schema_extensions_directory))
+                if re.match(SCHEMA_EXTENSION_FILENAME_REGEX, filename)]
+
+    def _get_fingerprint(self) -> _Fingerprint:
+        """ Cheap check for changes, without reading the files. """
+        result = []
+        for filename in self._get_filenames():
+            stat = os.stat(os.path.join(str(self.schema_extensions_directory), filename))
+            result.append((filename, stat.st_mtime_ns, stat.st_size))
+        return tuple(result)
+
+    def _get_version(self) -> str:
+        digest = hashlib.sha256()
+        for filename in self._get_filenames():
+            with open(os.path.join(str(self.schema_extensions_directory), filename), 'rb') as file:
+                digest.update(f'{filename}\0'.encode('utf-8'))
+                digest.update(file.read())
+                digest.update(b'\0')
+        return digest.hexdigest()[:12]
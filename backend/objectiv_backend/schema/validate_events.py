@@ -4,12 +4,13 @@ Copyright 2021 Objectiv B.V.
 import argparse
 import json
 import sys
-from typing import List, Any, Dict, NamedTuple
+from copy import deepcopy
+from typing import List, Any, Dict, NamedTuple, Optional, Callable, Tuple
 import uuid
 import re
 
 import jsonschema
-from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
 
 from objectiv_backend.schema.event_schemas import EventSchema, get_event_schema
 from objectiv_backend.common.config import \
@@ -38,12 +39,53 @@ class EventError(Dict):
         dict.__init__(self, event_id=event_id.__str__(), error_info=[e.asdict() for e in error_info])
 
 
+class _EventListValidation(NamedTuple):
+    """ Compiled structural validation of an EventList, for a specific EventSchema. """
+    event_schema: EventSchema
+    schema: Dict[str, Any]
+    validator: Any
+    # None if the schema uses keywords that _compile_fast_structure_check() doesn't support
+    fast_check: Optional[Callable[[Any], bool]]
+
+
+# Building the event-list schema and validator is relatively expensive, and the result only depends on the
+# EventSchema in the collector config. So we build it once, and only rebuild if the EventSchema changes.
+_CACHED_EVENT_LIST_VALIDATION: Optional[_EventListValidation] = None
+
+
 def get_event_list_schema() -> Dict[str, Any]:
     """
-
+    The returned schema is shared, callers should not modify it.
     :return: a dictionary containing a JSON schema like string to validate an array of events
     """
-    event_schema = get_collector_config().event_schema
+    return _get_event_list_validation().schema
+
+
+def _get_event_list_validation() -> _EventListValidation:
+    """ Get the cached _EventListValidation, or build it if there is none for the current EventSchema. """
+    global _CACHED_EVENT_LIST_VALIDATION
+    config = get_collector_config()
+    cached = _CACHED_EVENT_LIST_VALIDATION
+    if cached is None or cached.event_schema is not config.event_schema:
+        schema = _build_event_list_schema(event_schema=config.event_schema,
+                                          event_list_schema=config.event_list_schema)
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        cached = _EventListValidation(
+            event_schema=config.event_schema,
+            schema=schema,
+            validator=validator_class(schema),
+            fast_check=_compile_fast_structure_check(schema)
+        )
+        _CACHED_EVENT_LIST_VALIDATION = cached
+    return cached
+
+
+def _build_event_list_schema(event_schema: EventSchema, event_list_schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Combine the event_list_schema with the AbstractEvent definition in the event_schema. Neither of the
+    input schemas is modified.
+    """
     events = event_schema.events.schema
 
     # we use AbstractEvent as the blueprint for what an event should look like
@@ -52,7 +94,7 @@ def get_event_list_schema() -> Dict[str, Any]:
     # # list of properties for an event (can be nested)
     items: Dict[str, dict] = {}
     for property_name, property_desc in abstract_event['properties'].items():
-
+        property_desc = deepcopy(property_desc)
         if 'items' in property_desc and re.match('^Abstract.*?Context$', property_desc['items']['type']):
             # we don't want to go into the validation / schema of contexts here
             # so a simple object will suffice
@@ -63,7 +105,7 @@ def get_event_list_schema() -> Dict[str, Any]:
     # the schema wants a list of abstract events. As that is not a valid JSON type,
     # we replace that type with the more generic 'object' type, and the actual definition of
     # an abstract event
-    event_list_schema = get_collector_config().event_list_schema
+    event_list_schema = deepcopy(event_list_schema)
     if 'events' in event_list_schema['properties'] and \
             'items' in event_list_schema['properties']['events'] and \
             'type' in event_list_schema['properties']['events']['items'] and \
@@ -75,6 +117,80 @@ def get_event_list_schema() -> Dict[str, Any]:
     return event_list_schema
 
 
+# Checks for the json-schema types, as used by _compile_fast_structure_check(). Note that in json-schema
+# booleans are not integers or numbers, but in python they are.
+_FAST_TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'boolean': lambda value: isinstance(value, bool),
+}
+
+# Keywords that don't influence validation
+_ANNOTATION_KEYWORDS = {'name', 'version', 'description'}
+
+
+def _compile_fast_structure_check(schema: Dict[str, Any]) -> Optional[Callable[[Any], bool]]:
+    """
+    Compile a json-schema into a function that checks whether data adheres to that schema, without using
+    jsonschema.
+
+    Only the keywords `type`, `properties`, `required`, and `items` are supported. If the schema contains
+    other keywords then None is returned.
+
+    The returned function only gives a definitive answer for valid data: if it returns True, then the data
+    adheres to the schema. If it returns False, then the data might or might not adhere to the schema, and
+    jsonschema should be used to find out what's wrong.
+    """
+    supported = {'type', 'properties', 'required', 'items'}
+    if set(schema.keys()) - supported - _ANNOTATION_KEYWORDS:
+        return None
+
+    type_check: Optional[Callable[[Any], bool]] = None
+    if 'type' in schema:
+        # A list of types (e.g. ["string", "null"]) is not supported, leave that to jsonschema
+        if not isinstance(schema['type'], str) or schema['type'] not in _FAST_TYPE_CHECKS:
+            return None
+        type_check = _FAST_TYPE_CHECKS[schema['type']]
+
+    required = list(schema.get('required', []))
+    property_checks: List[Tuple[str, Callable[[Any], bool]]] = []
+    for property_name, property_schema in schema.get('properties', {}).items():
+        property_check = _compile_fast_structure_check(property_schema)
+        if property_check is None:
+            return None
+        property_checks.append((property_name, property_check))
+
+    # 'items' only applies to arrays. jsonschema ignores it for other types, and so do we.
+    items_check: Optional[Callable[[Any], bool]] = None
+    if 'items' in schema and schema.get('type') in (None, 'array'):
+        if not isinstance(schema['items'], dict):
+            return None
+        items_check = _compile_fast_structure_check(schema['items'])
+        if items_check is None:
+            return None
+
+    def check(data: Any) -> bool:
+        if type_check is not None and not type_check(data):
+            return False
+        if isinstance(data, dict):
+            for property_name in required:
+                if property_name not in data:
+                    return False
+            for property_name, property_check in property_checks:
+                if property_name in data and not property_check(data[property_name]):
+                    return False
+        if items_check is not None and isinstance(data, list):
+            for item in data:
+                if not items_check(item):
+                    return False
+        return True
+
+    return check
+
+
 def validate_structure_event_list(event_data: Any) -> List[ErrorInfo]:
     """
     Checks that event_data is a list of events, that each event has the required fields, and that all
@@ -84,11 +200,14 @@ def validate_structure_event_list(event_data: Any) -> List[ErrorInfo]:
     validate_event_adheres_to_schema on each individual event.
     :return: list of found errors. Empty list indicates not errors
     """
-    try:
-        event_list_schema = get_event_list_schema()
-        jsonschema.validate(instance=event_data, schema=event_list_schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {exc}')]
+    event_list_validation = _get_event_list_validation()
+    # Well-formed data is by far the most common case. We check that without jsonschema if possible, and
+    # only fall back to jsonschema to get an accurate error message.
+    if event_list_validation.fast_check is not None and event_list_validation.fast_check(event_data):
+        return []
+    error = best_match(event_list_validation.validator.iter_errors(event_data))
+    if error:
+        return [ErrorInfo(event_data, f'Overall structure does not adhere to schema: {error}')]
     return []
 
 
@@ -201,24 +320,25 @@ def _validate_context_item(event_schema: EventSchema, context) -> List[ErrorInfo
     context_type = context['_type']
     # theoretically we could generate some json schema with if-then that we could just validate, without
     # having to select the right sub-schema here, but that would be very complex and not very readable.
-    schema = event_schema.get_context_schema(context_type)
-    if not schema:
+    validator = event_schema.get_context_validator(context_type)
+    if not validator:
         print(f'Unknown context {context_type}, ignoring')
         return []
-    try:
-        jsonschema.validate(instance=context, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(context, f'context validation failed: {exc}')]
+    # best_match() gives the same error that jsonschema.validate() would raise
+    error = best_match(validator.iter_errors(context))
+    if error:
+        return [ErrorInfo(context, f'context validation failed: {error}')]
     return []
 
 
 def _validate_event_item(event_schema: EventSchema, event) -> List[ErrorInfo]:
     event_type = event['_type']
-    schema = event_schema.get_event_schema(event_type=event_type)
-    try:
-        jsonschema.validate(instance=event, schema=schema)
-    except ValidationError as exc:
-        return [ErrorInfo(event, f'event validation failed {exc}')]
+    validator = event_schema.get_event_validator(event_type=event_type)
+    if not validator:
+        return [ErrorInfo(event, f'Unknown event: {event_type}')]
+    error = best_match(validator.iter_errors(event))
+    if error:
+        return [ErrorInfo(event, f'event validation failed {error}')]
 
     return []
 
@@ -0,0 +1,26 @@
+-- Sessions, maintained incrementally when events are inserted into data. Added to create_tables.sql if
+-- db_init is run with --sessions. See objectiv_backend/workers/pg_sessions.py
+create table sessions (
+    session_id bigserial primary key,
+    cookie_id uuid not null,
+    start_moment timestamp not null,
+    end_moment timestamp not null,
+    hit_count bigint not null
+);
+
+create unique index on sessions(cookie_id, start_moment);
+
+-- The session of each event in data. This has a copy of the columns of data that are needed to determine
+-- the sessions, so that updating the sessions doesn't have to read the (much bigger) data table.
+create table session_events (
+    event_id uuid not null,
+    day date not null,
+    moment timestamp not null,
+    cookie_id uuid not null,
+    session_id bigint,
+    session_hit_number bigint,
+    primary key(event_id)
+);
+
+create index on session_events(cookie_id, moment);
+create index on session_events(day);
@@ -1,25 +1,33 @@
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union
 
 import base64
-import json
+import threading
+import time
 from datetime import datetime
 from urllib.parse import urlparse
 
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload  # type: ignore
 
 from objectiv_backend.common.config import SnowplowConfig, get_collector_config
-from objectiv_backend.common.event_utils import get_context
+from objectiv_backend.common.event_utils import get_optional_context
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.serialization import dumps, loads
 from objectiv_backend.common.types import EventDataList, EventData
 from objectiv_backend.schema.validate_events import EventError
 
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTransport
 
+logger = get_logger(__name__)
+
 # only load imports if needed
 snowplow_config = get_collector_config().output.snowplow
+# Errors of publishing to PubSub that are not worth retrying
+_PUBSUB_PERMANENT_ERRORS: Tuple[Type[Exception], ...] = ()
 if snowplow_config.gcp_enabled:
     from google.cloud import pubsub_v1
     from google.api_core.exceptions import NotFound
+    _PUBSUB_PERMANENT_ERRORS = (NotFound,)
 
 if snowplow_config.aws_enabled:
     import boto3
@@ -39,7 +47,7 @@ def make_snowplow_custom_context(self_describing_event: Dict, config: SnowplowCo
         'schema': snowplow_contexts_schema,
         'data': [self_describing_event]
     }
-    custom_context_json = json.dumps(custom_context)
+    custom_context_json = dumps(custom_context)
     return str(base64.b64encode(custom_context_json.encode('UTF-8')), 'UTF-8')
 
 
@@ -68,20 +76,11 @@ def objectiv_event_to_snowplow_payload(event: EventData, config: SnowplowConfig)
     snowplow_payload_data_schema = config.schema_payload_data
     snowplow_collector_payload_schema = config.schema_collector_payload
 
-    try:
-        http_context = get_context(event, 'HttpContext')
-    except ValueError:
-        http_context = {}
-
-    try:
-        cookie_context = get_context(event, 'CookieIdContext')
-    except ValueError:
-        cookie_context = {}
-
-    try:
-        path_context = get_context(event, 'PathContext')
-    except ValueError:
-        path_context = {}
+    # These are global contexts, so the lookups stop before the location stack. For three lookups, building a
+    # ContextIndex would cost more than it saves.
+    http_context = get_optional_context(event, 'HttpContext') or {}
+    cookie_context = get_optional_context(event, 'CookieIdContext') or {}
+    path_context = get_optional_context(event, 'PathContext') or {}
 
     query_string = urlparse(str(path_context.get('id', ''))).query
 
@@ -111,7 +110,7 @@ def objectiv_event_to_snowplow_payload(event: EventData, config: SnowplowConfig)
         refererUri=http_context.get('referrer', ''),
         path='/com.snowplowanalytics.snowplow/tp2',
         querystring=query_string,
-        body=json.dumps(payload),
+        body=dumps(payload),
         headers=[],
         contentType='application/json',
         hostname='',
@@ -159,7 +158,7 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
             })
 
     parameters = []
-    data = json.loads(payload.body)['data'][0]
+    data = loads(payload.body)['data'][0]
     for key, value in data.items():
         parameters.append({
             "name": key,
@@ -170,7 +169,7 @@ def snowplow_schema_violation_json(payload: CollectorPayload, config: SnowplowCo
     event = {}
     if 'cx' in data:
         context_container_encoded = data['cx']
-        context_container_decoded = json.loads(base64.b64decode(context_container_encoded).decode('utf-8'))
+        context_container_decoded = loads(base64.b64decode(context_container_encoded).decode('utf-8'))
         contexts = context_container_decoded['data']
         for context in contexts:
             if 'schema' in context and context['schema'] == config.schema_objectiv_taxonomy and 'data' in context:
@@ -265,19 +264,22 @@ def prepare_event_for_snowplow_pipeline(event: EventData,
         failed_event = snowplow_schema_violation_json(payload=payload, config=config, event_error=event_error)
 
         # serialize (json) and encode to bytestring for publishing
-        data = json.dumps(failed_event, separators=(',', ':')).encode('utf-8')
+        data = dumps(failed_event).encode('utf-8')
 
     return data
 
 
 def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good: bool = True,
-                             event_errors: List[EventError] = None) -> None:
+                             event_errors: List[EventError] = None, background: bool = False) -> None:
     """
-    Write provided list of events to the Snowplow GCP pipeline, using GCP PubSub
+    Write provided list of events to the Snowplow GCP pipeline, using GCP PubSub. The publisher client sends
+    the events in batches, see _get_pubsub_publisher(). Events that fail are retried.
     :param events: EventDataList - List of EventData
     :param config:  SnowplowConfig
     :param good: bool - True if these events should go to the "good" channel
     :param event_errors: list of EventErrors
+    :param background: True if this is called from a background thread, rather than while a request waits
+        for it. In the background we wait longer for the messages to be published, and retry more often.
     :return:
     """
 
@@ -289,23 +291,85 @@ def write_data_to_gcp_pubsub(events: EventDataList, config: SnowplowConfig, good
         # not ok events get sent to the bad topic
         topic = config.gcp_pubsub_topic_bad
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = _get_pubsub_publisher()
     topic_path = f'projects/{project}/topics/{topic}'
 
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
+    messages = [prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
+                for event in events]
+    if background:
+        timeout_seconds, max_attempts = _PUBSUB_TIMEOUT_SECONDS, _MAX_ATTEMPTS
+    else:
+        timeout_seconds, max_attempts = _PUBSUB_SYNC_TIMEOUT_SECONDS, _PUBSUB_SYNC_MAX_ATTEMPTS
+    try:
+        publish_to_pubsub(publisher, topic_path, messages,
+                          timeout_seconds=timeout_seconds, max_attempts=max_attempts)
+    except NotFound as e:
+        logger.error(f'PubSub topic {topic} could not be found! {e}')
 
-        try:
-            publisher.publish(topic_path, data=data)
-        except NotFound as e:
-            print(f'PubSub topic {topic} could not be found! {e}')
+
+def publish_to_pubsub(publisher, topic_path: str, messages: List[bytes],
+                      timeout_seconds: Optional[float] = None, max_attempts: Optional[int] = None) -> int:
+    """
+    Publish messages, and wait until they are published. Messages that fail are retried, up to
+    max_attempts times in total.
+    :param publisher: PubSub PublisherClient
+    :param topic_path: full path of the topic
+    :param messages: data of the messages
+    :param timeout_seconds: time to wait for all messages of an attempt to be published. Messages that are
+        not published by then count as failed. Defaults to _PUBSUB_TIMEOUT_SECONDS.
+    :param max_attempts: defaults to _MAX_ATTEMPTS
+    :return: number of messages that could not be published
+    :raise google.api_core.exceptions.NotFound: if the topic doesn't exist
+    """
+    if timeout_seconds is None:
+        timeout_seconds = _PUBSUB_TIMEOUT_SECONDS
+    if max_attempts is None:
+        max_attempts = _MAX_ATTEMPTS
+    pending = messages
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(_get_retry_sleep(attempt))
+        # Publish all messages before waiting for any of them, so the client can send them in batches
+        futures = [publisher.publish(topic_path, data=data) for data in pending]
+        deadline = time.monotonic() + timeout_seconds
+        failed = []
+        for data, future in zip(pending, futures):
+            try:
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except _PUBSUB_PERMANENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.warning(f'Could not publish event to PubSub ({topic_path}), attempt {attempt + 1}: {e}')
+                failed.append(data)
+        pending = failed
+        if not pending:
+            return 0
+    logger.error(f'Giving up on publishing {len(pending)} events to PubSub ({topic_path})')
+    return len(pending)
+
+
+# PublisherClients are expensive to create, and are thread-safe. So we create one per process.
+_CACHED_PUBSUB_PUBLISHER = None
+
+
+def _get_pubsub_publisher():
+    global _CACHED_PUBSUB_PUBLISHER
+    if _CACHED_PUBSUB_PUBLISHER is None:
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=_PUBSUB_BATCH_MAX_MESSAGES,
+            max_bytes=_PUBSUB_BATCH_MAX_BYTES,
+            max_latency=_PUBSUB_BATCH_MAX_LATENCY_SECONDS
+        )
+        _CACHED_PUBSUB_PUBLISHER = pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    return _CACHED_PUBSUB_PUBLISHER
 
 
 def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
                                good: bool = True,
                                event_errors: List[EventError] = None) -> None:
     """
-    Write provided list of events to Snowplow AWS pipeline, either directly to Kinesis, or to SQS
+    Write provided list of events to Snowplow AWS pipeline, either directly to Kinesis, or to SQS. The events
+    are sent in batches, and events that fail because of throttling are retried.
     :param events: EventDataList - List of EventData
     :param config:  SnowplowConfig
     :param good: bool - True if these events should go to the "good" channel
@@ -324,45 +388,181 @@ def write_data_to_aws_pipeline(events: EventDataList, config: SnowplowConfig,
         # the bad stream always goes to kinesis
         client_type = 'kinesis'
 
-    if client_type == 'kinesis':
-        client = boto3.client('kinesis')
-    else:
-        client = boto3.client('sqs')
-
-    for event in events:
-        data = prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
-
-        if client_type == 'kinesis':
-            try:
-                client.put_record(
-                    StreamName=stream_name,
-                    Data=data,
-                    PartitionKey='event_id')
-            except client.exceptions.ProvisionedThroughputExceededException as e:
-                print(f'Could not deliver event to Kinesis: throughput exceeded in {stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Exception sending event to Kinesis ({stream_name}: {e}')
-
-        elif client_type == 'sqs':
-            # sqs doesn't support binary payloads, so in this case we base64 encode
-            payload = str(base64.b64encode(data), 'UTF-8')
+    if client_type not in ('kinesis', 'sqs'):
+        # this should never happen
+        raise ValueError(f'Unknown Client-Type: {client_type}')
 
-            try:
-                client.send_message(QueueUrl=stream_name,
-                                    MessageBody=payload,
-                                    MessageAttributes={
-                                        #  The sqs message attribute that will be used to set the kinesis partition key
-                                        'kinesisKey': {
-                                            'StringValue': 'event_id',
-                                            'DataType': 'String'
-                                        }
-                                    })
-            except client.exceptions.InvalidMessageContents as e:
-                print(f'Failed to deliver event to SQS: Invalid Message Contents ({stream_name}: {e}')
-            except botocore.exceptions.ClientError as e:
-                print(f'Failed to deliver event to SQS ({stream_name}: {e}')
-
-        else:
-            # this should never happen
-            raise ValueError(f'Unknown Client-Type: {client_type}')
+    client = _get_aws_client(client_type)
+    records = [prepare_event_for_snowplow_pipeline(event=event, good=good, event_errors=event_errors, config=config)
+               for event in events]
 
+    if client_type == 'kinesis':
+        put_records_to_kinesis(client, stream_name=stream_name, records=records)
+    else:
+        # sqs doesn't support binary payloads, so in this case we base64 encode
+        messages = [str(base64.b64encode(data), 'UTF-8') for data in records]
+        send_messages_to_sqs(client, queue_url=stream_name, messages=messages)
+
+
+# Partition key of the events in Kinesis
+_KINESIS_PARTITION_KEY = 'event_id'
+# Limits of a Kinesis PutRecords request
+_KINESIS_BATCH_MAX_RECORDS = 500
+_KINESIS_BATCH_MAX_BYTES = 5 * 1024 * 1024
+
+# The sqs message attribute that will be used to set the kinesis partition key
+_SQS_MESSAGE_ATTRIBUTES = {
+    'kinesisKey': {
+        'StringValue': _KINESIS_PARTITION_KEY,
+        'DataType': 'String'
+    }
+}
+# Limits of an SQS SendMessageBatch request
+_SQS_BATCH_MAX_MESSAGES = 10
+_SQS_BATCH_MAX_BYTES = 256 * 1024
+# Size that the message attributes add to an SQS message
+_SQS_ATTRIBUTES_BYTES = len('kinesisKey') + len(_KINESIS_PARTITION_KEY) + len('String')
+
+# PubSub client batch settings
+_PUBSUB_BATCH_MAX_MESSAGES = 1000
+_PUBSUB_BATCH_MAX_BYTES = 5 * 1024 * 1024
+_PUBSUB_BATCH_MAX_LATENCY_SECONDS = 0.05
+# Time to wait for the messages of an attempt to be published, in the background (see SinkDispatcher)
+_PUBSUB_TIMEOUT_SECONDS = 60
+# Same, and the number of attempts, when a request waits for the messages to be published
+_PUBSUB_SYNC_TIMEOUT_SECONDS = 5
+_PUBSUB_SYNC_MAX_ATTEMPTS = 2
+
+# Number of attempts for records that fail, e.g. because of throttling, and the maximum time between attempts
+_MAX_ATTEMPTS = 5
+_MAX_RETRY_SLEEP_SECONDS = 5
+
+
+def put_records_to_kinesis(client, stream_name: str, records: List[bytes]) -> int:
+    """
+    Write records to Kinesis with PutRecords requests. Records that fail, e.g. because the throughput of the
+    stream is exceeded, are retried up to _MAX_ATTEMPTS times in total.
+    :param client: boto3 Kinesis client
+    :param stream_name: name of the stream
+    :param records: data of the records
+    :return: number of records that could not be delivered
+    """
+    failed = 0
+    for batch in _make_batches(records, max_count=_KINESIS_BATCH_MAX_RECORDS, max_bytes=_KINESIS_BATCH_MAX_BYTES,
+                               extra_bytes=len(_KINESIS_PARTITION_KEY)):
+        failed += _put_kinesis_batch(client, stream_name, batch)
+    return failed
+
+
+def _put_kinesis_batch(client, stream_name: str, batch: List[bytes]) -> int:
+    pending = batch
+    for attempt in range(_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(_get_retry_sleep(attempt))
+        try:
+            response = client.put_records(
+                StreamName=stream_name,
+                Records=[{'Data': data, 'PartitionKey': _KINESIS_PARTITION_KEY} for data in pending])
+        except botocore.exceptions.ClientError as e:
+            logger.warning(f'Exception sending {len(pending)} events to Kinesis ({stream_name}): {e}')
+            return len(pending)
+        if not response.get('FailedRecordCount'):
+            return 0
+        # The results are in the same order as the records in the request. Failed records have an ErrorCode:
+        # ProvisionedThroughputExceededException or InternalFailure, both of which are worth retrying.
+        failed = [(data, result) for data, result in zip(pending, response['Records']) if 'ErrorCode' in result]
+        logger.warning(f'Could not deliver {len(failed)} events to Kinesis ({stream_name}), attempt {attempt + 1}: '
+                       f'{failed[0][1]["ErrorCode"]}')
+        pending = [data for data, _ in failed]
+    logger.error(f'Giving up on delivering {len(pending)} events to Kinesis ({stream_name})')
+    return len(pending)
+
+
+def send_messages_to_sqs(client, queue_url: str, messages: List[str]) -> int:
+    """
+    Send messages to SQS with SendMessageBatch requests. Messages that fail because of a problem on the side
+    of SQS are retried up to _MAX_ATTEMPTS times in total; messages that are rejected are not.
+    :param client: boto3 SQS client
+    :param queue_url: url of the queue
+    :param messages: bodies of the messages
+    :return: number of messages that could not be delivered
+    """
+    failed = 0
+    for batch in _make_batches(messages, max_count=_SQS_BATCH_MAX_MESSAGES, max_bytes=_SQS_BATCH_MAX_BYTES,
+                               extra_bytes=_SQS_ATTRIBUTES_BYTES):
+        failed += _send_sqs_batch(client, queue_url, batch)
+    return failed
+
+
+def _send_sqs_batch(client, queue_url: str, batch: List[str]) -> int:
+    # Entries are identified by their index in the batch
+    pending = {str(index): message for index, message in enumerate(batch)}
+    rejected = 0
+    for attempt in range(_MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(_get_retry_sleep(attempt))
+        try:
+            response = client.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': entry_id, 'MessageBody': message, 'MessageAttributes': _SQS_MESSAGE_ATTRIBUTES}
+                         for entry_id, message in pending.items()])
+        except botocore.exceptions.ClientError as e:
+            logger.warning(f'Failed to deliver {len(pending)} events to SQS ({queue_url}): {e}')
+            return rejected + len(pending)
+        retry = {}
+        for failure in response.get('Failed', []):
+            if failure.get('SenderFault'):
+                logger.warning(f'Failed to deliver event to SQS ({queue_url}): '
+                               f'{failure.get("Code")} {failure.get("Message")}')
+                rejected += 1
+            else:
+                retry[failure['Id']] = pending[failure['Id']]
+        pending = retry
+        if not pending:
+            return rejected
+        logger.warning(f'Could not deliver {len(pending)} events to SQS ({queue_url}), attempt {attempt + 1}')
+    logger.error(f'Giving up on delivering {len(pending)} events to SQS ({queue_url})')
+    return rejected + len(pending)
+
+
+T = TypeVar('T', bytes, str)
+
+
+def _make_batches(items: List[T], max_count: int, max_bytes: int, extra_bytes: int = 0) -> List[List[T]]:
+    """
+    Split items into batches of at most max_count items, and at most max_bytes. An item that is bigger than
+    max_bytes by itself gets a batch of its own.
+    :param extra_bytes: number of bytes that each item adds to the size of a batch, in addition to its length
+    """
+    batches: List[List[T]] = []
+    batch: List[T] = []
+    batch_bytes = 0
+    for item in items:
+        item_bytes = len(item) + extra_bytes
+        if batch and (len(batch) >= max_count or batch_bytes + item_bytes > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _get_retry_sleep(attempt: int) -> float:
+    """ Time to wait before the given attempt, with exponential backoff. """
+    return min(_MAX_RETRY_SLEEP_SECONDS, 0.1 * 2 ** attempt)
+
+
+# Creating boto3 clients is expensive, and clients are thread-safe. So we create one per type, per process.
+_CACHED_AWS_CLIENTS: Dict[str, Any] = {}
+# Creating clients is not thread-safe
+_CACHED_AWS_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_aws_client(client_type: str):
+    with _CACHED_AWS_CLIENTS_LOCK:
+        if client_type not in _CACHED_AWS_CLIENTS:
+            _CACHED_AWS_CLIENTS[client_type] = boto3.client(client_type)
+        return _CACHED_AWS_CLIENTS[client_type]
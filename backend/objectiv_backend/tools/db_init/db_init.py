@@ -9,26 +9,96 @@ Copyright 2021 Objectiv B.V.
 """
 import argparse
 import os
+import re
 import sys
 from time import sleep
+from typing import Optional
 
 import psycopg2
 
 from objectiv_backend.common.config import get_config_postgres
 from objectiv_backend.common.db import get_db_connection
+from objectiv_backend.tools.db_partitions.db_partitions import create_partitions
 
 _MAX_RETRIES = 5
 _POSTGRES_DUPLICATE_TABLE_ERROR = '42P07'
-
-
-def get_sql() -> str:
-    """ get content of ../../create_tables.sql as string """
+_PARTITION_BY_OPTIONS = ('day', 'month')
+# Block in create_tables.sql that is replaced by data_partitioned.sql if the data table is partitioned
+_DATA_TABLE_BLOCK = re.compile(r'^-- begin data table$.*^-- end data table$', re.MULTILINE | re.DOTALL)
+# Definition of the value column of the data table, and its replacement if jsonb storage is used. The
+# extracted columns are filled by insert_events_into_data().
+_JSON_VALUE_COLUMN = '    value json not null,\n'
+_JSONB_VALUE_COLUMNS = \
+    '''    value jsonb not null,
+    -- Copies of parts of value, so queries don't have to extract these from value for every row
+    event_type text not null,
+    stack_event_types jsonb not null,
+    global_contexts jsonb not null,
+    location_stack jsonb not null,
+'''
+# Columns of the queue tables, and their replacement if the queues store a row per batch of events. See
+# PostgresQueues.
+_QUEUE_COLUMNS = \
+    '''    event_id uuid not null,
+    insert_order bigserial,
+    value json not null
+'''
+_QUEUE_BATCH_COLUMNS = \
+    '''    insert_order bigserial,
+    -- Number of events in value, which is a json array of events that were put on the queue together
+    event_count integer not null,
+    value json not null
+'''
+_QUEUE_TABLES = ('queue_entry', 'queue_finalize')
+
+
+def _read_sql_file(name: str) -> str:
     dirname = os.path.dirname(__file__)
-    filename = os.path.join(dirname, '../../create_tables.sql')
+    filename = os.path.join(dirname, '../..', name)
     with open(filename) as f:
         return f.read()
 
 
+def get_sql(partition_by: Optional[str] = None, jsonb: bool = False, sessions: bool = False,
+            queue_batches: bool = False, unlogged_queues: bool = False) -> str:
+    """
+    get content of ../../create_tables.sql as string
+    :param partition_by: If set, the data table is partitioned by 'day' or 'month', as defined in
+        ../../data_partitioned.sql
+    :param jsonb: If True, the value column of the data table is jsonb instead of json, and the data table
+        gets extra columns with the event_type, stack_event_types, global_contexts, and location_stack.
+    :param sessions: If True, add the tables with incrementally maintained sessions, as defined in
+        ../../sessions.sql
+    :param queue_batches: If True, the queue tables store a row per batch of events instead of a row per
+        event.
+    :param unlogged_queues: If True, the queue tables are unlogged. This saves writing the queued events
+        to the write-ahead log, but the queues are emptied if Postgres crashes.
+    """
+    sql = _read_sql_file('create_tables.sql')
+    if queue_batches:
+        if sql.count(_QUEUE_COLUMNS) != len(_QUEUE_TABLES):
+            raise Exception('Cannot find queue table definitions in create_tables.sql')
+        sql = sql.replace(_QUEUE_COLUMNS, _QUEUE_BATCH_COLUMNS)
+    if unlogged_queues:
+        for table_name in _QUEUE_TABLES:
+            sql = sql.replace(f'create table {table_name} (', f'create unlogged table {table_name} (', 1)
+    match = _DATA_TABLE_BLOCK.search(sql)
+    if match is None:
+        raise Exception('Cannot find data table definition in create_tables.sql')
+    data_sql = match.group(0)
+    if partition_by is not None:
+        if partition_by not in _PARTITION_BY_OPTIONS:
+            raise ValueError(f'partition_by should be one of {_PARTITION_BY_OPTIONS}, got {partition_by}')
+        data_sql = _read_sql_file('data_partitioned.sql').replace('{partition_by}', partition_by).strip()
+    if jsonb:
+        if _JSON_VALUE_COLUMN not in data_sql:
+            raise Exception('Cannot find value column in data table definition')
+        data_sql = data_sql.replace(_JSON_VALUE_COLUMN, _JSONB_VALUE_COLUMNS, 1)
+    if sessions:
+        data_sql += '\n\n' + _read_sql_file('sessions.sql').strip()
+    return sql[:match.start()] + data_sql + sql[match.end():]
+
+
 def get_connection_with_retries(retry: bool):
     """ Connect to database. If retry set will attempt multiple times"""
     pg_config = get_config_postgres()
@@ -54,8 +124,26 @@ def main():
                              "giving the database time to start up if run at start up. If set won't retry")
     parser.add_argument('--print', dest='print', default=False, action='store_true',
                         help="Instead of running sql to setup schema, print it to stdout")
+    parser.add_argument('--partition-by', dest='partition_by', default=None, choices=_PARTITION_BY_OPTIONS,
+                        help="Partition the data table by day or month. Partitions for the coming period "
+                             "are created right away, use objectiv-db-partitions to create new partitions "
+                             "and to detach old partitions after that.")
+    parser.add_argument('--jsonb', dest='jsonb', default=False, action='store_true',
+                        help="Store the events in the data table as jsonb, and store the event type, "
+                             "stack event types, global contexts, and location stack in separate columns. "
+                             "This makes queries on the data faster, at the cost of more storage.")
+    parser.add_argument('--sessions', dest='sessions', default=False, action='store_true',
+                        help="Maintain the sessions of the events in the sessions and session_events tables, "
+                             "while inserting events into the data table.")
+    parser.add_argument('--queue-batches', dest='queue_batches', default=False, action='store_true',
+                        help="Store a row per batch of events in the queue tables (async mode), instead of a "
+                             "row per event.")
+    parser.add_argument('--unlogged-queues', dest='unlogged_queues', default=False, action='store_true',
+                        help="Make the queue tables (async mode) unlogged. Queued events are lost if "
+                             "Postgres crashes.")
     args = parser.parse_args(sys.argv[1:])
-    sql = get_sql()
+    sql = get_sql(partition_by=args.partition_by, jsonb=args.jsonb, sessions=args.sessions,
+                  queue_batches=args.queue_batches, unlogged_queues=args.unlogged_queues)
 
     if args.print:
         print(sql)
@@ -66,6 +154,10 @@ def main():
         try:
             cursor.execute(sql)
             print('Succesfully initialized database.')
+            if args.partition_by:
+                with connection:
+                    created = create_partitions(connection)
+                print(f'Created partitions: {", ".join(created)}')
         except psycopg2.Error as error:
             if error.pgcode == _POSTGRES_DUPLICATE_TABLE_ERROR:
                 print('Got "duplicate table error", assuming database is already initialized')
@@ -0,0 +1,207 @@
+"""
+Tool that manages the partitions of the data table, if the data table is partitioned (see db_init's
+--partition-by option, and data_partitioned.sql):
+ * creates partitions for the coming period, so that new events don't end up in the default partition.
+ * optionally detaches (and drops) partitions that are older than the retention period, and removes their
+   event_ids from the data_event_ids table.
+
+Run this regularly, e.g. daily from cron, or keep it running with --loop.
+
+Copyright 2022 Objectiv B.V.
+"""
+import argparse
+import sys
+from datetime import date, datetime, timedelta
+from time import sleep
+from typing import List, Optional, Tuple
+
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.db import get_db_connection
+
+_DEFAULT_AHEAD_DAYS = 7
+_DEFAULT_LOOP_SECONDS = 3600
+_PARTITION_NAME_FORMATS = {
+    'day': 'data_p%Y%m%d',
+    'month': 'data_p%Y%m',
+}
+
+
+def get_partition_range(partition_by: str, day: date) -> Tuple[date, date]:
+    """ Get the range [start, end) of the partition that contains day. """
+    if partition_by == 'day':
+        return day, day + timedelta(days=1)
+    if partition_by == 'month':
+        start = day.replace(day=1)
+        end = (start + timedelta(days=31)).replace(day=1)
+        return start, end
+    raise ValueError(f'Unsupported partition_by: {partition_by}')
+
+
+def get_partition_name(partition_by: str, start: date) -> str:
+    return start.strftime(_PARTITION_NAME_FORMATS[partition_by])
+
+
+def parse_partition_name(partition_by: str, name: str) -> Optional[date]:
+    """ Get the start of the partition with the given name, or None if the name is not a partition name. """
+    try:
+        return datetime.strptime(name, _PARTITION_NAME_FORMATS[partition_by]).date()
+    except ValueError:
+        return None
+
+
+def get_partitions_to_create(partition_by: str, existing: List[str], today: date,
+                             ahead_days: int) -> List[date]:
+    """
+    Get the starts of the partitions that are needed to cover today up to and including today + ahead_days,
+    and that don't exist yet.
+    """
+    starts = []
+    start, _ = get_partition_range(partition_by, today)
+    while start <= today + timedelta(days=ahead_days):
+        if get_partition_name(partition_by, start) not in existing:
+            starts.append(start)
+        _, start = get_partition_range(partition_by, start)
+    return starts
+
+
+def get_partitions_to_detach(partition_by: str, existing: List[str], today: date,
+                             retention_days: int) -> List[str]:
+    """ Get the names of the partitions that only contain days before today - retention_days. """
+    cutoff = today - timedelta(days=retention_days)
+    names = []
+    for name in sorted(existing):
+        start = parse_partition_name(partition_by, name)
+        if start is not None and get_partition_range(partition_by, start)[1] <= cutoff:
+            names.append(name)
+    return names
+
+
+def get_partition_by(connection) -> Optional[str]:
+    """ Get the partition size of the data table ('day' or 'month'), or None if it is not partitioned. """
+    with connection.cursor() as cursor:
+        cursor.execute("select to_regclass('data_partitioning') is not null")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute('select partition_by from data_partitioning')
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+
+def get_existing_partitions(connection) -> List[str]:
+    """ Get the names of all partitions of the data table. """
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            select c.relname
+            from pg_inherits as i
+            inner join pg_class as c on c.oid = i.inhrelid
+            where i.inhparent = 'data'::regclass
+        ''')
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_partitions(connection,
+                      ahead_days: int = _DEFAULT_AHEAD_DAYS,
+                      today: Optional[date] = None) -> List[str]:
+    """
+    Create the partitions that are needed to cover today up to today + ahead_days. Events in the default
+    partition that belong in a new partition are moved to that partition.
+    Does not do any transaction management.
+    :return: names of the created partitions
+    """
+    partition_by = get_partition_by(connection)
+    if partition_by is None:
+        raise Exception('The data table is not partitioned')
+    today = today or datetime.utcnow().date()
+    existing = get_existing_partitions(connection)
+    created = []
+    with connection.cursor() as cursor:
+        for start in get_partitions_to_create(partition_by, existing, today, ahead_days):
+            _, end = get_partition_range(partition_by, start)
+            name = get_partition_name(partition_by, start)
+            # Postgres refuses to create a partition if the default partition has rows that belong in it
+            cursor.execute('select exists(select 1 from data_default where day >= %s and day < %s)',
+                           (start, end))
+            move_rows = cursor.fetchone()[0]
+            if move_rows:
+                cursor.execute('create temporary table data_moved (like data)')
+                cursor.execute('''
+                    with moved as (
+                        delete from data_default where day >= %s and day < %s returning *
+                    )
+                    insert into data_moved select * from moved
+                ''', (start, end))
+            # The bounds are dates that we formatted ourselves, so it's safe to put them in the query
+            cursor.execute(f"create table {name} partition of data "
+                           f"for values from ('{start.isoformat()}') to ('{end.isoformat()}')")
+            if move_rows:
+                cursor.execute(f'insert into {name} select * from data_moved')
+                cursor.execute('drop table data_moved')
+            created.append(name)
+    return created
+
+
+def detach_partitions(connection,
+                      retention_days: int,
+                      drop: bool = False,
+                      today: Optional[date] = None) -> List[str]:
+    """
+    Detach the partitions that only contain days before today - retention_days, and remove their event_ids
+    from data_event_ids. Detached partitions are regular tables; they can be archived and dropped, or
+    attached again. Does not do any transaction management.
+    :param drop: If True, drop the partitions after detaching them.
+    :return: names of the detached partitions
+    """
+    partition_by = get_partition_by(connection)
+    if partition_by is None:
+        raise Exception('The data table is not partitioned')
+    today = today or datetime.utcnow().date()
+    names = get_partitions_to_detach(partition_by, get_existing_partitions(connection), today, retention_days)
+    with connection.cursor() as cursor:
+        for name in names:
+            cursor.execute(f'alter table data detach partition {name}')
+            if drop:
+                cursor.execute(f'drop table {name}')
+        if names:
+            last_start = parse_partition_name(partition_by, names[-1])
+            assert last_start is not None
+            _, cutoff = get_partition_range(partition_by, last_start)
+            cursor.execute('delete from data_event_ids where day < %s', (cutoff,))
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the partitions of the data table')
+    parser.add_argument('--ahead-days', type=int, default=_DEFAULT_AHEAD_DAYS,
+                        help='Create partitions up to this many days in the future')
+    parser.add_argument('--retention-days', type=int, default=None,
+                        help='Detach partitions with events that are older than this many days. '
+                             'By default no partitions are detached.')
+    parser.add_argument('--drop', action='store_true',
+                        help='Drop partitions after detaching them')
+    parser.add_argument('--loop', action='store_true',
+                        help='Keep running, and manage the partitions every --loop-seconds')
+    parser.add_argument('--loop-seconds', type=int, default=_DEFAULT_LOOP_SECONDS)
+    args = parser.parse_args(sys.argv[1:])
+
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    while True:
+        connection = get_db_connection(pg_config)
+        try:
+            with connection:
+                created = create_partitions(connection, ahead_days=args.ahead_days)
+                print(f'Created partitions: {", ".join(created) or "none"}')
+                if args.retention_days is not None:
+                    detached = detach_partitions(connection, retention_days=args.retention_days,
+                                                 drop=args.drop)
+                    print(f'Detached partitions: {", ".join(detached) or "none"}')
+        finally:
+            connection.close()
+        if not args.loop:
+            break
+        sleep(args.loop_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,26 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
+import select
 import uuid
 from enum import Enum
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple, Sequence
 
 import psycopg2
 from psycopg2.extras import execute_values
 
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.db import copy_rows, get_db_connection, get_pooled_db_connection
+from objectiv_backend.common.metrics import DB_SECONDS, QUEUE_EVENTS
+from objectiv_backend.common.serialization import get_serialized_events
 from objectiv_backend.common.types import EventDataList
 
 
+# Number of rows that get_events() fetches at a time from queue tables with batch rows. Fetched rows are
+# locked, so this limits the number of rows that are locked but not taken.
+_BATCH_ROWS_FETCH_SIZE = 10
+
+
 class ProcessingStage(Enum):
     ENTRY = "entry"
     FINALIZE = "finalize"
@@ -27,14 +36,20 @@ class PostgresQueues:
 
     This class assumes that the postgres connection has the isolation level ISOLATION_LEVEL_READ_COMMITTED
     set.
+
+    The queue tables have either a row per event, or a row per batch of events that were put on the queue
+    together (`objectiv-db-init --queue-batches`). This is detected automatically, see _has_batch_rows().
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, copy_threshold: int = 0):
         """
         Create a new PostgresQueues object
         :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
+        :param copy_threshold: if non-zero, put_events() writes batches of at least this many events with
+            `copy` instead of `insert`.
         """
         self.connection = connection
+        self.copy_threshold = copy_threshold
 
     @staticmethod
     def _queue_to_table(queue: ProcessingStage):
@@ -44,15 +59,23 @@ class PostgresQueues:
             return 'queue_finalize'
         raise Exception('Implementation incomplete')
 
+    @staticmethod
+    def queue_to_channel(queue: ProcessingStage) -> str:
+        """ Name of the channel on which put_events() sends a notification for the given queue. """
+        return f'objectiv_{PostgresQueues._queue_to_table(queue)}'
+
     def get_events(self, queue: ProcessingStage, max_items: int) -> EventDataList:
         """
         Get a list of events from a queue for processing.
 
         :param queue: Queue from which to pick events
         :param max_items: maximum number of items to pick from the queue.
-        :return: list of events with id, at most max_items, but can be less.
+        :return: list of events, at most max_items, but can be less. If the queue has batch rows, then
+            whole batches are taken, and the last batch can make the list longer than max_items.
         """
         table_name = self._queue_to_table(queue)
+        if _has_batch_rows(self.connection):
+            return self._get_batches(table_name, max_items)
         query = f'''
             delete from {table_name}
             where event_id in (
@@ -64,28 +87,157 @@ class PostgresQueues:
             )
             returning event_id, value;
         '''
-        with self.connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+        with DB_SECONDS.time(operation='get', table=table_name), \
+                self.connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
             cursor.execute(query, (max_items, ))
-            events_with_id: EventDataList = cursor.fetchall()
-        return events_with_id
+            # psycopg2 parses the json values into dictionaries
+            events: EventDataList = [row.value for row in cursor.fetchall()]
+        return events
+
+    def _get_batches(self, table_name: str, max_items: int) -> EventDataList:
+        """ Take batch rows from the table, until there are at least max_items events. """
+        insert_orders: List[int] = []
+        event_count = 0
+        with DB_SECONDS.time(operation='get', table=table_name):
+            # A server-side cursor, so rows are only locked when they are fetched
+            with self.connection.cursor(name=f'get_{table_name}') as cursor:
+                cursor.execute(f'''
+                    select insert_order, event_count
+                    from {table_name}
+                    order by insert_order asc
+                    for update skip locked
+                ''')
+                while event_count < max_items:
+                    rows = cursor.fetchmany(_BATCH_ROWS_FETCH_SIZE)
+                    if not rows:
+                        break
+                    for insert_order, row_event_count in rows:
+                        if event_count >= max_items:
+                            break
+                        insert_orders.append(insert_order)
+                        event_count += row_event_count
+            if not insert_orders:
+                return []
+            with self.connection.cursor() as cursor:
+                cursor.execute(f'''
+                    delete from {table_name}
+                    where insert_order = any(%s)
+                    returning insert_order, value
+                ''', (insert_orders, ))
+                rows = sorted(cursor.fetchall())
+        # psycopg2 parses the json arrays into lists of dictionaries
+        return [event for _, batch in rows for event in batch]
 
     def put_events(self,
                    queue: ProcessingStage,
-                   events: EventDataList):
+                   events: EventDataList,
+                   serialized_events: Optional[List[str]] = None):
         """
-        Put an event with a given event-id on a queue
+        Put an event with a given event-id on a queue, and notify the listeners of the queue's channel (see
+        QueueListener). The notification is delivered when the transaction commits.
 
         :param queue: Which queue to put the event on
         :param events: list of events with ids
+        :param serialized_events: optional, the events serialized with serialize_events()
         """
         if not events:
             return
         table_name = self._queue_to_table(queue)
-        insert_query = f'''
-            insert into
-            {table_name}(event_id, value)
-            values %s
-            '''
-        values: List[Tuple[uuid.UUID, str]] = [(event['id'], json.dumps(event)) for event in events]
+        serialized_events = get_serialized_events(events, serialized_events)
+        if _has_batch_rows(self.connection):
+            with DB_SECONDS.time(operation='insert', table=table_name), self.connection.cursor() as cursor:
+                cursor.execute(f'insert into {table_name}(event_count, value) values (%s, %s)',
+                               (len(events), f'[{",".join(serialized_events)}]'))
+                cursor.execute(f'notify {self.queue_to_channel(queue)}')
+            return
+        values: List[Tuple[uuid.UUID, str]] = [
+            (event['id'], serialized_event) for event, serialized_event in zip(events, serialized_events)
+        ]
+        with DB_SECONDS.time(operation='insert', table=table_name), self.connection.cursor() as cursor:
+            if self.copy_threshold and len(values) >= self.copy_threshold:
+                copy_rows(cursor, table_name=table_name, columns=('event_id', 'value'), rows=values)
+            else:
+                insert_query = f'''
+                    insert into
+                    {table_name}(event_id, value)
+                    values %s
+                    '''
+                execute_values(cursor, insert_query, values, template=None, page_size=100)
+            # Postgres folds identical notifications within a transaction, so this is cheap even if
+            # put_events is called multiple times.
+            cursor.execute(f'notify {self.queue_to_channel(queue)}')
+
+    def get_queue_size(self, queue: ProcessingStage) -> int:
+        """ Give the number of events in a queue. """
+        table_name = self._queue_to_table(queue)
+        with self.connection.cursor() as cursor:
+            if _has_batch_rows(self.connection):
+                cursor.execute(f'select coalesce(sum(event_count), 0) from {table_name}')
+            else:
+                cursor.execute(f'select count(*) from {table_name}')
+            return cursor.fetchone()[0]
+
+
+# Whether the queue tables have batch rows, per database. See _has_batch_rows()
+_BATCH_ROWS: Dict[str, bool] = {}
+
+
+def _has_batch_rows(connection) -> bool:
+    """
+    Whether the queue tables have a row per batch of events, instead of a row per event. The result is
+    cached per database.
+    """
+    if connection.dsn not in _BATCH_ROWS:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                select exists(
+                    select from pg_attribute
+                    where attrelid = 'queue_entry'::regclass and attname = 'event_count' and not attisdropped
+                )
+            ''')
+            _BATCH_ROWS[connection.dsn] = cursor.fetchone()[0]
+    return _BATCH_ROWS[connection.dsn]
+
+
+def update_queue_metrics(pg_config: PostgresConfig):
+    """ Set the QUEUE_EVENTS metric to the current size of each queue. """
+    with get_pooled_db_connection(pg_config) as connection:
+        with connection:
+            pg_queues = PostgresQueues(connection=connection)
+            for queue in ProcessingStage:
+                QUEUE_EVENTS.set(pg_queues.get_queue_size(queue), queue=queue.value)
+
+
+class QueueListener:
+    """
+    Listens for the notifications that PostgresQueues.put_events() sends, so workers can wait for work
+    instead of polling the queue tables.
+
+    Uses its own connection in autocommit mode, as notifications are only received outside of
+    transactions.
+    """
+
+    def __init__(self, pg_config: PostgresConfig, queues: Sequence[ProcessingStage]):
+        self.connection = get_db_connection(pg_config)
+        self.connection.autocommit = True
         with self.connection.cursor() as cursor:
-            execute_values(cursor, insert_query, values, template=None, page_size=100)
+            for queue in queues:
+                cursor.execute(f'listen {PostgresQueues.queue_to_channel(queue)}')
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until a notification is received, or timeout seconds have passed.
+        Notifications that were received since the previous call make this return directly.
+        :return: True if a notification was received, False on timeout
+        """
+        self.connection.poll()
+        if not self.connection.notifies:
+            readable, _, _ = select.select([self.connection], [], [], timeout)
+            if readable:
+                self.connection.poll()
+        received = bool(self.connection.notifies)
+        self.connection.notifies.clear()
+        return received
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,147 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Incremental sessionization of events, for databases that have the sessions and session_events tables (see
+sessions.sql).
+
+A session is a series of events of the same cookie, where the time between consecutive events is at most
+session_gap_seconds. When new events are added, only the sessions of the affected cookies from the session
+that contains the earliest new event onward (the 'tail') are recalculated. For events that arrive in order,
+that is just the last session of each cookie.
+"""
+from datetime import datetime
+from typing import List, Tuple
+from uuid import UUID
+
+from psycopg2.extras import execute_values
+
+
+def update_sessions(cursor, rows: List[Tuple[UUID, datetime, UUID]], session_gap_seconds: int):
+    """
+    Add events to the session_events table, and update the sessions of the affected cookies. Events that
+    are already in session_events are ignored.
+
+    Does not do any transaction management. The updates of a cookie's sessions are serialized with an
+    advisory lock, which is held until the end of the transaction. So keep transactions that use this
+    function short.
+
+    :param cursor: psycopg2 cursor, of a connection with ISOLATION_LEVEL_READ_COMMITTED set.
+    :param rows: list of (event_id, moment, cookie_id) tuples
+    :param session_gap_seconds: maximum time between two events in the same session
+    """
+    if not rows:
+        return
+
+    # Cookies with new events, and the moment from which their sessions must be recalculated
+    cursor.execute('''
+        create temporary table if not exists session_tails (
+            cookie_id uuid primary key,
+            tail_start timestamp not null
+        ) on commit delete rows
+    ''')
+    cursor.execute('''
+        create temporary table if not exists session_tail_events (
+            event_id uuid not null,
+            cookie_id uuid not null,
+            moment timestamp not null,
+            session_start timestamp not null,
+            session_hit_number bigint not null
+        ) on commit delete rows
+    ''')
+    # The tables might have been filled earlier in this same transaction
+    cursor.execute('truncate session_tails, session_tail_events')
+
+    execute_values(cursor, '''
+        with new_events as (
+            insert into session_events(event_id, day, moment, cookie_id)
+            select event_id, moment::date, moment, cookie_id
+            from (values %s) as v(event_id, moment, cookie_id)
+            on conflict(event_id) do nothing
+            returning cookie_id, moment
+        )
+        insert into session_tails(cookie_id, tail_start)
+        select cookie_id, min(moment) from new_events group by cookie_id
+        on conflict(cookie_id) do update set tail_start = least(session_tails.tail_start, excluded.tail_start)
+    ''', rows, template='(%s::uuid, %s::timestamp, %s::uuid)', page_size=1000)
+
+    # Serialize updates of the same cookie's sessions. Locks are taken in a fixed order to prevent deadlocks.
+    cursor.execute('''
+        select pg_advisory_xact_lock(hashtext(cookie_id::text))
+        from session_tails
+        order by hashtext(cookie_id::text)
+    ''')
+
+    # The earliest new event might belong to an existing session, recalculate from the start of that session
+    cursor.execute('''
+        update session_tails as t
+        set tail_start = s.start_moment
+        from (
+            select t2.cookie_id, max(s2.start_moment) as start_moment
+            from session_tails as t2
+            inner join sessions as s2 on s2.cookie_id = t2.cookie_id and s2.start_moment <= t2.tail_start
+            group by t2.cookie_id
+        ) as s
+        where s.cookie_id = t.cookie_id
+    ''')
+
+    # Determine the sessions of all events in the tails. An event starts a new session if it is the first
+    # event in the tail, or if it is more than session_gap_seconds after the previous event.
+    cursor.execute('''
+        insert into session_tail_events(event_id, cookie_id, moment, session_start, session_hit_number)
+        select
+            event_id,
+            cookie_id,
+            moment,
+            session_start,
+            row_number() over (partition by cookie_id, session_start order by moment, event_id)
+        from (
+            select
+                *,
+                max(case when is_session_start then moment end)
+                    over (partition by cookie_id order by moment, event_id) as session_start
+            from (
+                select
+                    e.event_id,
+                    e.cookie_id,
+                    e.moment,
+                    coalesce(
+                        extract(epoch from e.moment - lag(e.moment)
+                            over (partition by e.cookie_id order by e.moment, e.event_id)) > %(gap)s,
+                        true
+                    ) as is_session_start
+                from session_events as e
+                inner join session_tails as t on t.cookie_id = e.cookie_id and e.moment >= t.tail_start
+            ) as with_session_starts
+        ) as with_sessions
+    ''', {'gap': session_gap_seconds})
+
+    # Sessions that were split or merged by the new events are replaced. Sessions that still start at the
+    # same moment keep their session_id.
+    cursor.execute('''
+        delete from sessions as s
+        using session_tails as t
+        where s.cookie_id = t.cookie_id
+          and s.start_moment >= t.tail_start
+          and not exists (
+              select from session_tail_events as e
+              where e.cookie_id = s.cookie_id and e.session_start = s.start_moment
+          )
+    ''')
+    cursor.execute('''
+        insert into sessions(cookie_id, start_moment, end_moment, hit_count)
+        select cookie_id, session_start, max(moment), count(*)
+        from session_tail_events
+        group by cookie_id, session_start
+        on conflict(cookie_id, start_moment) do update
+        set end_moment = excluded.end_moment, hit_count = excluded.hit_count
+        where (sessions.end_moment, sessions.hit_count) is distinct from (excluded.end_moment, excluded.hit_count)
+    ''')
+    # Only touch the events whose session changed
+    cursor.execute('''
+        update session_events as e
+        set session_id = s.session_id, session_hit_number = t.session_hit_number
+        from session_tail_events as t
+        inner join sessions as s on s.cookie_id = t.cookie_id and s.start_moment = t.session_start
+        where e.event_id = t.event_id
+          and (e.session_id, e.session_hit_number) is distinct from (s.session_id, t.session_hit_number)
+    ''')
@@ -1,24 +1,62 @@
 """
 Copyright 2021 Objectiv B.V.
 """
-import json
 from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 
 from psycopg2.extras import execute_values
 
+from objectiv_backend.common.config import SESSION_GAP_SECONDS
+from objectiv_backend.common.db import copy_rows
 from objectiv_backend.common.event_utils import get_context
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import DB_SECONDS, EVENTS
+from objectiv_backend.common.serialization import dumps, get_serialized_events
 from objectiv_backend.common.types import FailureReason, EventDataList
+from objectiv_backend.workers.pg_sessions import update_sessions
+from objectiv_backend.workers.recent_event_ids import RecentEventIds
 
+logger = get_logger(__name__)
 
-def insert_events_into_data(connection, events: EventDataList):
+_DATA_COLUMNS = ('event_id', 'day', 'moment', 'cookie_id', 'value')
+# Extra columns of the data table if it was created with jsonb storage, see db_init
+_DATA_EXTRACTED_COLUMNS = ('event_type', 'stack_event_types', 'global_contexts', 'location_stack')
+_NOK_DATA_COLUMNS = ('event_id', 'day', 'moment', 'cookie_id', 'value', 'reason')
+
+
+class _DataLayout(NamedTuple):
+    """ Optional features of the data table, see db_init """
+    # Whether the data table is partitioned, and uniqueness of event_ids is guaranteed by data_event_ids
+    partitioned: bool
+    # Whether the data table has the extracted columns of jsonb storage
+    extracted_columns: bool
+    # Whether the sessions of events are maintained in the sessions and session_events tables
+    sessions: bool
+
+    @property
+    def columns(self) -> Tuple[str, ...]:
+        if self.extracted_columns:
+            return _DATA_COLUMNS + _DATA_EXTRACTED_COLUMNS
+        return _DATA_COLUMNS
+
+
+def insert_events_into_data(connection,
+                            events: EventDataList,
+                            copy_threshold: int = 0,
+                            serialized_events: Optional[List[str]] = None,
+                            recent_event_ids: Optional[RecentEventIds] = None) -> EventDataList:
     """
     Insert events into the 'data' table.
 
     This also tackles the problem of duplicate events. Postgres has a unique index on the event_id, so will
     not allow for two events with the same id to be inserted (a unique event). Here we check which events
     were not inserted (because they violated the uniqueness constraint), and those are inserted in the
-    not-ok data table (nok_data).
+    not-ok data table (nok_data). If the data table is partitioned, then the unique index is on the
+    data_event_ids table instead, see data_partitioned.sql.
+
+    If the data table has the extracted columns of jsonb storage (see db_init), then these are filled too.
+    If the database has the sessions tables (see db_init), then these are updated, see update_sessions().
 
     Does not do any transaction management, this merely issues insert commands. The insert might block if
     another transaction inserts events with the same event_ids. In extreme cases this function might even
@@ -30,10 +68,17 @@ def insert_events_into_data(connection, events: EventDataList):
 
     :param connection: psycopg2 database connection, must have ISOLATION_LEVEL_READ_COMMITTED set.
     :param events: EventDataList, list of events. Each event must be a valid Event, and must have a CookieIdContext
+    :param copy_threshold: if non-zero, and there are at least this many events, then the events are
+        written with `copy` to a staging table, and from there inserted into the data table.
+    :param serialized_events: optional, the events serialized with serialize_events()
+    :param recent_event_ids: optional, event_ids that are known to be in the data table. Events with these
+        ids are not inserted, but treated as duplicates right away. The caller must add the event_ids to
+        recent_event_ids after the transaction is committed.
+    :return: the duplicate events, that were inserted into the nok_data table instead
     :raise Exception: If the database is not available, or if it blocks longer than lock_timeout.
     """
     if not events:
-        return
+        return []
 
     # We use 'on conflict do nothing'. With the read-committed isolation level this guarantees that this
     # transaction will not insert a row that will conflict with another transaction, even if the results
@@ -50,67 +95,204 @@ def insert_events_into_data(connection, events: EventDataList):
     #
     # [1] https://www.postgresql.org/docs/13/transaction-iso.html
     # [2] https://www.postgresql.org/docs/13/sql-insert.html
-    insert_query = f'''
-        insert into data(event_id, day, moment, cookie_id, value)
-        values %s
-        on conflict(event_id) do nothing
-        returning event_id
-    '''
+    layout = _get_data_layout(connection)
+    serialized_events = get_serialized_events(events, serialized_events)
+    duplicate_events: EventDataList = []
+    serialized_duplicate_events: List[str] = []
+    if recent_event_ids is not None:
+        # Events that were inserted recently are duplicates for sure. Typically these are retries by a
+        # tracker, which we can recognize without trying to insert them.
+        new_events: EventDataList = []
+        serialized_new_events: List[str] = []
+        for event, serialized_event in zip(events, serialized_events):
+            if str(event['id']) in recent_event_ids:
+                duplicate_events.append(event)
+                serialized_duplicate_events.append(serialized_event)
+            else:
+                new_events.append(event)
+                serialized_new_events.append(serialized_event)
+        events, serialized_events = new_events, serialized_new_events
     values = []
-    for event in events:
+    for event, serialized_event in zip(events, serialized_events):
         timestamp = _millis_to_datetime(event['time'])
         cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
-        value = (event['id'],
-                 timestamp,
-                 timestamp,
-                 cookie_id,
-                 json.dumps(event))
+        value: Tuple = (event['id'],
+                        timestamp.date(),
+                        timestamp,
+                        cookie_id,
+                        serialized_event)
+        if layout.extracted_columns:
+            value += (event['_type'],
+                      dumps(event['_types']),
+                      dumps(event['global_contexts']),
+                      dumps(event['location_stack']))
         values.append(value)
-    with connection.cursor() as cursor:
-        inserted_event_ids = execute_values(
-            cursor, insert_query, values, template=None, page_size=100, fetch=True)
+    inserted_rows: List[Tuple] = []
+    if values:
+        with DB_SECONDS.time(operation='insert', table='data'), connection.cursor() as cursor:
+            if copy_threshold and len(values) >= copy_threshold:
+                inserted_rows = _copy_into_data(cursor, values, layout=layout)
+            elif layout.partitioned:
+                inserted_rows = _insert_into_partitioned_data(cursor, values, layout=layout)
+            else:
+                insert_query = f'''
+                    insert into data({', '.join(layout.columns)})
+                    values %s
+                    on conflict(event_id) do nothing
+                    returning event_id
+                '''
+                inserted_rows = execute_values(
+                    cursor, insert_query, values, template=None, page_size=100, fetch=True)
+            if layout.sessions:
+                update_sessions(cursor,
+                                rows=[(value[0], value[2], value[3]) for value in values],
+                                session_gap_seconds=SESSION_GAP_SECONDS)
 
     # Determine whether there were any duplicate events that were already in the table
     # In case of duplicate events, we'll add those to the nok_data table for traceability
-    duplicate_events: EventDataList = []
-    if len(inserted_event_ids) < len(events):
-        inserted_event_ids_set = set(inserted_event_ids)
-        for event in events:
-            if event['id'] not in inserted_event_ids_set:
+    if len(inserted_rows) < len(events):
+        # The returned event_ids are uuid objects, the event ids are strings.
+        inserted_event_ids_set = {str(row[0]) for row in inserted_rows}
+        for event, serialized_event in zip(events, serialized_events):
+            event_id = str(event['id'])
+            if event_id in inserted_event_ids_set:
+                # If events contains the same event_id more than once, only the first one was inserted
+                inserted_event_ids_set.remove(event_id)
+            else:
                 duplicate_events.append(event)
+                serialized_duplicate_events.append(serialized_event)
     if duplicate_events:
-        print(f'Duplicate events found, count: {len(duplicate_events)}. '
-              f'Will be inserted in nok_data table.')
-        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE)
+        logger.info(f'Duplicate events found, count: {len(duplicate_events)}. '
+                    f'Will be inserted in nok_data table.')
+        EVENTS.inc(len(duplicate_events), result='duplicate')
+        insert_events_into_nok_data(connection, duplicate_events, reason=FailureReason.DUPLICATE,
+                                    copy_threshold=copy_threshold,
+                                    serialized_events=serialized_duplicate_events)
+    return duplicate_events
+
+
+def _copy_into_data(cursor, values: List[Tuple], layout: _DataLayout) -> List[Tuple]:
+    """
+    Write the values to the data table, through a staging table that is filled with `copy`.
+    Has the same semantics as an `insert ... on conflict(event_id) do nothing returning event_id`
+    statement; see insert_events_into_data() for why that matters.
+    :return: list of rows with the event_ids that were inserted.
+    """
+    # The staging table lives as long as the session, and is emptied on commit. As we use pooled
+    # connections, the table will typically only be created once per connection.
+    cursor.execute('create temporary table if not exists data_staging (like data) on commit delete rows')
+    # The table might have been filled earlier in this same transaction
+    cursor.execute('truncate data_staging')
+    copy_rows(cursor, table_name='data_staging', columns=layout.columns, rows=values)
+    columns = ', '.join(layout.columns)
+    if layout.partitioned:
+        cursor.execute(f'''
+            with new_event_ids as (
+                insert into data_event_ids(event_id, day)
+                select event_id, day from data_staging
+                on conflict(event_id) do nothing
+                returning event_id
+            )
+            insert into data({columns})
+            select distinct on (event_id) {columns}
+            from data_staging
+            inner join new_event_ids using (event_id)
+            returning event_id
+        ''')
+    else:
+        cursor.execute(f'''
+            insert into data({columns})
+            select {columns} from data_staging
+            on conflict(event_id) do nothing
+            returning event_id
+        ''')
+    return cursor.fetchall()
+
+
+def _insert_into_partitioned_data(cursor, values: List[Tuple], layout: _DataLayout) -> List[Tuple]:
+    """
+    Write the values to a partitioned data table. Has the same semantics as the
+    `insert ... on conflict(event_id) do nothing returning event_id` statement that is used for a regular
+    data table, by first inserting the event_ids into the data_event_ids table.
+    :return: list of rows with the event_ids that were inserted.
+    """
+    inserted_rows = execute_values(
+        cursor,
+        'insert into data_event_ids(event_id, day) values %s on conflict(event_id) do nothing returning event_id',
+        [(value[0], value[1]) for value in values],
+        template=None, page_size=100, fetch=True)
+    new_event_ids = {str(row[0]) for row in inserted_rows}
+    new_values = []
+    for value in values:
+        # remove the id from the set, so that only the first of multiple events with the same id is inserted
+        if str(value[0]) in new_event_ids:
+            new_event_ids.remove(str(value[0]))
+            new_values.append(value)
+    execute_values(
+        cursor, f'insert into data({", ".join(layout.columns)}) values %s', new_values, template=None, page_size=100)
+    return inserted_rows
+
+
+# Layout of the data table, per database. See _get_data_layout()
+_DATA_LAYOUTS: Dict[str, _DataLayout] = {}
+
+
+def _get_data_layout(connection) -> _DataLayout:
+    """ Get the layout of the data table. The result is cached per database. """
+    if connection.dsn not in _DATA_LAYOUTS:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                select
+                    to_regclass('data_event_ids') is not null,
+                    exists(
+                        select from pg_attribute
+                        where attrelid = 'data'::regclass and attname = 'event_type' and not attisdropped
+                    ),
+                    to_regclass('session_events') is not null
+            ''')
+            partitioned, extracted_columns, sessions = cursor.fetchone()
+        _DATA_LAYOUTS[connection.dsn] = _DataLayout(partitioned=partitioned,
+                                                    extracted_columns=extracted_columns,
+                                                    sessions=sessions)
+    return _DATA_LAYOUTS[connection.dsn]
 
 
 def insert_events_into_nok_data(connection,
                                 events: EventDataList,
-                                reason: FailureReason = FailureReason.FAILED_VALIDATION):
+                                reason: FailureReason = FailureReason.FAILED_VALIDATION,
+                                copy_threshold: int = 0,
+                                serialized_events: Optional[List[str]] = None):
     """
     Insert events into the not-ok data ('nok_data') table
     Does not do any transaction management, this merely issues insert commands.
     :param connection: db connection
     :param events: EventDataList, list of events. Each event must have a CookieIdContext
     :param reason: Why are these events written to the nok_data table.
+    :param copy_threshold: if non-zero, and there are at least this many events, then the events are
+        written with `copy` instead of `insert`.
+    :param serialized_events: optional, the events serialized with serialize_events()
     """
     if not events:
         return
 
-    insert_query = f'insert into nok_data (event_id, day, moment, cookie_id, value, reason) values %s'
+    serialized_events = get_serialized_events(events, serialized_events)
     values = []
-    for event in events:
+    for event, serialized_event in zip(events, serialized_events):
         timestamp = _millis_to_datetime(event['time'])
         cookie_id = get_context(event, 'CookieIdContext')['cookie_id']
         value = (event['id'],
-                 timestamp,
+                 timestamp.date(),
                  timestamp,
                  cookie_id,
-                 json.dumps(event),
+                 serialized_event,
                  reason.value)
         values.append(value)
-    with connection.cursor() as cursor:
-        execute_values(cursor, insert_query, values, template=None, page_size=100)
+    with DB_SECONDS.time(operation='insert', table='nok_data'), connection.cursor() as cursor:
+        if copy_threshold and len(values) >= copy_threshold:
+            copy_rows(cursor, table_name='nok_data', columns=_NOK_DATA_COLUMNS, rows=values)
+        else:
+            insert_query = f'insert into nok_data ({", ".join(_NOK_DATA_COLUMNS)}) values %s'
+            execute_values(cursor, insert_query, values, template=None, page_size=100)
 
 
 def _millis_to_datetime(millis: int) -> datetime:
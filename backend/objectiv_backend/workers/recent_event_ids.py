@@ -0,0 +1,72 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+In-memory set of the event_ids that were recently committed to the data table, to recognize duplicate events
+without a round-trip to the database. Trackers retry whole batches after network errors, so duplicates
+mostly arrive shortly after the original events.
+
+The database stays the source of truth: event_ids are only added after the transaction that inserted
+them is committed, so the set never contains an event_id that is not in the database. Event_ids that are
+not in the set are still checked by the database, see insert_events_into_data().
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from objectiv_backend.common.config import PostgresConfig
+
+
+class RecentEventIds:
+    """
+    Thread-safe set of at most max_size event_ids. If full, the least recently added or seen event_id is
+    removed.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._event_ids: 'OrderedDict[str, None]' = OrderedDict()
+
+    def __contains__(self, event_id: str) -> bool:
+        with self._lock:
+            if event_id not in self._event_ids:
+                return False
+            # A retried event is likely to be retried again, keep it
+            self._event_ids.move_to_end(event_id)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._event_ids)
+
+    def add(self, event_ids: Iterable[str]):
+        """ Add event_ids. Only call this after the event_ids are committed to the data table. """
+        with self._lock:
+            for event_id in event_ids:
+                self._event_ids[event_id] = None
+                self._event_ids.move_to_end(event_id)
+            while len(self._event_ids) > self.max_size:
+                self._event_ids.popitem(last=False)
+
+
+# One set per process and configuration, created on first use.
+_RECENT_EVENT_IDS: Dict[PostgresConfig, RecentEventIds] = {}
+_RECENT_EVENT_IDS_PID: Optional[int] = None
+_RECENT_EVENT_IDS_LOCK = threading.Lock()
+
+
+def get_recent_event_ids(pg_config: Optional[PostgresConfig]) -> Optional[RecentEventIds]:
+    """
+    Get the RecentEventIds of the current process for the given configuration, or None if
+    pg_config.recent_event_ids is not set.
+    """
+    if pg_config is None or not pg_config.recent_event_ids:
+        return None
+    global _RECENT_EVENT_IDS_PID
+    with _RECENT_EVENT_IDS_LOCK:
+        if _RECENT_EVENT_IDS_PID != os.getpid():
+            _RECENT_EVENT_IDS.clear()
+            _RECENT_EVENT_IDS_PID = os.getpid()
+        if pg_config not in _RECENT_EVENT_IDS:
+            _RECENT_EVENT_IDS[pg_config] = RecentEventIds(max_size=pg_config.recent_event_ids)
+        return _RECENT_EVENT_IDS[pg_config]
@@ -0,0 +1,145 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Supervisor that runs multiple entry, finalize, and single worker processes in parallel.
+
+The queues are consumed with `for update skip locked`, so multiple workers can safely process the same
+queue at the same time.
+"""
+import multiprocessing
+import signal
+import time
+from typing import Callable, Any, Dict, List, NamedTuple
+
+from objectiv_backend.common.config import WORKER_SUPERVISOR_REPORT_SECONDS
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import REGISTRY, WORKER_STAGE_BUSY_SECONDS, WORKER_STAGE_EVENTS
+from objectiv_backend.workers.pg_queues import ProcessingStage
+from objectiv_backend.workers.util import worker_main, StageStats
+from objectiv_backend.workers.worker_entry import main_entry
+from objectiv_backend.workers.worker_finalize import main_finalize
+from objectiv_backend.workers.worker_single import main_single
+
+logger = get_logger(__name__)
+
+
+class _Stage(NamedTuple):
+    function: Callable[[Any, int], int]
+    queue: ProcessingStage
+    process_count: int
+    stats: StageStats
+
+
+class _StatsSnapshot(NamedTuple):
+    moment: float
+    events: int
+    batches: int
+    busy_seconds: float
+
+
+def _run_worker(function: Callable[[Any, int], int], queue: ProcessingStage, stats: StageStats):
+    """ Entry point of a worker process. """
+    # The supervisor takes care of stopping the workers. Ignore ctrl-c, which is sent to the whole process
+    # group, so that workers don't get interrupted in the middle of a batch.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    worker_main(function=function, loop=True, stats=stats, queues=[queue])
+
+
+def run_supervisor(entry_workers: int, finalize_workers: int, single_workers: int = 0,
+                   report_seconds: float = WORKER_SUPERVISOR_REPORT_SECONDS):
+    """
+    Start entry_workers entry worker processes, finalize_workers finalize worker processes, and
+    single_workers single worker processes. Worker processes that exit are restarted. Every report_seconds
+    the throughput per stage is printed.
+
+    Single workers take events from the entry queue, like entry workers, but write them directly to the data
+    tables. With entry_workers=0 all events are processed in a single hop. Keep a finalize worker running
+    until the finalize queue is empty when switching from entry to single workers.
+
+    Runs until interrupted with SIGINT or SIGTERM, after which all worker processes are terminated.
+    """
+    stages = [
+        _Stage(function=main_entry, queue=ProcessingStage.ENTRY, process_count=entry_workers,
+               stats=StageStats('entry')),
+        _Stage(function=main_finalize, queue=ProcessingStage.FINALIZE, process_count=finalize_workers,
+               stats=StageStats('finalize')),
+    ]
+    if single_workers:
+        stages.append(_Stage(function=main_single, queue=ProcessingStage.ENTRY, process_count=single_workers,
+                             stats=StageStats('single')))
+    processes: Dict[str, List[multiprocessing.Process]] = {stage.stats.name: [] for stage in stages}
+    REGISTRY.set_collect_hook('supervisor', lambda: _update_stage_metrics(stages))
+
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    snapshots = {stage.stats.name: _take_snapshot(stage.stats) for stage in stages}
+    try:
+        while True:
+            for stage in stages:
+                _start_missing_processes(stage, processes[stage.stats.name])
+            time.sleep(report_seconds)
+            for stage in stages:
+                snapshot = _take_snapshot(stage.stats)
+                logger.info(format_stage_metrics(name=stage.stats.name,
+                                                 previous=snapshots[stage.stats.name],
+                                                 current=snapshot,
+                                                 process_count=stage.process_count))
+                snapshots[stage.stats.name] = snapshot
+    except KeyboardInterrupt:
+        logger.info('Stopping workers')
+    finally:
+        all_processes = [process for stage_processes in processes.values() for process in stage_processes]
+        for process in all_processes:
+            process.terminate()
+        for process in all_processes:
+            process.join()
+
+
+def _start_missing_processes(stage: _Stage, stage_processes: List[multiprocessing.Process]):
+    """ Remove dead processes from stage_processes, and start new processes up to the desired count. """
+    for process in list(stage_processes):
+        if not process.is_alive():
+            logger.warning(f'{stage.stats.name} worker (pid {process.pid}) exited with code {process.exitcode}, '
+                           f'restarting')
+            stage_processes.remove(process)
+    while len(stage_processes) < stage.process_count:
+        process = multiprocessing.Process(
+            target=_run_worker,
+            kwargs={'function': stage.function, 'queue': stage.queue, 'stats': stage.stats},
+            name=f'objectiv-worker-{stage.stats.name}',
+            daemon=True
+        )
+        process.start()
+        stage_processes.append(process)
+
+
+def _update_stage_metrics(stages: List[_Stage]):
+    """ Set the metrics of the worker processes from the shared counters, for the metrics server. """
+    for stage in stages:
+        WORKER_STAGE_EVENTS.set(stage.stats.events, stage=stage.stats.name)
+        WORKER_STAGE_BUSY_SECONDS.set(stage.stats.busy_seconds, stage=stage.stats.name)
+
+
+def _take_snapshot(stats: StageStats) -> _StatsSnapshot:
+    return _StatsSnapshot(
+        moment=time.time(),
+        events=stats.events,
+        batches=stats.batches,
+        busy_seconds=stats.busy_seconds
+    )
+
+
+def format_stage_metrics(name: str, previous: _StatsSnapshot, current: _StatsSnapshot,
+                         process_count: int) -> str:
+    """ Give a one-line summary of the throughput of a stage between two snapshots. """
+    elapsed = max(current.moment - previous.moment, 1e-9)
+    events = current.events - previous.events
+    batches = current.batches - previous.batches
+    busy_seconds = current.busy_seconds - previous.busy_seconds
+    utilization = busy_seconds / (elapsed * process_count) if process_count else 0
+    return (f'stage={name} workers={process_count} events={events} batches={batches} '
+            f'events_per_second={events / elapsed:.1f} utilization={utilization:.0%} '
+            f'total_events={current.events}')
@@ -1,36 +1,200 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import multiprocessing
 import time
-from typing import Callable, Any
+from typing import Callable, Any, Optional, Sequence
 
-from objectiv_backend.common.config import get_config_postgres
-from objectiv_backend.common.db import get_db_connection
+import psycopg2
 
+from objectiv_backend.common.config import get_config_postgres, WORKER_BATCH_SIZE, WORKER_BATCH_SIZE_MIN, \
+    WORKER_BATCH_SIZE_MAX, WORKER_BATCH_TARGET_SECONDS, WORKER_SLEEP_MIN_SECONDS, WORKER_SLEEP_SECONDS, \
+    WORKER_LISTEN, PostgresConfig
+from objectiv_backend.common.db import get_pooled_db_connection
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import WORKER_BATCH_SECONDS, WORKER_EVENTS
+from objectiv_backend.workers.pg_queues import ProcessingStage, QueueListener
 
-def worker_main(function: Callable[[Any], int], loop: bool) -> int:
+logger = get_logger(__name__)
+
+
+class AdaptiveBatchSize:
+    """
+    Batch size that adapts to the observed processing time of batches:
+        * If a batch was full, and took less than the target time, then there is probably more work
+          waiting and we can handle bigger batches: the size is doubled.
+        * If a batch took more than the target time, the size is halved.
+    The size always stays between minimum and maximum.
+
+    The depth of the queue is not read: counting the rows of a queue table scans it, which would cost more
+    than a batch. A full batch is used as a sign that more work is waiting instead.
+    """
+
+    def __init__(self,
+                 initial: int = WORKER_BATCH_SIZE,
+                 minimum: int = WORKER_BATCH_SIZE_MIN,
+                 maximum: int = WORKER_BATCH_SIZE_MAX,
+                 target_seconds: float = WORKER_BATCH_TARGET_SECONDS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.size = max(minimum, min(maximum, initial))
+
+    def update(self, event_count: int, duration: float) -> int:
+        """ Update the size based on the last batch. Returns the new size. """
+        if duration > self.target_seconds:
+            self.size = max(self.minimum, self.size // 2)
+        elif event_count >= self.size:
+            self.size = min(self.maximum, self.size * 2)
+        return self.size
+
+
+class Backoff:
+    """
+    Exponential backoff for polling: every consecutive sleep() sleeps twice as long as the previous one,
+    starting at minimum and up to maximum seconds. reset() starts over at minimum.
+    """
+
+    def __init__(self, minimum: float = WORKER_SLEEP_MIN_SECONDS, maximum: float = WORKER_SLEEP_SECONDS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.next_seconds = minimum
+
+    def sleep(self):
+        time.sleep(self.next_seconds)
+        self.next_seconds = min(self.maximum, self.next_seconds * 2)
+
+    def reset(self):
+        self.next_seconds = self.minimum
+
+
+class WorkWaiter:
+    """
+    Waits until there might be new work in the queues.
+
+    If listening is enabled (WORKER_LISTEN), this waits for a notification on the queues, with a timeout of
+    WORKER_SLEEP_SECONDS. Otherwise, or if listening fails, this sleeps with an exponential Backoff.
+
+    Notifications are only received once listening has started. Events that were committed after the caller
+    found no work, but before listening started, would be missed. So after starting to listen, wait() returns
+    right away, and the caller checks for work once more before waiting for notifications.
+    """
+
+    def __init__(self,
+                 pg_config: PostgresConfig,
+                 queues: Sequence[ProcessingStage],
+                 listen: bool = WORKER_LISTEN):
+        self.pg_config = pg_config
+        self.queues = queues
+        self.listen = listen and bool(queues)
+        self.backoff = Backoff()
+        self._listener: Optional[QueueListener] = None
+
+    def wait(self):
+        """ Wait for new work. Call this after finding no work. """
+        if self.listen:
+            try:
+                if self._listener is None:
+                    self._listener = QueueListener(pg_config=self.pg_config, queues=self.queues)
+                    return
+                self._listener.wait(timeout=WORKER_SLEEP_SECONDS)
+                return
+            except psycopg2.Error as exc:
+                logger.warning(f'Cannot listen for queue notifications, falling back to polling: {exc}')
+                self._close_listener()
+        self.backoff.sleep()
+
+    def reset(self):
+        """ Call this after finding work. """
+        self.backoff.reset()
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except psycopg2.Error:
+                pass
+            self._listener = None
+
+
+class StageStats:
+    """
+    Counters for the work done by the workers of one processing stage. The counters live in shared memory,
+    so they can be updated from multiple worker processes and read by the supervisor.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._events = multiprocessing.Value('q', 0)
+        self._batches = multiprocessing.Value('q', 0)
+        self._busy_seconds = multiprocessing.Value('d', 0.0)
+
+    def add_batch(self, event_count: int, duration: float):
+        with self._events.get_lock():
+            self._events.value += event_count
+        with self._batches.get_lock():
+            self._batches.value += 1
+        with self._busy_seconds.get_lock():
+            self._busy_seconds.value += duration
+
+    @property
+    def events(self) -> int:
+        return self._events.value
+
+    @property
+    def batches(self) -> int:
+        return self._batches.value
+
+    @property
+    def busy_seconds(self) -> float:
+        return self._busy_seconds.value
+
+
+def get_copy_threshold() -> int:
+    """ Get the configured copy_threshold for writing events, see PostgresConfig. """
+    pg_config = get_config_postgres()
+    return pg_config.copy_threshold if pg_config else 0
+
+
+def worker_main(function: Callable[[Any, int], int],
+                loop: bool,
+                stats: Optional[StageStats] = None,
+                queues: Sequence[ProcessingStage] = ()) -> int:
     """
     Run the function once, or in a loop.
     Will print the last part of the function's name and information about the function's execution time.
 
-    If running in a loop it will sleep a second between invocations if the function returns 0.
-    :param function: function that will be called. Should take a `connection` as arguments. The connection
-        is a db_connection as delivered by get_db_connection()
+    If running in a loop the batch size adapts to the processing time (see AdaptiveBatchSize), and if the
+    function returns 0 it will wait for new events on the queues before calling it again (see WorkWaiter).
+    :param function: function that will be called. Should take a `connection` and a maximum number of
+        events to process as arguments. The connection is a db_connection as delivered by
+        get_db_connection(), taken from the process' connection pool for each invocation.
     :param loop: whether to call the function once (False) or in an endless loop (True)
+    :param stats: optional StageStats, that will be updated after every invocation
+    :param queues: the queues that the function reads from
     :return number of processed events, if loop is False
     """
     pg_config = get_config_postgres()
     if pg_config is None:
         raise Exception('Missing Postgres configuration')
-    connection = get_db_connection(pg_config)
     name = function.__name__.split('_')[-1]
-    print(f'{name} worker')
+    logger.info(f'{name} worker')
+    batch_size = AdaptiveBatchSize()
+    waiter = WorkWaiter(pg_config=pg_config, queues=queues)
     while True:
         start = time.time()
-        event_count = function(connection)
+        with get_pooled_db_connection(pg_config) as connection:
+            event_count = function(connection, batch_size.size)
         end = time.time()
-        print(f'Processing time: {(end - start):.5} s')
+        logger.debug(f'Processing time: {(end - start):.5} s')
+        WORKER_BATCH_SECONDS.observe(end - start, worker=name)
+        WORKER_EVENTS.inc(event_count, worker=name)
+        if stats is not None:
+            stats.add_batch(event_count=event_count, duration=end - start)
         if not loop:
             return event_count
+        batch_size.update(event_count=event_count, duration=end - start)
         if event_count == 0:
-            time.sleep(1)
+            waiter.wait()
+        else:
+            waiter.reset()
@@ -1,35 +1,43 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import logging
 import sys
 import time
 from typing import List, Tuple
 
 from objectiv_backend.common.config import WORKER_BATCH_SIZE, get_collector_config
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.metrics import EVENTS, STAGE_SECONDS
 from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
 from objectiv_backend.schema.validate_events import validate_event_adheres_to_schema, validate_event_time, EventError
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
 from objectiv_backend.workers.pg_storage import insert_events_into_nok_data
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.util import worker_main, get_copy_threshold
 from objectiv_backend.common.types import EventDataList
 
+logger = get_logger(__name__)
 
-def main_entry(connection) -> int:
+
+def main_entry(connection, max_items: int = WORKER_BATCH_SIZE) -> int:
     """
     Pick events from the entry queue and insert them into the finalize queue.
+    :param connection: db connection
+    :param max_items: maximum number of events to process
     :return number of processed events
     """
+    copy_threshold = get_copy_threshold()
     with connection:
-        pg_queues = PostgresQueues(connection=connection)
-        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.ENTRY,
-                                                     max_items=WORKER_BATCH_SIZE)
-        print(f'event-ids: {sorted(event["id"] for event in events)}')
+        pg_queues = PostgresQueues(connection=connection, copy_threshold=copy_threshold)
+        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.ENTRY, max_items=max_items)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'event-ids: {sorted(event["id"] for event in events)}')
 
         ok_events, nok_events, event_errors = process_events_entry(events)
         # ok_events continue on the happy path
         # nok_events failed to validate and are written to the nok_data table
         pg_queues.put_events(queue=ProcessingStage.FINALIZE, events=ok_events)
-        insert_events_into_nok_data(connection=connection, events=nok_events)
+        insert_events_into_nok_data(connection=connection, events=nok_events, copy_threshold=copy_threshold)
     return len(events)
 
 
@@ -55,19 +63,29 @@ def process_events_entry(events: EventDataList, current_millis: int = 0) -> \
     if current_millis == 0:
         current_millis = round(time.time() * 1000)
 
+    # Validation and hydration alternate per event, add up the time of each for the whole batch
+    validate_seconds = 0.0
+    hydrate_seconds = 0.0
     for event in events:
-
+        start = time.perf_counter()
         error_info = \
             validate_event_adheres_to_schema(event_schema=event_schema, event=event) + \
             validate_event_time(event=event, current_millis=current_millis)
+        validate_seconds += time.perf_counter() - start
 
         if error_info:
-            print(f"error, event_id: {event['id']}, errors: {[ei.info for ei in error_info]}")
+            logger.info(f"error, event_id: {event['id']}, errors: {[ei.info for ei in error_info]}")
             nok_events.append(event)
             event_errors.append(EventError(event_id=event['id'], error_info=error_info))
         else:
+            start = time.perf_counter()
             event = hydrate_types_into_event(event_schema=event_schema, event=event)
+            hydrate_seconds += time.perf_counter() - start
             ok_events.append(event)
+    STAGE_SECONDS.observe(validate_seconds, stage='validate_schema')
+    STAGE_SECONDS.observe(hydrate_seconds, stage='hydrate')
+    EVENTS.inc(len(ok_events), result='ok')
+    EVENTS.inc(len(nok_events), result='nok')
     return ok_events, nok_events, event_errors
 
 
@@ -1,25 +1,39 @@
 """
 Copyright 2021 Objectiv B.V.
 """
+import logging
 import sys
 
-from objectiv_backend.common.config import WORKER_BATCH_SIZE
+from objectiv_backend.common.config import WORKER_BATCH_SIZE, get_config_postgres
+from objectiv_backend.common.log import get_logger
 from objectiv_backend.common.types import EventDataList
 from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
 from objectiv_backend.workers.pg_storage import insert_events_into_data
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.workers.recent_event_ids import get_recent_event_ids
+from objectiv_backend.workers.util import worker_main, get_copy_threshold
 
+logger = get_logger(__name__)
 
-def main_finalize(connection) -> int:
+
+def main_finalize(connection, max_items: int = WORKER_BATCH_SIZE) -> int:
     """
     Pick events from the finalize queue, and write them to the data table.
+    :param connection: db connection
+    :param max_items: maximum number of events to process
     :return number of processed events
     """
+    copy_threshold = get_copy_threshold()
+    recent_event_ids = get_recent_event_ids(get_config_postgres())
     with connection:
-        pg_queues = PostgresQueues(connection=connection)
-        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=WORKER_BATCH_SIZE)
-        print(f'event-ids: {sorted(event["id"] for event in events)}')
-        insert_events_into_data(connection, events)
+        pg_queues = PostgresQueues(connection=connection, copy_threshold=copy_threshold)
+        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.FINALIZE, max_items=max_items)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'event-ids: {sorted(event["id"] for event in events)}')
+        insert_events_into_data(connection, events, copy_threshold=copy_threshold,
+                                recent_event_ids=recent_event_ids)
+    if recent_event_ids is not None:
+        # Now that the transaction is committed, all events are in the data table
+        recent_event_ids.add(str(event['id']) for event in events)
     return len(events)
 
 
@@ -0,0 +1,50 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import logging
+import sys
+
+from objectiv_backend.common.config import WORKER_BATCH_SIZE, get_config_postgres
+from objectiv_backend.common.log import get_logger
+from objectiv_backend.common.types import EventDataList
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+from objectiv_backend.workers.pg_storage import insert_events_into_data, insert_events_into_nok_data
+from objectiv_backend.workers.recent_event_ids import get_recent_event_ids
+from objectiv_backend.workers.util import worker_main, get_copy_threshold
+from objectiv_backend.workers.worker_entry import process_events_entry
+
+logger = get_logger(__name__)
+
+
+def main_single(connection, max_items: int = WORKER_BATCH_SIZE) -> int:
+    """
+    Pick events from the entry queue, and write them to the data and nok_data tables.
+
+    This does the work of main_entry() and main_finalize() in a single transaction, without writing the
+    events to the finalize queue in between. Each event is thus written once to a queue table instead of
+    twice, which halves the queue churn (WAL volume, dead tuples to vacuum).
+    :param connection: db connection
+    :param max_items: maximum number of events to process
+    :return number of processed events
+    """
+    copy_threshold = get_copy_threshold()
+    recent_event_ids = get_recent_event_ids(get_config_postgres())
+    with connection:
+        pg_queues = PostgresQueues(connection=connection, copy_threshold=copy_threshold)
+        events: EventDataList = pg_queues.get_events(queue=ProcessingStage.ENTRY, max_items=max_items)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'event-ids: {sorted(event["id"] for event in events)}')
+
+        ok_events, nok_events, event_errors = process_events_entry(events)
+        insert_events_into_data(connection, ok_events, copy_threshold=copy_threshold,
+                                recent_event_ids=recent_event_ids)
+        insert_events_into_nok_data(connection=connection, events=nok_events, copy_threshold=copy_threshold)
+    if recent_event_ids is not None:
+        # Now that the transaction is committed, all ok events are in the data table
+        recent_event_ids.add(str(event['id']) for event in ok_events)
+    return len(events)
+
+
+if __name__ == '__main__':
+    _loop = sys.argv[1:2] == ['--loop']
+    worker_main(function=main_single, loop=_loop, queues=[ProcessingStage.ENTRY])
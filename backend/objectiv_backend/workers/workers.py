@@ -3,40 +3,73 @@ Copyright 2021 Objectiv B.V.
 """
 import argparse
 import sys
-import time
 
-from objectiv_backend.common.config import WORKER_SLEEP_SECONDS
-from objectiv_backend.workers.util import worker_main
+from objectiv_backend.common.config import get_config_postgres
+from objectiv_backend.common.metrics import REGISTRY, start_metrics_server
+from objectiv_backend.workers.pg_queues import ProcessingStage, update_queue_metrics
+from objectiv_backend.workers.supervisor import run_supervisor
+from objectiv_backend.workers.util import worker_main, WorkWaiter
 from objectiv_backend.workers.worker_entry import main_entry
 from objectiv_backend.workers.worker_finalize import main_finalize
+from objectiv_backend.workers.worker_single import main_single
 
 
 def call_all(loop: bool):
+    pg_config = get_config_postgres()
+    if pg_config is None:
+        raise Exception('Missing Postgres configuration')
+    waiter = WorkWaiter(pg_config=pg_config, queues=[ProcessingStage.ENTRY, ProcessingStage.FINALIZE])
     while True:
         event_count = worker_main(function=main_entry, loop=False)
         event_count += worker_main(function=main_finalize, loop=False)
         if not loop:
             break
         if event_count == 0:
-            # sleeping a short random time is nice for catching concurrency problems
-            # time.sleep(0.2 * random.random())
-            time.sleep(WORKER_SLEEP_SECONDS)
+            waiter.wait()
+        else:
+            waiter.reset()
+
+
+def _start_metrics_server(port: int):
+    pg_config = get_config_postgres()
+    if pg_config is not None:
+        REGISTRY.set_collect_hook('queues', lambda: update_queue_metrics(pg_config))
+    start_metrics_server(port)
 
 
 def main():
     parser = argparse.ArgumentParser(prog='worker')
     parser.add_argument('type',
-                        choices=['all', 'entry', 'finalize'],
+                        choices=['all', 'entry', 'finalize', 'single', 'supervisor'],
                         default='all',
-                        type=str)
+                        type=str,
+                        help='Which worker to run. "single" processes the entry queue and writes the events '
+                             'directly to the data tables, skipping the finalize queue. "supervisor" runs '
+                             'multiple workers in separate processes, and always loops.')
     parser.add_argument('--loop', action='store_true')
+    parser.add_argument('--entry-workers', type=int, default=1,
+                        help='Number of entry worker processes. Only used with "supervisor".')
+    parser.add_argument('--finalize-workers', type=int, default=1,
+                        help='Number of finalize worker processes. Only used with "supervisor".')
+    parser.add_argument('--single-workers', type=int, default=0,
+                        help='Number of single worker processes. Only used with "supervisor". Combine with '
+                             '"--entry-workers 0" to process all events in a single hop.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve metrics in the Prometheus text format on http://0.0.0.0:<port>/metrics')
     args = parser.parse_args(sys.argv[1:])
+    if args.metrics_port:
+        _start_metrics_server(args.metrics_port)
     if args.type == 'all':
         return call_all(args.loop)
     if args.type == 'entry':
-        return worker_main(function=main_entry, loop=args.loop)
+        return worker_main(function=main_entry, loop=args.loop, queues=[ProcessingStage.ENTRY])
     if args.type == 'finalize':
-        return worker_main(function=main_finalize, loop=args.loop)
+        return worker_main(function=main_finalize, loop=args.loop, queues=[ProcessingStage.FINALIZE])
+    if args.type == 'single':
+        return worker_main(function=main_single, loop=args.loop, queues=[ProcessingStage.ENTRY])
+    if args.type == 'supervisor':
+        return run_supervisor(entry_workers=args.entry_workers, finalize_workers=args.finalize_workers,
+                              single_workers=args.single_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import asyncio
+import gzip
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+from objectiv_backend import asgi
+from objectiv_backend.asgi import CollectorApp
+from objectiv_backend.end_points.collector import DATA_MAX_SIZE_BYTES
+from tests.schema.test_schema import CLICK_EVENT_JSON
+
+
+def _request(app: CollectorApp,
+             method: str,
+             path: str,
+             body_chunks: Optional[List[bytes]] = None,
+             headers: Optional[List[Tuple[str, str]]] = None) -> Tuple[int, Dict[str, str], bytes]:
+    """ Do a request to the ASGI app, return status, headers, and body of the response. """
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers or []],
+        'client': ('10.0.0.1', 12345),
+        'server': ('collector', 80),
+    }
+    chunks = body_chunks or [b'']
+    received: List[Dict[str, Any]] = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1} for i, chunk in enumerate(chunks)
+    ]
+    sent: List[Dict[str, Any]] = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, sent[1]['body']
+
+
+@pytest.fixture
+def app(monkeypatch):
+    written: List[Any] = []
+
+    def write_sync_events(ok_events, nok_events, event_errors):
+        written.append((ok_events, nok_events))
+        return ok_events[:app.duplicate_count]  # type: ignore
+
+    monkeypatch.setattr(asgi, 'write_sync_events', write_sync_events)
+    app = CollectorApp()
+    app.written = written  # type: ignore
+    app.duplicate_count = 0  # type: ignore
+    yield app
+    app.shutdown()
+
+
+def test_collect(app):
+    data = CLICK_EVENT_JSON.encode('utf-8')
+    status, headers, body = _request(
+        app, 'POST', '/',
+        body_chunks=[data[:100], data[100:]],
+        headers=[('Content-Type', 'application/json'), ('Origin', 'https://example.com'),
+                 ('X-Real-IP', '1.2.3.4'), ('User-Agent', 'test-agent')]
+    )
+    assert status == 200
+    assert json.loads(body)['event_count'] == 1
+    assert json.loads(body)['duplicate_count'] == 0
+    assert 'obj_user_id=' in headers['set-cookie']
+    assert headers['access-control-allow-origin'] == 'https://example.com'
+    assert headers['access-control-allow-credentials'] == 'true'
+
+    [(ok_events, nok_events)] = app.written
+    events = ok_events + nok_events
+    assert len(events) == 1
+    http_context = [c for c in events[0]['global_contexts'] if c['_type'] == 'HttpContext'][0]
+    assert http_context['remote_address'] == '1.2.3.4'
+    assert http_context['user_agent'] == 'test-agent'
+    cookie_context = [c for c in events[0]['global_contexts'] if c['_type'] == 'CookieIdContext'][0]
+    assert f'obj_user_id={cookie_context["cookie_id"]}' in headers['set-cookie']
+
+
+def test_collect_existing_cookie_compressed(app):
+    cookie_id = 'ec6a6ec0-8e2d-4e4a-9f2a-6e6f8a1b3c4d'
+    status, _, body = _request(
+        app, 'POST', '/',
+        body_chunks=[gzip.compress(CLICK_EVENT_JSON.encode('utf-8'))],
+        headers=[('Content-Encoding', 'gzip'), ('Cookie', f'obj_user_id={cookie_id}')]
+    )
+    assert status == 200
+    assert json.loads(body)['event_count'] == 1
+    [(ok_events, nok_events)] = app.written
+    event = (ok_events + nok_events)[0]
+    assert [c['cookie_id'] for c in event['global_contexts'] if c['_type'] == 'CookieIdContext'] == [cookie_id]
+
+
+def test_collect_duplicate(app):
+    # An event that was sent before isn't an error, but is reported as a duplicate
+    app.duplicate_count = 1
+    status, _, body = _request(app, 'POST', '/', body_chunks=[CLICK_EVENT_JSON.encode('utf-8')])
+    assert status == 200
+    [(ok_events, nok_events)] = app.written
+    assert len(ok_events) == 1
+    assert json.loads(body)['error_count'] == 0
+    assert json.loads(body)['duplicate_count'] == 1
+
+
+def test_collect_too_big(app):
+    chunk = b' ' * (DATA_MAX_SIZE_BYTES // 2)
+    status, _, body = _request(app, 'POST', '/', body_chunks=[chunk, chunk, chunk])
+    assert status == 200
+    assert json.loads(body)['error_count'] == 1
+    assert app.written == []
+
+
+def test_other_endpoints(app):
+    status, headers, body = _request(app, 'GET', '/schema')
+    assert status == 200
+    assert headers['content-type'] == 'application/json'
+    assert 'PressEvent' in json.loads(body)['events']
+    assert json.loads(body)['schema_version']
+    assert _request(app, 'GET', '/')[0] == 405
+    assert _request(app, 'GET', '/unknown')[0] == 404
+
+    status, headers, _ = _request(app, 'OPTIONS', '/', headers=[
+        ('Origin', 'https://example.com'),
+        ('Access-Control-Request-Method', 'POST'),
+        ('Access-Control-Request-Headers', 'content-type,content-encoding')
+    ])
+    assert status == 200
+    assert headers['access-control-allow-origin'] == 'https://example.com'
+    assert headers['access-control-allow-headers'] == 'content-type,content-encoding'
+    assert 'POST' in headers['access-control-allow-methods']
+
+
+def test_metrics(app, monkeypatch):
+    # Disabled by default
+    assert _request(app, 'GET', '/metrics')[0] == 404
+
+    monkeypatch.setattr(asgi, 'METRICS_ENDPOINT', True)
+    _request(app, 'POST', '/', body_chunks=[CLICK_EVENT_JSON.encode('utf-8')])
+    status, headers, body = _request(app, 'GET', '/metrics', headers=[('Origin', 'https://example.com')])
+    assert status == 200
+    assert headers['content-type'].startswith('text/plain; version=0.0.4')
+    # Web pages of other origins can't read the metrics
+    assert 'access-control-allow-origin' not in headers
+    text = body.decode('utf-8')
+    assert '# TYPE objectiv_collector_requests_total counter' in text
+    assert 'objectiv_collector_requests_total{result="ok"}' in text
+    assert 'objectiv_stage_seconds_count{stage="parse"}' in text
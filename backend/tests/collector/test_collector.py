@@ -1,6 +1,18 @@
+import gzip
 import json
-
-from objectiv_backend.end_points.collector import add_http_context_to_event, add_marketing_context_to_event
+import zlib
+
+import flask
+import psycopg2
+import pytest
+from flask import Flask
+
+from objectiv_backend.common.config import PostgresConfig, SpoolConfig, get_collector_config
+from objectiv_backend.end_points import collector
+from objectiv_backend.end_points.collector import add_http_context_to_event, add_marketing_context_to_event, \
+    _get_event_data, _write_to_postgres_or_spool, DATA_MAX_SIZE_BYTES
+from objectiv_backend.end_points.spool import KIND_OK
+from objectiv_backend.end_points.common import decode_body
 from objectiv_backend.common.event_utils import add_global_context_to_event, get_contexts
 from tests.schema.test_schema import CLICK_EVENT_JSON, make_event_from_dict, order_dict
 
@@ -134,3 +146,121 @@ def test_enrich_marketing_context():
 
     # check serialized jsons match for set and unset optionals
     assert json.dumps(order_dict(generated_marketing_context)) == marketing_context_json
+
+
+def test_decode_body():
+    data = CLICK_EVENT_JSON.encode('utf-8')
+    assert decode_body(data, None, max_size=len(data)) == data
+    assert decode_body(data, 'identity', max_size=len(data)) == data
+    assert decode_body(gzip.compress(data), 'gzip', max_size=len(data)) == data
+    assert decode_body(zlib.compress(data), 'deflate', max_size=len(data)) == data
+    raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    assert decode_body(raw_deflate.compress(data) + raw_deflate.flush(), 'Deflate', max_size=len(data)) == data
+    assert decode_body(zlib.compress(gzip.compress(data)), 'gzip, deflate', max_size=len(data)) == data
+
+    with pytest.raises(ValueError, match='Unsupported'):
+        decode_body(data, 'br', max_size=len(data))
+    with pytest.raises(ValueError, match='incomplete'):
+        decode_body(gzip.compress(data)[:-10], 'gzip', max_size=len(data))
+    with pytest.raises(ValueError):
+        decode_body(data, 'gzip', max_size=len(data))
+
+
+def test_decode_body_multi_member():
+    assert decode_body(gzip.compress(b'[1,') + gzip.compress(b'2]'), 'gzip', max_size=5) == b'[1,2]'
+    # The size limit applies to all members together
+    with pytest.raises(ValueError):
+        decode_body(gzip.compress(b'[1,') + gzip.compress(b'2]'), 'gzip', max_size=4)
+    with pytest.raises(ValueError):
+        decode_body(gzip.compress(b'[1,') + gzip.compress(b'2]')[:-10], 'gzip', max_size=5)
+    # Trailing data after a deflate stream is not silently dropped
+    with pytest.raises(ValueError):
+        decode_body(zlib.compress(b'[1,') + zlib.compress(b'2]'), 'deflate', max_size=5)
+
+
+def test_decode_body_size_limit():
+    # 100MB of zeros compresses to about 100KB, we should stop decompressing right after the limit
+    bomb = gzip.compress(b'0' * 100_000_000)
+    assert len(bomb) < DATA_MAX_SIZE_BYTES
+    with pytest.raises(ValueError, match='exceeds limit'):
+        decode_body(bomb, 'gzip', max_size=DATA_MAX_SIZE_BYTES)
+
+
+def test_get_event_data_compressed():
+    app = Flask(__name__)
+    data = CLICK_EVENT_JSON.encode('utf-8')
+    with app.test_request_context('/', method='POST', data=gzip.compress(data),
+                                  headers={'Content-Encoding': 'gzip'}):
+        assert _get_event_data(flask.request) == json.loads(CLICK_EVENT_JSON)
+    with app.test_request_context('/', method='POST', data=b' ' * (DATA_MAX_SIZE_BYTES + 1)):
+        with pytest.raises(ValueError, match='exceeds limit'):
+            _get_event_data(flask.request)
+
+
+class FakeSpool:
+    def __init__(self):
+        self.appended = []
+        self.rotations = 0
+
+    def append(self, records):
+        self.appended.extend(records)
+
+    def rotate(self):
+        self.rotations += 1
+
+
+class FailingWriter:
+    """ Replaces the function that writes to postgres, fails with the given error. """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def __call__(self, statement_timeout_seconds):
+        self.calls.append(statement_timeout_seconds)
+        if self.error:
+            raise self.error
+        return 'result'
+
+
+@pytest.fixture
+def spool(monkeypatch):
+    spool = FakeSpool()
+    config = get_collector_config()
+    output = config.output._replace(
+        postgres=PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                                password=''),
+        spool=SpoolConfig(directory='/nonexistent', fsync='always', segment_max_bytes=1_000_000,
+                          max_bytes=1_000_000, latency_budget_seconds=0.5, replay_interval_seconds=10)
+    )
+    monkeypatch.setattr(collector, 'get_collector_config', lambda: config._replace(output=output))
+    monkeypatch.setattr(collector, 'get_spool', lambda spool_config, pg_config: spool)
+    return spool
+
+
+def test_write_to_postgres_or_spool(spool):
+    records = [(KIND_OK, ['{"id": "a"}'])]
+    writer = FailingWriter()
+    assert _write_to_postgres_or_spool(writer, records) == 'result'
+    # Writes get the latency budget as statement timeout
+    assert writer.calls == [0.5]
+    assert spool.appended == []
+    assert spool.rotations == 1
+
+
+def test_write_to_postgres_or_spool_unavailable(spool):
+    records = [(KIND_OK, ['{"id": "a"}'])]
+    for error in (psycopg2.OperationalError('connection refused'),
+                  psycopg2.extensions.QueryCanceledError('statement timeout')):
+        spool.appended = []
+        assert _write_to_postgres_or_spool(FailingWriter(error), records) is None
+        assert spool.appended == records
+    assert spool.rotations == 0
+
+
+def test_write_to_postgres_or_spool_data_error(spool):
+    # Errors that are not about the availability of the database are not hidden by spooling the events
+    records = [(KIND_OK, ['{"id": "a"}'])]
+    with pytest.raises(psycopg2.DataError):
+        _write_to_postgres_or_spool(FailingWriter(psycopg2.DataError('invalid input')), records)
+    assert spool.appended == []
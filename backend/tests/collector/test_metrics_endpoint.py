@@ -0,0 +1,29 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from objectiv_backend.common.config import PostgresConfig, get_collector_config
+from objectiv_backend.end_points import metrics
+
+
+def test_queue_sizes_are_cached(monkeypatch):
+    pg_config = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                               password='')
+    config = get_collector_config()
+    config = config._replace(async_mode=True, output=config.output._replace(postgres=pg_config))
+    monkeypatch.setattr(metrics, 'get_collector_config', lambda: config)
+    monkeypatch.setattr(metrics, '_QUEUE_SIZES_UPDATED', 0)
+    updates = []
+
+    def update_queue_metrics(pg_config):
+        updates.append(pg_config)
+        raise Exception('database unavailable')
+    monkeypatch.setattr(metrics, 'update_queue_metrics', update_queue_metrics)
+
+    # The queue tables are counted once, also if that fails
+    metrics.get_metrics_text()
+    metrics.get_metrics_text()
+    assert updates == [pg_config]
+
+    monkeypatch.setattr(metrics, '_QUEUE_SIZES_UPDATED', metrics._QUEUE_SIZES_UPDATED - 60)
+    metrics.get_metrics_text()
+    assert len(updates) == 2
@@ -0,0 +1,108 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import glob
+import os
+from datetime import datetime
+
+from objectiv_backend.common.config import FileSystemOutputConfig, RollingFilesConfig
+from objectiv_backend.common.serialization import loads, serialize_events
+from objectiv_backend.end_points.rolling_files import FileSystemTarget, RollingFileWriter
+
+MOMENT = datetime(2022, 3, 4, 5, 6, 7)
+
+
+def _get_config(**kwargs) -> RollingFilesConfig:
+    values = dict(format='ndjson', segment_max_bytes=1_000_000, segment_max_seconds=3600, staging_directory='')
+    values.update(kwargs)
+    return RollingFilesConfig(**values)
+
+
+def _get_writer(tmp_path, **kwargs) -> RollingFileWriter:
+    target = FileSystemTarget(FileSystemOutputConfig(path=str(tmp_path)))
+    return RollingFileWriter('test', target, _get_config(**kwargs))
+
+
+def _events(*ids):
+    return serialize_events([{'id': event_id, '_type': 'PressEvent'} for event_id in ids])
+
+
+def _read_ids(path):
+    with open(path) as file:
+        return [loads(line)['id'] for line in file]
+
+
+def _published(tmp_path, prefix='OK'):
+    return sorted(glob.glob(os.path.join(str(tmp_path), prefix, '2022', '03', '04', '05', '*.ndjson')))
+
+
+def test_append_and_publish(tmp_path):
+    writer = _get_writer(tmp_path)
+    writer.append(prefix='OK', serialized_events=_events('a', 'b'), moment=MOMENT)
+    writer.append(prefix='OK', serialized_events=_events('c'), moment=MOMENT)
+    writer.append(prefix='NOK', serialized_events=_events('d'), moment=MOMENT)
+    writer.append(prefix='NOK', serialized_events=[], moment=MOMENT)
+
+    # Not visible until complete, but the hour of MOMENT is over
+    assert _published(tmp_path) == []
+    hidden = glob.glob(os.path.join(str(tmp_path), 'OK', '2022', '03', '04', '05', '.*.tmp'))
+    assert len(hidden) == 1
+
+    writer.rotate()
+    ok_files = _published(tmp_path)
+    nok_files = _published(tmp_path, prefix='NOK')
+    assert len(ok_files) == 1
+    assert _read_ids(ok_files[0]) == ['a', 'b', 'c']
+    assert len(nok_files) == 1
+    assert _read_ids(nok_files[0]) == ['d']
+    assert glob.glob(os.path.join(str(tmp_path), '**', '.*.tmp'), recursive=True) == []
+
+
+def test_segment_max_bytes(tmp_path):
+    writer = _get_writer(tmp_path, segment_max_bytes=30)
+    for event_id in 'abc':
+        writer.append(prefix='OK', serialized_events=_events(event_id), moment=MOMENT)
+    writer.close()
+    files = _published(tmp_path)
+    assert len(files) == 3
+    assert [_read_ids(path) for path in files] == [['a'], ['b'], ['c']]
+
+
+def test_segments_per_hour(tmp_path):
+    writer = _get_writer(tmp_path)
+    writer.append(prefix='OK', serialized_events=_events('a'), moment=MOMENT)
+    writer.append(prefix='OK', serialized_events=_events('b'), moment=MOMENT.replace(hour=6))
+    writer.close()
+    assert [_read_ids(path) for path in _published(tmp_path)] == [['a']]
+    files = glob.glob(os.path.join(str(tmp_path), 'OK', '2022', '03', '04', '06', '*.ndjson'))
+    assert [_read_ids(path) for path in files] == [['b']]
+
+
+class FlakyTarget:
+    """ Target that fails to publish the first time. """
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.attempts = 0
+        self.published = []
+
+    def get_staging_path(self, prefix, hour, filename):
+        return os.path.join(str(self.tmp_path), f'.{prefix}-{filename}.tmp')
+
+    def publish(self, staging_path, prefix, hour, filename):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise Exception('upload failed')
+        self.published.append((prefix, _read_ids(staging_path)))
+        os.remove(staging_path)
+
+
+def test_publish_retries(tmp_path):
+    target = FlakyTarget(tmp_path)
+    writer = RollingFileWriter('test', target, _get_config())
+    writer.append(prefix='RAW', serialized_events=_events('a'), moment=MOMENT)
+    writer.close()
+    assert target.published == []
+    writer.close()
+    assert target.published == [('RAW', ['a'])]
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,71 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import threading
+import time
+
+from objectiv_backend.common.config import AsyncSinksConfig
+from objectiv_backend.end_points import sink_dispatcher
+from objectiv_backend.end_points.sink_dispatcher import BatchingSink
+
+
+def _get_config(**kwargs) -> AsyncSinksConfig:
+    values = dict(batch_max_events=3, batch_max_seconds=0.05, queue_max_events=100,
+                  queue_timeout_seconds=0.1, max_retries=2)
+    values.update(kwargs)
+    return AsyncSinksConfig(**values)
+
+
+def test_batching_sink_batches():
+    batches = []
+    sink = BatchingSink('test', batches.append, _get_config())
+    assert sink.submit(list(range(7))) == 0
+    sink.close(timeout=5)
+    assert [item for batch in batches for item in batch] == list(range(7))
+    assert all(len(batch) <= 3 for batch in batches)
+    assert len(batches) >= 3
+
+
+def test_batching_sink_retries(monkeypatch):
+    monkeypatch.setattr(sink_dispatcher, '_MAX_RETRY_SLEEP_SECONDS', 0)
+    attempts = []
+
+    def write_batch(batch):
+        attempts.append(batch)
+        if len(attempts) < 3:
+            raise Exception('failure')
+
+    sink = BatchingSink('test', write_batch, _get_config())
+    sink.submit(['a'])
+    sink.close(timeout=5)
+    assert attempts == [['a'], ['a'], ['a']]
+
+    # give up after max_retries
+    attempts.clear()
+
+    def always_fail(batch):
+        attempts.append(batch)
+        raise Exception('failure')
+
+    sink = BatchingSink('test', always_fail, _get_config(max_retries=1))
+    sink.submit(['b'])
+    sink.close(timeout=5)
+    assert attempts == [['b'], ['b']]
+
+
+def test_batching_sink_drops_when_full():
+    blocked = threading.Event()
+    written = []
+
+    def write_batch(batch):
+        blocked.wait()
+        written.extend(batch)
+
+    sink = BatchingSink('test', write_batch, _get_config(batch_max_events=1, queue_max_events=2))
+    # the first item is taken by the writer thread, which then blocks
+    sink.submit(['first'])
+    time.sleep(0.1)
+    assert sink.submit(['a', 'b', 'c', 'd']) == 2
+    blocked.set()
+    sink.close(timeout=5)
+    assert written == ['first', 'a', 'b']
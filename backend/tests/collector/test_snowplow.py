@@ -1,9 +1,16 @@
 import json
 import jsonschema
 import base64
+import time
 from objectiv_backend.snowplow.schema.ttypes import CollectorPayload
+from concurrent.futures import Future
+
+import pytest
+
+from objectiv_backend.snowplow import snowplow_helper
 from objectiv_backend.snowplow.snowplow_helper import make_snowplow_custom_context, \
-    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, snowplow_schema_violation_json
+    objectiv_event_to_snowplow, objectiv_event_to_snowplow_payload, snowplow_schema_violation_json, \
+    put_records_to_kinesis, send_messages_to_sqs, publish_to_pubsub
 from tests.schema.test_schema import CLICK_EVENT_JSON, make_event_from_dict
 from objectiv_backend.common.config import SnowplowConfig
 from objectiv_backend.schema.validate_events import EventError, ErrorInfo
@@ -99,3 +106,121 @@ def test_snowplow_failed_event():
         instance = violation['data']
 
         jsonschema.validate(instance=instance, schema=schema,)
+
+
+class FakeKinesisClient:
+    """ Stand-in for a boto3 Kinesis client, that throttles the first record of the first requests. """
+
+    def __init__(self, throttled_requests=1):
+        self.requests = []
+        self.throttled_requests = throttled_requests
+        self.delivered = []
+
+    def put_records(self, StreamName, Records):
+        self.requests.append([record['Data'] for record in Records])
+        results = []
+        for index, record in enumerate(Records):
+            if index == 0 and len(self.requests) <= self.throttled_requests:
+                results.append({'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'})
+            else:
+                self.delivered.append(record['Data'])
+                results.append({'SequenceNumber': '1', 'ShardId': 'shard-1'})
+        return {'FailedRecordCount': sum('ErrorCode' in result for result in results), 'Records': results}
+
+
+class FakeSqsClient:
+    """ Stand-in for a boto3 SQS client, with a server-side failure for the first entry, and rejecting 'bad'. """
+
+    def __init__(self):
+        self.requests = []
+        self.delivered = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.requests.append([entry['MessageBody'] for entry in Entries])
+        failed = []
+        for index, entry in enumerate(Entries):
+            if entry['MessageBody'] == 'bad':
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'})
+            elif index == 0 and len(self.requests) == 1:
+                failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+            else:
+                self.delivered.append(entry['MessageBody'])
+        return {'Successful': [], 'Failed': failed}
+
+
+class FakePublisher:
+    """ Stand-in for a PubSub PublisherClient, where the first publish fails. """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic_path, data):
+        future = Future()
+        if not self.published:
+            future.set_exception(Exception('unavailable'))
+        else:
+            future.set_result('message-id')
+        self.published.append(data)
+        return future
+
+
+@pytest.fixture
+def no_retry_sleep(monkeypatch):
+    monkeypatch.setattr(snowplow_helper, '_MAX_RETRY_SLEEP_SECONDS', 0)
+
+
+def test_put_records_to_kinesis(no_retry_sleep):
+    client = FakeKinesisClient()
+    records = [str(index).encode('utf-8') for index in range(1200)]
+    assert put_records_to_kinesis(client, stream_name='raw', records=records) == 0
+    assert sorted(client.delivered) == sorted(records)
+    # 3 batches within the limit of 500 records, and a retry of the throttled record
+    assert [len(request) for request in client.requests] == [500, 1, 500, 200]
+
+    client = FakeKinesisClient(throttled_requests=100)
+    assert put_records_to_kinesis(client, stream_name='raw', records=[b'a', b'b']) == 1
+    assert client.delivered == [b'b']
+    assert len(client.requests) == snowplow_helper._MAX_ATTEMPTS
+
+
+def test_put_records_to_kinesis_max_bytes(no_retry_sleep, monkeypatch):
+    monkeypatch.setattr(snowplow_helper, '_KINESIS_BATCH_MAX_BYTES', 30)
+    client = FakeKinesisClient(throttled_requests=0)
+    assert put_records_to_kinesis(client, stream_name='raw', records=[b'a' * 10, b'b' * 10, b'c' * 50]) == 0
+    assert [len(request) for request in client.requests] == [1, 1, 1]
+
+
+def test_send_messages_to_sqs(no_retry_sleep):
+    client = FakeSqsClient()
+    messages = [f'message-{index}' for index in range(15)] + ['bad']
+    assert send_messages_to_sqs(client, queue_url='https://sqs.test', messages=messages) == 1
+    assert sorted(client.delivered) == sorted(messages[:-1])
+    # batches of at most 10 messages, and a retry of the failed message
+    assert [len(request) for request in client.requests] == [10, 1, 6]
+
+
+def test_publish_to_pubsub(no_retry_sleep):
+    publisher = FakePublisher()
+    assert publish_to_pubsub(publisher, 'projects/p/topics/t', [b'a', b'b']) == 0
+    assert publisher.published == [b'a', b'b', b'a']
+
+
+class HangingPublisher:
+    """ Stand-in for a PubSub PublisherClient, where messages are never published. """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic_path, data):
+        self.published.append(data)
+        return Future()
+
+
+def test_publish_to_pubsub_timeout(no_retry_sleep):
+    publisher = HangingPublisher()
+    start = time.monotonic()
+    messages = [str(index).encode('utf-8') for index in range(10)]
+    assert publish_to_pubsub(publisher, 'projects/p/topics/t', messages, timeout_seconds=0.1, max_attempts=2) == 10
+    # The timeout is for all messages of an attempt together, not per message
+    assert time.monotonic() - start < 1
+    assert len(publisher.published) == 20
@@ -0,0 +1,126 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import glob
+import os
+
+import pytest
+
+from objectiv_backend.common.config import PostgresConfig, SpoolConfig
+from objectiv_backend.common.serialization import serialize_events
+from objectiv_backend.end_points import spool as spool_module
+from objectiv_backend.end_points.spool import KIND_ENTRY, KIND_NOK, KIND_OK, Spool, SpoolFull, \
+    get_spool_size, replay_spool
+
+PG_CONFIG = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                           password='')
+
+
+class FakeWriter:
+    """ Replaces _write_records(), keeps track of the written records. """
+
+    def __init__(self):
+        self.written = []
+        self.fail_after = None
+
+    def __call__(self, records, pg_config):
+        if self.fail_after is not None and len(self.written) >= self.fail_after:
+            raise spool_module.psycopg2.OperationalError('database unavailable')
+        self.written.append(records)
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(spool_module, '_write_records', writer)
+    return writer
+
+
+def _get_spool(directory, **kwargs) -> Spool:
+    values = dict(directory=str(directory), fsync='always', segment_max_bytes=1_000_000, max_bytes=1_000_000,
+                  latency_budget_seconds=0, replay_interval_seconds=10)
+    values.update(kwargs)
+    return Spool(SpoolConfig(**values))
+
+
+def _events(*ids):
+    return [{'id': event_id, '_type': 'PressEvent'} for event_id in ids]
+
+
+def _segments(directory):
+    return sorted(glob.glob(os.path.join(str(directory), '*.spool')))
+
+
+def test_append_and_replay(tmp_path, writer):
+    spool = _get_spool(tmp_path)
+    spool.append([(KIND_OK, serialize_events(_events('a', 'b'))), (KIND_NOK, serialize_events(_events('c')))])
+    spool.append([(KIND_ENTRY, serialize_events(_events('d'))), (KIND_NOK, [])])
+    assert len(_segments(tmp_path)) == 1
+
+    # The segment is still being written, replay must skip it
+    assert replay_spool(str(tmp_path), PG_CONFIG) == 0
+    assert writer.written == []
+
+    spool.rotate()
+    assert replay_spool(str(tmp_path), PG_CONFIG) == 4
+    assert writer.written == [[(KIND_OK, _events('a', 'b')), (KIND_NOK, _events('c')), (KIND_ENTRY, _events('d'))]]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_rotate_min_idle(tmp_path):
+    spool = _get_spool(tmp_path)
+    spool.append([(KIND_OK, serialize_events(_events('a')))])
+    spool.rotate(min_idle_seconds=60)
+    assert spool._file is not None
+    spool.rotate(min_idle_seconds=0)
+    assert spool._file is None
+
+
+def test_segment_max_bytes(tmp_path, writer):
+    spool = _get_spool(tmp_path, segment_max_bytes=50)
+    for event_id in 'abc':
+        spool.append([(KIND_OK, serialize_events(_events(event_id)))])
+    spool.rotate()
+    assert len(_segments(tmp_path)) == 3
+    assert replay_spool(str(tmp_path), PG_CONFIG) == 3
+    # segments are replayed in the order they were written
+    assert [records[0][1][0]['id'] for records in writer.written] == ['a', 'b', 'c']
+
+
+def test_max_bytes(tmp_path):
+    spool = _get_spool(tmp_path, max_bytes=60)
+    spool.append([(KIND_OK, serialize_events(_events('a')))])
+    with pytest.raises(SpoolFull):
+        spool.append([(KIND_OK, serialize_events(_events('b')))])
+    spool.rotate()
+    assert get_spool_size(str(tmp_path)) < 60
+
+
+def test_replay_resumes_from_offset(tmp_path, writer, monkeypatch):
+    monkeypatch.setattr(spool_module, '_REPLAY_BATCH_MAX_EVENTS', 1)
+    spool = _get_spool(tmp_path)
+    for event_id in 'abc':
+        spool.append([(KIND_OK, serialize_events(_events(event_id)))])
+    spool.rotate()
+
+    writer.fail_after = 1
+    with pytest.raises(spool_module.psycopg2.OperationalError):
+        replay_spool(str(tmp_path), PG_CONFIG)
+    assert len(_segments(tmp_path)) == 1
+
+    writer.fail_after = None
+    assert replay_spool(str(tmp_path), PG_CONFIG) == 2
+    assert [records[0][1][0]['id'] for records in writer.written] == ['a', 'b', 'c']
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_replay_skips_broken_records(tmp_path, writer):
+    path = os.path.join(str(tmp_path), '00000000000000000001-1-000001.spool')
+    with open(path, 'wb') as file:
+        file.write(b'ok\t[{"id": "a"}]\n')
+        file.write(b'unknown\t[{"id": "b"}]\n')
+        file.write(b'ok\tnot json\n')
+        file.write(b'ok\t[{"id": "c"}]\n')
+        file.write(b'ok\t[{"id": "d"')
+    assert replay_spool(str(tmp_path), PG_CONFIG) == 2
+    assert writer.written == [[(KIND_OK, [{'id': 'a'}]), (KIND_OK, [{'id': 'c'}])]]
@@ -0,0 +1,156 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.end_points import write_coalescer
+from objectiv_backend.end_points.write_coalescer import WriteCoalescer
+
+
+class FakeConnection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeStorage:
+    """ Replaces the database functions, keeps track of the transactions and the stored event ids. """
+
+    def __init__(self):
+        self.transactions = []
+        self.data_ids = set()
+        self.fail_on_id = None
+        # If set, every write fails with this error
+        self.error = None
+        self.attempts = 0
+        # Writes block while this is cleared
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+
+    @contextmanager
+    def get_pooled_db_connection(self, pg_config):
+        yield FakeConnection()
+
+    def insert_events_into_data(self, connection, events, copy_threshold, serialized_events, recent_event_ids):
+        assert len(events) == len(serialized_events)
+        self.attempts += 1
+        self.unblocked.wait(timeout=5)
+        if self.error:
+            raise self.error
+        if any(event['id'] == self.fail_on_id for event in events):
+            raise Exception('failure')
+        duplicates = []
+        for event in events:
+            if event['id'] in self.data_ids:
+                duplicates.append(event)
+            self.data_ids.add(event['id'])
+        self.transactions.append([event['id'] for event in events])
+        return duplicates
+
+    def insert_events_into_nok_data(self, connection, events, copy_threshold, serialized_events):
+        pass
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    for name in ('get_pooled_db_connection', 'insert_events_into_data', 'insert_events_into_nok_data'):
+        monkeypatch.setattr(write_coalescer, name, getattr(storage, name))
+    monkeypatch.setattr(write_coalescer, 'set_local_statement_timeout', lambda connection, seconds: None)
+    return storage
+
+
+def _get_config(**kwargs) -> PostgresConfig:
+    values = dict(hostname='localhost', port=5432, database_name='objectiv', user='objectiv', password='',
+                  coalesce_millis=100, coalesce_max_events=1000)
+    values.update(kwargs)
+    return PostgresConfig(**values)
+
+
+def _write_concurrently(coalescer: WriteCoalescer, requests):
+    """ Write the ok events of each request in a separate thread, return the result or error per request. """
+    results = [None] * len(requests)
+
+    def write(index):
+        try:
+            results[index] = coalescer.write(ok_events=requests[index], nok_events=[])
+        except Exception as exc:
+            results[index] = exc
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+def test_coalesce(storage):
+    coalescer = WriteCoalescer(_get_config())
+    storage.data_ids.add('old')
+    requests = [[{'id': f'{i}'}] for i in range(10)] + [[{'id': 'old'}, {'id': 'new'}]]
+    results = _write_concurrently(coalescer, requests)
+    assert len(storage.transactions) < len(requests)
+    assert sorted(id for transaction in storage.transactions for id in transaction) == \
+           sorted([f'{i}' for i in range(10)] + ['old', 'new'])
+    # every request gets its own duplicates
+    assert results[:10] == [[]] * 10
+    assert results[10] == [{'id': 'old'}]
+
+
+def test_coalesce_max_events(storage):
+    # A full batch is written right away, instead of after coalesce_millis
+    coalescer = WriteCoalescer(_get_config(coalesce_millis=60_000, coalesce_max_events=2))
+    start = time.monotonic()
+    assert coalescer.write(ok_events=[{'id': 'a'}, {'id': 'b'}], nok_events=[]) == []
+    assert time.monotonic() - start < 5
+    assert storage.transactions == [['a', 'b']]
+
+
+def test_coalesce_failure(storage):
+    coalescer = WriteCoalescer(_get_config())
+    storage.fail_on_id = 'bad'
+    requests = [[{'id': 'a'}], [{'id': 'bad'}], [{'id': 'b'}]]
+    results = _write_concurrently(coalescer, requests)
+    # Only the request with the failing event fails
+    assert results[0] == []
+    assert isinstance(results[1], Exception)
+    assert results[2] == []
+    assert storage.data_ids == {'a', 'b'}
+
+
+def test_coalesce_database_unavailable(storage):
+    # If the database is unavailable, writing the requests one by one won't help. All requests fail at once.
+    coalescer = WriteCoalescer(_get_config(coalesce_millis=60_000, coalesce_max_events=3))
+    storage.error = psycopg2.OperationalError('connection refused')
+    requests = [[{'id': 'a'}], [{'id': 'b'}], [{'id': 'c'}]]
+    results = _write_concurrently(coalescer, requests)
+    assert all(isinstance(result, psycopg2.OperationalError) for result in results)
+    assert storage.attempts == 1
+
+
+def test_coalesce_timeout(storage):
+    # Requests don't wait longer than coalesce_millis plus twice the statement timeout
+    coalescer = WriteCoalescer(_get_config(coalesce_millis=10), statement_timeout_seconds=0.1)
+    storage.unblocked.clear()
+    start = time.monotonic()
+    results = _write_concurrently(coalescer, [[{'id': 'a'}]])
+    # The second request waits in the queue while the first batch is being written
+    results += _write_concurrently(coalescer, [[{'id': 'b'}]])
+    assert all(isinstance(result, write_coalescer.WriteTimeout) for result in results)
+    assert all(isinstance(result, psycopg2.OperationalError) for result in results)
+    assert time.monotonic() - start < 2
+
+    # The first batch was already being written, so it still completes. The second request gave up before
+    # its batch was started, so its events are never written.
+    storage.unblocked.set()
+    assert coalescer.write(ok_events=[{'id': 'c'}], nok_events=[]) == []
+    assert storage.transactions == [['a'], ['c']]
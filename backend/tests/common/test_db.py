@@ -0,0 +1,158 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from objectiv_backend.common import db
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.db import ConnectionPool, copy_rows
+
+
+class FakeConnectionInfo:
+    transaction_status = TRANSACTION_STATUS_IDLE
+
+
+class FakeConnectionCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, query):
+        if self.connection.server_closed:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.connection.queries.append(query)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.info = FakeConnectionInfo()
+        self.rollback_count = 0
+        self.server_closed = False
+        self.queries = []
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self):
+        return FakeConnectionCursor(self)
+
+    def rollback(self):
+        self.rollback_count += 1
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+
+PG_CONFIG = PostgresConfig(hostname='localhost', port=5432, database_name='test', user='test', password='',
+                           pool_min_size=1, pool_max_size=2, pool_timeout_seconds=0.01)
+
+
+@pytest.fixture
+def fake_connections(monkeypatch):
+    created = []
+
+    def fake_get_db_connection(pg_config):
+        connection = FakeConnection()
+        created.append(connection)
+        return connection
+    monkeypatch.setattr(db, 'get_db_connection', fake_get_db_connection)
+    return created
+
+
+def test_pool_reuses_connections(fake_connections):
+    pool = ConnectionPool(PG_CONFIG)
+    assert len(fake_connections) == 1
+    with pool.connection() as connection:
+        assert connection is fake_connections[0]
+    with pool.connection() as connection:
+        assert connection is fake_connections[0]
+    assert len(fake_connections) == 1
+
+
+def test_pool_max_size(fake_connections):
+    pool = ConnectionPool(PG_CONFIG)
+    connection1 = pool.get_connection()
+    connection2 = pool.get_connection()
+    assert connection1 is not connection2
+    with pytest.raises(Exception, match='No database connection available'):
+        pool.get_connection()
+    pool.put_connection(connection2)
+    assert pool.get_connection() is connection2
+
+
+def test_pool_health_check(fake_connections):
+    pool = ConnectionPool(PG_CONFIG)
+    with pool.connection() as connection:
+        connection.close()
+    # closed connection is replaced by a new one
+    with pool.connection() as connection:
+        assert connection is fake_connections[1]
+        connection.info.transaction_status = TRANSACTION_STATUS_INTRANS
+    # open transactions are rolled back when a connection is given back
+    assert fake_connections[1].rollback_count == 1
+
+
+def test_pool_checks_idle_connections(fake_connections):
+    pool = ConnectionPool(PG_CONFIG._replace(pool_check_idle_seconds=0))
+    with pool.connection() as connection:
+        assert connection is fake_connections[0]
+    assert fake_connections[0].queries == ['select 1']
+
+    # a connection that was closed by the server is replaced
+    fake_connections[0].server_closed = True
+    with pool.connection() as connection:
+        assert connection is fake_connections[1]
+    assert fake_connections[0].closed
+
+    # recently used connections are not checked
+    pool = ConnectionPool(PG_CONFIG._replace(pool_check_idle_seconds=3600))
+    with pool.connection() as connection:
+        assert connection.queries == []
+
+
+def test_pool_discard_on_error(fake_connections):
+    pool = ConnectionPool(PG_CONFIG)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            raise psycopg2.OperationalError('connection lost')
+    assert fake_connections[0].closed
+    with pool.connection() as connection:
+        assert connection is fake_connections[1]
+
+
+def test_get_db_connection_timeout(monkeypatch):
+    timeouts = []
+
+    def fake_connect(**kwargs):
+        timeouts.append(kwargs['connect_timeout'])
+        raise psycopg2.OperationalError('timeout expired')
+    monkeypatch.setattr(db.psycopg2, 'connect', fake_connect)
+    for connect_timeout_seconds in (0.5, 2.5, 10):
+        with pytest.raises(psycopg2.OperationalError):
+            db.get_db_connection(PG_CONFIG._replace(connect_timeout_seconds=connect_timeout_seconds))
+    # libpq takes whole seconds, and at least 2
+    assert timeouts == [2, 3, 10]
+
+
+class FakeCursor:
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        self.data = file.read()
+
+
+def test_copy_rows():
+    cursor = FakeCursor()
+    rows = [
+        ('id1', None, '{"a": "tab\\there"}'),
+        ('id2', 12, 'line\nbreak\\'),
+    ]
+    copy_rows(cursor, table_name='test', columns=('x', 'y', 'z'), rows=rows)
+    assert cursor.sql == 'copy test (x, y, z) from stdin'
+    assert cursor.data == 'id1\t\\N\t{"a": "tab\\\\there"}\n' \
+                          'id2\t12\tline\\nbreak\\\\\n'
@@ -0,0 +1,53 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import pytest
+
+from objectiv_backend.common.event_utils import ContextIndex, add_global_context_to_event, get_context, \
+    get_contexts, get_optional_context
+
+
+def _get_event():
+    return {
+        'id': 'a',
+        '_type': 'ClickEvent',
+        'global_contexts': [
+            {'id': 'http', '_type': 'HttpContext', '_types': ['AbstractContext', 'HttpContext']},
+            {'id': 'cookie', '_type': 'CookieIdContext'},
+        ],
+        'location_stack': [
+            {'id': 'root', '_type': 'RootLocationContext',
+             '_types': ['AbstractContext', 'AbstractLocationContext', 'RootLocationContext']},
+            {'id': 'button', '_type': 'PressableContext',
+             '_types': ['AbstractContext', 'AbstractLocationContext', 'PressableContext']},
+        ]
+    }
+
+
+@pytest.mark.parametrize('context_type', [
+    'HttpContext', 'CookieIdContext', 'PressableContext', 'AbstractLocationContext', 'AbstractContext',
+    'PathContext'
+])
+def test_context_index_matches_functions(context_type):
+    event = _get_event()
+    index = ContextIndex(event)
+    assert index.get_contexts(context_type) == get_contexts(event, context_type)
+    assert index.get_optional_context(context_type) == get_optional_context(event, context_type)
+
+
+def test_context_index_order():
+    index = ContextIndex(_get_event())
+    assert [c['id'] for c in index.get_contexts('AbstractContext')] == ['http', 'root', 'button']
+    assert index.get_context('AbstractLocationContext')['id'] == 'root'
+    with pytest.raises(ValueError):
+        index.get_context('PathContext')
+
+
+def test_add_global_context_updates_index():
+    event = _get_event()
+    index = ContextIndex(event)
+    path_context = {'id': 'path', '_type': 'PathContext', '_types': ['AbstractContext', 'PathContext']}
+    add_global_context_to_event(event, path_context, index=index)  # type: ignore
+    assert index.get_context('PathContext') is path_context
+    assert get_context(event, 'PathContext') is path_context
+    assert index.get_contexts('AbstractContext') == get_contexts(event, 'AbstractContext')
@@ -0,0 +1,69 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import pytest
+
+from objectiv_backend.common.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    counter = Counter('test_total', 'Test "counter"\nwith two lines', ['result'], registry=registry)
+    gauge = Gauge('test_size', 'Test gauge', registry=registry)
+    counter.inc(result='ok')
+    counter.inc(2, result='ok')
+    counter.inc(result='a"b')
+    gauge.set(5)
+    gauge.inc(-2)
+    assert counter.get(result='ok') == 3
+    assert registry.render() == (
+        '# HELP test_total Test "counter"\\nwith two lines\n'
+        '# TYPE test_total counter\n'
+        'test_total{result="a\\"b"} 1\n'
+        'test_total{result="ok"} 3\n'
+        '# HELP test_size Test gauge\n'
+        '# TYPE test_size gauge\n'
+        'test_size 3\n'
+    )
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram('test_seconds', 'Test histogram', ['stage'], buckets=[1, 0.1], registry=registry)
+    for value in (0.05, 0.5, 0.1, 3):
+        histogram.observe(value, stage='parse')
+    with histogram.time(stage='enrich'):
+        pass
+    assert histogram.get_count(stage='parse') == 4
+    assert histogram.get_count(stage='enrich') == 1
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{stage="parse",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{stage="parse",le="1"} 3' in lines
+    assert 'test_seconds_bucket{stage="parse",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{stage="parse"} 3.65' in lines
+    assert 'test_seconds_count{stage="parse"} 4' in lines
+    assert 'test_seconds_count{stage="enrich"} 1' in lines
+
+
+def test_labels_and_registration():
+    registry = Registry()
+    counter = Counter('test_total', 'Test counter', ['result'], registry=registry)
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(result='ok', other='x')
+    with pytest.raises(ValueError):
+        Counter('test_total', 'Same name', registry=registry)
+
+
+def test_collect_hook():
+    registry = Registry()
+    gauge = Gauge('test_queue_events', 'Test gauge', ['queue'], registry=registry)
+    registry.set_collect_hook('queues', lambda: gauge.set(7, queue='entry'))
+    assert 'test_queue_events{queue="entry"} 7' in registry.render()
+
+    def broken_hook():
+        raise Exception('database unavailable')
+    # A failing hook doesn't prevent rendering the other metrics
+    registry.set_collect_hook('queues', broken_hook)
+    assert 'test_queue_events{queue="entry"} 7' in registry.render()
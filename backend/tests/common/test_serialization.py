@@ -0,0 +1,47 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import json
+
+import pytest
+
+from objectiv_backend.common import serialization
+from objectiv_backend.common.serialization import dumps, loads, serialize_events, get_serialized_events, \
+    join_serialized_events
+
+EVENTS = [
+    {'id': 'a', '_type': 'ClickEvent', 'time': 1630049334860, 'location_stack': [{'id': 'é', '_type': 'X'}]},
+    {'id': 'b', '_type': 'ClickEvent', 'time': 1630049334861, 'location_stack': []},
+]
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def backend(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(serialization, 'orjson', None)
+    elif serialization.orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
+def test_dumps_loads(backend):
+    for event in EVENTS:
+        assert loads(dumps(event)) == event
+        assert json.loads(dumps(event)) == event
+    assert loads(dumps(EVENTS).encode('utf-8')) == EVENTS
+    # more than 64 bits: not supported by orjson, but supported by json
+    big = {'value': 2 ** 70}
+    assert loads(dumps(big)) == big
+    with pytest.raises(ValueError):
+        loads('{"id": ')
+
+
+def test_serialized_events(backend):
+    serialized = serialize_events(EVENTS)
+    assert [loads(event) for event in serialized] == EVENTS
+    assert loads(join_serialized_events(serialized)) == EVENTS
+    assert loads(join_serialized_events([])) == []
+    assert get_serialized_events(EVENTS, serialized) is serialized
+    assert get_serialized_events(EVENTS, None) == serialized
+    with pytest.raises(ValueError):
+        get_serialized_events(EVENTS, serialized[:1])
@@ -148,6 +148,17 @@ def test_all_parent_context_types():
            {'BaseContext', 'OtherContext', 'ExtraContext'}
 
 
+def test_sorted_parent_types():
+    schema = _get_schema()
+    assert schema.get_sorted_parent_event_types('GrandChildEvent') == \
+           ('BaseEvent', 'Child2Event', 'ChildEvent', 'GrandChildEvent')
+    assert schema.get_sorted_parent_context_types('X') == ('X',)
+    assert schema.get_sorted_parent_context_types('ExtraContext') == \
+           ('BaseContext', 'ExtraContext', 'OtherContext')
+    with pytest.raises(ValueError):
+        schema.get_sorted_parent_event_types('XEvent')
+
+
 def test_all_child_context_types():
     schema = _get_schema()
     assert schema.get_all_child_context_types('X') == set()
@@ -209,6 +220,22 @@ def test_optional_property():
     assert other_context['required'] == ['id', 'other_property']
 
 
+def test_compiled_validators():
+    schema = _get_schema()
+    assert schema.get_event_validator('NonExistingEvent') is None
+    assert schema.get_context_validator('NonExistingContext') is None
+
+    validator = schema.get_context_validator('OtherContext')
+    # validators are built once, and shared between calls
+    assert validator is schema.get_context_validator('OtherContext')
+    assert validator.schema == schema.get_context_schema('OtherContext')
+    assert validator.is_valid({'id': 'x', 'other_property': 1, 'optional_property': None})
+    assert not validator.is_valid({'id': 'x'})
+
+    event_validator = schema.get_event_validator('GreatGrandChildEvent')
+    assert event_validator.schema == schema.get_event_schema('GreatGrandChildEvent')
+
+
 # ### Below are helper functions and test data
 def _get_schema() -> EventSchema:
 
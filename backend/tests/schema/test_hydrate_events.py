@@ -0,0 +1,30 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import json
+
+from objectiv_backend.schema.hydrate_events import hydrate_types_into_event
+from tests.schema.test_schema import CLICK_EVENT_JSON, EVENT_SCHEMA
+
+
+def test_hydrate_types_into_event():
+    event = json.loads(CLICK_EVENT_JSON)['events'][0]
+    hydrate_types_into_event(EVENT_SCHEMA, event)
+    assert event['_types'] == sorted(EVENT_SCHEMA.get_all_parent_event_types('PressEvent'))
+    assert 'InteractiveEvent' in event['_types']
+    for context in event['global_contexts'] + event['location_stack']:
+        assert context['_types'] == sorted(EVENT_SCHEMA.get_all_parent_context_types(context['_type']))
+    assert event['location_stack'][0]['_types'] == \
+           ['AbstractContext', 'AbstractLocationContext', 'RootLocationContext']
+
+
+def test_hydrate_types_into_event_not_shared():
+    event1 = json.loads(CLICK_EVENT_JSON)['events'][0]
+    event2 = json.loads(CLICK_EVENT_JSON)['events'][0]
+    hydrate_types_into_event(EVENT_SCHEMA, event1)
+    hydrate_types_into_event(EVENT_SCHEMA, event2)
+    event1['_types'].append('X')
+    event1['location_stack'][0]['_types'].append('X')
+    assert 'X' not in event2['_types']
+    assert 'X' not in event2['location_stack'][0]['_types']
+    assert 'X' not in EVENT_SCHEMA.get_sorted_parent_event_types('PressEvent')
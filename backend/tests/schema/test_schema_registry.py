@@ -0,0 +1,51 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import os
+import shutil
+
+from objectiv_backend.schema.schema_registry import SchemaRegistry
+
+SCHEMA_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'test_data', 'schemas1')
+
+
+def test_reload(tmp_path):
+    shutil.copy(os.path.join(SCHEMA_DIRECTORY, 'extension1.json'), str(tmp_path))
+    changes = []
+    registry = SchemaRegistry(str(tmp_path), on_change=lambda schema, version: changes.append((schema, version)))
+    old_schema, old_version = registry.event_schema, registry.version
+    assert old_schema.events.is_valid_event_type('NewEvent')
+    assert not old_schema.events.is_valid_event_type('New2Event')
+    assert not registry.reload()
+
+    # Files that are not schema extensions are ignored
+    with open(os.path.join(str(tmp_path), 'README.md'), 'w') as file:
+        file.write('not a schema')
+    assert not registry.reload()
+
+    shutil.copy(os.path.join(SCHEMA_DIRECTORY, 'extension2.json'), str(tmp_path))
+    assert registry.reload()
+    assert registry.version != old_version
+    assert registry.event_schema.events.is_valid_event_type('New2Event')
+    assert registry.event_schema.get_event_validator('New2Event') is not None
+    assert changes == [(registry.event_schema, registry.version)]
+    # The old schema is not modified
+    assert not old_schema.events.is_valid_event_type('New2Event')
+
+
+def test_reload_invalid(tmp_path):
+    shutil.copy(os.path.join(SCHEMA_DIRECTORY, 'extension1.json'), str(tmp_path))
+    registry = SchemaRegistry(str(tmp_path))
+    schema, version = registry.event_schema, registry.version
+
+    with open(os.path.join(str(tmp_path), 'extension2.json'), 'w') as file:
+        file.write('{"events": ')
+    assert not registry.reload()
+    assert registry.event_schema is schema
+    assert registry.version == version
+
+
+def test_no_directory():
+    registry = SchemaRegistry(None)
+    assert registry.event_schema.events.is_valid_event_type('PressEvent')
+    assert not registry.reload()
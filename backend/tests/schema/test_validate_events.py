@@ -0,0 +1,56 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import json
+
+import jsonschema
+
+from objectiv_backend.schema.validate_events import validate_structure_event_list, get_event_list_schema, \
+    _get_event_list_validation, _compile_fast_structure_check
+from tests.schema.test_schema import CLICK_EVENT_JSON
+
+
+def test_event_list_schema_cached():
+    assert get_event_list_schema() is get_event_list_schema()
+    assert _get_event_list_validation() is _get_event_list_validation()
+    # The AbstractEvent type must have been replaced
+    assert get_event_list_schema()['properties']['events']['items']['type'] == 'object'
+
+
+def test_fast_structure_check_matches_jsonschema():
+    validation = _get_event_list_validation()
+    assert validation.fast_check is not None
+
+    valid_event_list = json.loads(CLICK_EVENT_JSON)
+    invalid_event_lists = [
+        {'events': []},
+        {'events': {}, 'transport_time': 1},
+        {'events': [1], 'transport_time': 1},
+        {'events': [], 'transport_time': '1'},
+        {'events': [], 'transport_time': True},
+    ]
+    assert validation.fast_check(valid_event_list)
+    assert validate_structure_event_list(valid_event_list) == []
+    for event_list in invalid_event_lists:
+        assert not validation.fast_check(event_list)
+        assert not validation.validator.is_valid(event_list)
+        errors = validate_structure_event_list(event_list)
+        assert len(errors) == 1
+        assert errors[0].info.startswith('Overall structure does not adhere to schema')
+
+
+def test_fast_structure_check_unsupported_keywords():
+    assert _compile_fast_structure_check({'type': 'string', 'pattern': '^a$'}) is None
+    assert _compile_fast_structure_check({'properties': {'a': {'type': 'string', 'pattern': '^a$'}}}) is None
+    assert _compile_fast_structure_check({'type': 'array', 'items': [{'type': 'string'}]}) is None
+    assert _compile_fast_structure_check({'type': ['string', 'null']}) is None
+    assert _compile_fast_structure_check({'properties': {'a': {'type': ['string', 'null']}}}) is None
+    schema = {
+        'type': 'object',
+        'properties': {'a': {'type': 'array', 'items': {'type': 'integer'}}},
+        'required': ['a']
+    }
+    check = _compile_fast_structure_check(schema)
+    assert check is not None
+    for data in [{'a': [1, 2]}, {'a': [1, 'x']}, {'b': []}, [], {'a': [True]}]:
+        assert check(data) == jsonschema.Draft7Validator(schema).is_valid(data)
@@ -0,0 +1,59 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import pytest
+
+from objectiv_backend.tools.db_init.db_init import get_sql
+
+
+def test_get_sql():
+    sql = get_sql()
+    assert 'primary key(event_id)\n' in sql
+    assert 'partition by range' not in sql
+
+    sql = get_sql(partition_by='month')
+    assert 'partition by range (day)' in sql
+    assert "values ('month')" in sql
+    assert 'primary key(event_id)\n' in sql  # data_event_ids
+    assert sql.count('create table data (') == 1
+    assert '-- begin data table' not in sql
+    # the rest of create_tables.sql is still there
+    assert 'create view data_with_sessions' in sql
+
+    with pytest.raises(ValueError):
+        get_sql(partition_by='year')
+
+
+def test_get_sql_jsonb():
+    sql = get_sql(jsonb=True)
+    assert 'value jsonb not null' in sql
+    assert 'event_type text not null' in sql
+    # nok_data is not changed
+    assert 'value json not null' in sql
+    assert sql.count('event_type text not null') == 1
+
+    sql = get_sql(partition_by='day', jsonb=True)
+    assert 'value jsonb not null' in sql
+    assert 'partition by range (day)' in sql
+
+
+def test_get_sql_sessions():
+    sql = get_sql(sessions=True)
+    assert 'create table sessions (' in sql
+    assert 'create table session_events (' in sql
+    # the sessions tables are created before the grants that use them
+    assert sql.index('create table session_events (') < sql.index("to_regclass('session_events')")
+
+
+def test_get_sql_queues():
+    sql = get_sql(queue_batches=True, unlogged_queues=True)
+    assert 'create unlogged table queue_entry (' in sql
+    assert 'create unlogged table queue_finalize (' in sql
+    assert sql.count('event_count integer not null') == 2
+    # the data table is not changed
+    assert 'create table data (' in sql
+    assert 'primary key(event_id)\n' in sql
+
+    sql = get_sql()
+    assert 'create table queue_entry (' in sql
+    assert 'event_count' not in sql
@@ -0,0 +1,35 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from datetime import date
+
+from objectiv_backend.tools.db_partitions.db_partitions import get_partition_range, get_partition_name, \
+    get_partitions_to_create, get_partitions_to_detach
+
+
+def test_get_partition_range():
+    assert get_partition_range('day', date(2022, 2, 28)) == (date(2022, 2, 28), date(2022, 3, 1))
+    assert get_partition_range('month', date(2022, 1, 31)) == (date(2022, 1, 1), date(2022, 2, 1))
+    assert get_partition_range('month', date(2022, 12, 15)) == (date(2022, 12, 1), date(2023, 1, 1))
+    assert get_partition_name('day', date(2022, 3, 1)) == 'data_p20220301'
+    assert get_partition_name('month', date(2022, 3, 1)) == 'data_p202203'
+
+
+def test_get_partitions_to_create():
+    today = date(2022, 3, 30)
+    assert get_partitions_to_create('day', [], today, ahead_days=2) == \
+        [date(2022, 3, 30), date(2022, 3, 31), date(2022, 4, 1)]
+    assert get_partitions_to_create('day', ['data_p20220330', 'data_default'], today, ahead_days=1) == \
+        [date(2022, 3, 31)]
+    assert get_partitions_to_create('month', [], today, ahead_days=7) == [date(2022, 3, 1), date(2022, 4, 1)]
+    assert get_partitions_to_create('month', ['data_p202203'], today, ahead_days=1) == []
+
+
+def test_get_partitions_to_detach():
+    existing = ['data_default', 'data_p202201', 'data_p202202', 'data_p202203', 'data_p202204']
+    assert get_partitions_to_detach('month', existing, date(2022, 4, 15), retention_days=30) == \
+        ['data_p202201', 'data_p202202']
+    assert get_partitions_to_detach('month', existing, date(2022, 4, 15), retention_days=365) == []
+    existing = ['data_default', 'data_p20220301', 'data_p20220302', 'data_p20220303']
+    assert get_partitions_to_detach('day', existing, date(2022, 3, 4), retention_days=1) == \
+        ['data_p20220301', 'data_p20220302']
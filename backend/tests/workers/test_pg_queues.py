@@ -0,0 +1,82 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import json
+
+import pytest
+
+from objectiv_backend.workers import pg_queues
+from objectiv_backend.workers.pg_queues import PostgresQueues, ProcessingStage
+
+
+class FakeCursor:
+    """ Cursor on a queue table with batch rows, that supports the queries of PostgresQueues. """
+
+    def __init__(self, table):
+        self.table = table
+        self.fetched = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        if query.startswith('select insert_order, event_count'):
+            self.results = [(insert_order, count) for insert_order, count, _ in self.table.rows]
+        elif query.startswith('delete from'):
+            taken = [row for row in self.table.rows if row[0] in params[0]]
+            self.table.rows = [row for row in self.table.rows if row[0] not in params[0]]
+            self.results = [(insert_order, json.loads(value)) for insert_order, _, value in reversed(taken)]
+        elif query.startswith('insert into'):
+            self.table.rows.append((len(self.table.rows) + 1, params[0], params[1]))
+        elif not query.startswith('notify'):
+            raise Exception(f'Unexpected query: {query}')
+
+    def fetchmany(self, size):
+        rows, self.results = self.results[:size], self.results[size:]
+        self.table.fetched += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.results
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rows = []
+        self.fetched = 0
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def batch_rows(monkeypatch):
+    monkeypatch.setattr(pg_queues, '_has_batch_rows', lambda connection: True)
+
+
+def _events(*ids):
+    return [{'id': event_id} for event_id in ids]
+
+
+def test_batch_rows(batch_rows, monkeypatch):
+    monkeypatch.setattr(pg_queues, '_BATCH_ROWS_FETCH_SIZE', 2)
+    connection = FakeConnection()
+    queues = PostgresQueues(connection)
+    queues.put_events(ProcessingStage.ENTRY, _events('a', 'b'))
+    queues.put_events(ProcessingStage.ENTRY, [])
+    for event_id in 'cdefg':
+        queues.put_events(ProcessingStage.ENTRY, _events(event_id))
+    assert len(connection.rows) == 6
+
+    # Whole batches are taken, until there are at least max_items events
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=3) == _events('a', 'b', 'c')
+    # Only the rows that were needed are fetched, and thus locked
+    assert connection.fetched == 2
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=2) == _events('d', 'e')
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=10) == _events('f', 'g')
+    assert queues.get_events(ProcessingStage.ENTRY, max_items=10) == []
@@ -0,0 +1,130 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+These tests need a Postgres database, configured with the same POSTGRES_* environment variables as the
+backend. They are skipped if the database is not reachable. All changes are rolled back.
+"""
+import os
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import psycopg2
+import pytest
+from psycopg2 import extras
+
+from objectiv_backend.workers.pg_sessions import update_sessions
+
+SESSIONS_SQL = os.path.join(os.path.dirname(__file__), '..', '..', 'objectiv_backend', 'sessions.sql')
+
+GAP = 1800
+COOKIE = UUID('00000000-0000-0000-0000-00000000c001')
+START = datetime(2022, 3, 1, 12, 0, 0)
+
+
+def _event_id(number: int) -> UUID:
+    return UUID(int=number)
+
+
+def _row(number: int, minutes: int, cookie_id: UUID = COOKIE):
+    return _event_id(number), START + timedelta(minutes=minutes), cookie_id
+
+
+@pytest.fixture
+def cursor():
+    try:
+        connection = psycopg2.connect(
+            host=os.environ.get('POSTGRES_HOSTNAME', 'localhost'),
+            port=os.environ.get('POSTGRES_PORT', '5432'),
+            dbname=os.environ.get('POSTGRES_DB', 'objectiv'),
+            user=os.environ.get('POSTGRES_USER', 'objectiv'),
+            password=os.environ.get('POSTGRES_PASSWORD', ''),
+            connect_timeout=2
+        )
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f'Postgres is not available: {exc}')
+    extras.register_uuid(conn_or_curs=connection)
+    try:
+        with connection.cursor() as cur:
+            # Create the tables in a schema of our own, so that we don't interfere with an existing database
+            cur.execute('create schema test_pg_sessions')
+            cur.execute('set local search_path to test_pg_sessions')
+            with open(SESSIONS_SQL) as file:
+                cur.execute(file.read())
+            yield cur
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def _sessions(cursor):
+    """ Return the sessions as a list of (start_minute, end_minute, hit_count), ordered by start. """
+    cursor.execute('select start_moment, end_moment, hit_count from sessions order by start_moment')
+    return [
+        ((start - START) / timedelta(minutes=1), (end - START) / timedelta(minutes=1), hit_count)
+        for start, end, hit_count in cursor.fetchall()
+    ]
+
+
+def _session_events(cursor):
+    """
+    Return the session assignment of each event as a dict: event number -> (session start minute, hit number)
+    """
+    cursor.execute('''
+        select e.event_id, s.start_moment, e.session_hit_number
+        from session_events as e
+        inner join sessions as s on s.session_id = e.session_id
+    ''')
+    return {
+        event_id.int:
+            ((start - START) / timedelta(minutes=1), hit_number)
+        for event_id, start, hit_number in cursor.fetchall()
+    }
+
+
+def test_update_sessions_in_order(cursor):
+    update_sessions(cursor, [_row(1, 0), _row(2, 10)], GAP)
+    update_sessions(cursor, [_row(3, 20), _row(4, 100)], GAP)
+    assert _sessions(cursor) == [(0, 20, 3), (100, 100, 1)]
+    assert _session_events(cursor) == {1: (0, 1), 2: (0, 2), 3: (0, 3), 4: (100, 1)}
+
+
+def test_update_sessions_out_of_order(cursor):
+    update_sessions(cursor, [_row(3, 20), _row(4, 100)], GAP)
+    # Arrives later, but happened before all events that are already stored
+    update_sessions(cursor, [_row(2, 10)], GAP)
+    update_sessions(cursor, [_row(1, 0)], GAP)
+    assert _sessions(cursor) == [(0, 20, 3), (100, 100, 1)]
+    assert _session_events(cursor) == {1: (0, 1), 2: (0, 2), 3: (0, 3), 4: (100, 1)}
+
+
+def test_update_sessions_late_event_merges_sessions(cursor):
+    update_sessions(cursor, [_row(1, 0), _row(2, 20), _row(4, 60), _row(5, 70)], GAP)
+    assert _sessions(cursor) == [(0, 20, 2), (60, 70, 2)]
+    cursor.execute('select session_id from sessions order by start_moment')
+    first_session_id = cursor.fetchone()[0]
+
+    # Closes the gap between the two sessions
+    update_sessions(cursor, [_row(3, 40)], GAP)
+    assert _sessions(cursor) == [(0, 70, 5)]
+    assert _session_events(cursor) == {1: (0, 1), 2: (0, 2), 3: (0, 3), 4: (0, 4), 5: (0, 5)}
+    # The session that still starts at the same moment keeps its id
+    cursor.execute('select session_id from sessions')
+    assert cursor.fetchone()[0] == first_session_id
+
+
+def test_update_sessions_duplicate_event_ids(cursor):
+    update_sessions(cursor, [_row(1, 0), _row(2, 10)], GAP)
+    # Event 2 is sent again with a different moment, and event 3 twice in the same batch. Only the first
+    # version of each event counts.
+    update_sessions(cursor, [_row(2, 200), _row(3, 20), _row(3, 300)], GAP)
+    assert _sessions(cursor) == [(0, 20, 3)]
+    assert _session_events(cursor) == {1: (0, 1), 2: (0, 2), 3: (0, 3)}
+
+
+def test_update_sessions_multiple_cookies(cursor):
+    other_cookie = UUID('00000000-0000-0000-0000-00000000c002')
+    update_sessions(cursor, [_row(1, 0), _row(2, 10, other_cookie), _row(3, 10)], GAP)
+    cursor.execute('select cookie_id, hit_count from sessions order by cookie_id')
+    assert [(str(cookie_id), hit_count) for cookie_id, hit_count in cursor.fetchall()] == [
+        (str(COOKIE), 2), (str(other_cookie), 1)
+    ]
@@ -0,0 +1,52 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.common.types import FailureReason
+from objectiv_backend.workers import pg_storage
+from objectiv_backend.workers.pg_storage import insert_events_into_data, _DataLayout
+from objectiv_backend.workers.recent_event_ids import RecentEventIds, get_recent_event_ids
+
+
+def test_recent_event_ids():
+    recent_event_ids = RecentEventIds(max_size=3)
+    recent_event_ids.add(['a', 'b', 'c'])
+    assert 'a' in recent_event_ids
+    # 'a' was seen, so 'b' is the least recently used
+    recent_event_ids.add(['d'])
+    assert len(recent_event_ids) == 3
+    assert 'b' not in recent_event_ids
+    assert all(event_id in recent_event_ids for event_id in ('a', 'c', 'd'))
+
+
+def test_get_recent_event_ids():
+    pg_config = PostgresConfig(hostname='localhost', port=5432, database_name='objectiv', user='objectiv',
+                               password='')
+    assert get_recent_event_ids(None) is None
+    assert get_recent_event_ids(pg_config) is None
+    pg_config = pg_config._replace(recent_event_ids=10)
+    recent_event_ids = get_recent_event_ids(pg_config)
+    assert recent_event_ids is not None
+    assert recent_event_ids.max_size == 10
+    assert get_recent_event_ids(pg_config) is recent_event_ids
+
+
+class FailingConnection:
+    """ Connection that fails on any query. """
+    def cursor(self):
+        raise Exception('Should not query the database')
+
+
+def test_insert_events_into_data_recent_duplicates(monkeypatch):
+    monkeypatch.setattr(pg_storage, '_get_data_layout',
+                        lambda connection: _DataLayout(partitioned=False, extracted_columns=False, sessions=False))
+    nok_inserts = []
+    monkeypatch.setattr(pg_storage, 'insert_events_into_nok_data',
+                        lambda connection, events, reason, **kwargs: nok_inserts.append((events, reason)))
+    events = [{'id': 'a', 'time': 1630049334860}, {'id': 'b', 'time': 1630049334860}]
+    recent_event_ids = RecentEventIds(max_size=10)
+    recent_event_ids.add(['a', 'b'])
+
+    duplicates = insert_events_into_data(FailingConnection(), events, recent_event_ids=recent_event_ids)
+    assert duplicates == events
+    assert nok_inserts == [(events, FailureReason.DUPLICATE)]
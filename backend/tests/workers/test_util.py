@@ -0,0 +1,89 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+import psycopg2
+
+from objectiv_backend.common.config import PostgresConfig
+from objectiv_backend.workers import util
+from objectiv_backend.workers.pg_queues import ProcessingStage
+from objectiv_backend.workers.supervisor import format_stage_metrics, _StatsSnapshot
+from objectiv_backend.workers.util import AdaptiveBatchSize, Backoff, StageStats, WorkWaiter
+
+
+def test_adaptive_batch_size():
+    batch_size = AdaptiveBatchSize(initial=100, minimum=10, maximum=300, target_seconds=1)
+    # full batch, fast: grow
+    assert batch_size.update(event_count=100, duration=0.1) == 200
+    assert batch_size.update(event_count=200, duration=0.1) == 300
+    assert batch_size.update(event_count=300, duration=0.1) == 300
+    # batch not full: the queue is drained, no need to grow
+    assert batch_size.update(event_count=20, duration=0.1) == 300
+    # slow: shrink, regardless of whether the batch was full
+    assert batch_size.update(event_count=300, duration=2) == 150
+    assert batch_size.update(event_count=10, duration=2) == 75
+    for _ in range(10):
+        batch_size.update(event_count=0, duration=2)
+    assert batch_size.size == 10
+
+
+def test_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(util.time, 'sleep', sleeps.append)
+    backoff = Backoff(minimum=0.1, maximum=0.5)
+    for _ in range(5):
+        backoff.sleep()
+    assert sleeps == [0.1, 0.2, 0.4, 0.5, 0.5]
+    backoff.reset()
+    backoff.sleep()
+    assert sleeps[-1] == 0.1
+
+
+def test_stage_stats():
+    stats = StageStats('test')
+    stats.add_batch(event_count=10, duration=0.5)
+    stats.add_batch(event_count=5, duration=0.25)
+    assert stats.events == 15
+    assert stats.batches == 2
+    assert stats.busy_seconds == 0.75
+
+    previous = _StatsSnapshot(moment=0, events=0, batches=0, busy_seconds=0)
+    current = _StatsSnapshot(moment=10, events=stats.events, batches=stats.batches,
+                             busy_seconds=stats.busy_seconds)
+    assert format_stage_metrics(name='test', previous=previous, current=current, process_count=1) == \
+        'stage=test workers=1 events=15 batches=2 events_per_second=1.5 utilization=8% total_events=15'
+
+
+def test_work_waiter_falls_back_to_polling(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(util.time, 'sleep', sleeps.append)
+
+    def failing_listener(pg_config, queues):
+        raise psycopg2.OperationalError('could not connect')
+    monkeypatch.setattr(util, 'QueueListener', failing_listener)
+
+    pg_config = PostgresConfig(hostname='localhost', port=5432, database_name='test', user='test', password='')
+    waiter = WorkWaiter(pg_config=pg_config, queues=[ProcessingStage.ENTRY], listen=True)
+    waiter.wait()
+    waiter.wait()
+    assert sleeps == [waiter.backoff.minimum, waiter.backoff.minimum * 2]
+
+
+def test_work_waiter_polls_again_after_listen(monkeypatch):
+    waits = []
+
+    class FakeListener:
+        def __init__(self, pg_config, queues):
+            pass
+
+        def wait(self, timeout):
+            waits.append(timeout)
+            return False
+    monkeypatch.setattr(util, 'QueueListener', FakeListener)
+
+    pg_config = PostgresConfig(hostname='localhost', port=5432, database_name='test', user='test', password='')
+    waiter = WorkWaiter(pg_config=pg_config, queues=[ProcessingStage.ENTRY], listen=True)
+    # the first wait only starts listening, so notifications from before that aren't missed
+    waiter.wait()
+    assert waits == []
+    waiter.wait()
+    assert len(waits) == 1
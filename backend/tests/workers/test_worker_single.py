@@ -0,0 +1,52 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+from objectiv_backend.workers import worker_single
+from objectiv_backend.workers.pg_queues import ProcessingStage
+from objectiv_backend.workers.worker_single import main_single
+
+
+class FakeConnection:
+    """ Connection that only supports being used as a transaction context manager. """
+
+    def __init__(self):
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commits += 1
+
+
+class FakeQueues:
+    """ Replaces PostgresQueues, only has events in the entry queue. """
+    events = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+
+    def __init__(self, connection, copy_threshold=0):
+        self.connection = connection
+
+    def get_events(self, queue, max_items):
+        assert queue == ProcessingStage.ENTRY
+        return self.events[:max_items]
+
+    def put_events(self, queue, events):
+        raise Exception('Single worker should not write to a queue')
+
+
+def test_main_single(monkeypatch):
+    written = []
+    monkeypatch.setattr(worker_single, 'PostgresQueues', FakeQueues)
+    monkeypatch.setattr(worker_single, 'process_events_entry',
+                        lambda events: ([e for e in events if e['id'] != 'b'], [e for e in events if e['id'] == 'b'],
+                                        []))
+    monkeypatch.setattr(worker_single, 'insert_events_into_data',
+                        lambda connection, events, **kwargs: written.append(('data', events)))
+    monkeypatch.setattr(worker_single, 'insert_events_into_nok_data',
+                        lambda connection, events, **kwargs: written.append(('nok_data', events)))
+
+    connection = FakeConnection()
+    assert main_single(connection, max_items=10) == 3
+    assert connection.commits == 1
+    assert written == [('data', [{'id': 'a'}, {'id': 'c'}]), ('nok_data', [{'id': 'b'}])]
@@ -125,11 +125,16 @@ class ModelHub():
         """
 
         with engine.connect() as conn:
-            res = conn.execute(sql)
+            # The backend maintains the sessions of the events in the data table in the session_events table,
+            # if it was set up to do so
+            stored_sessions = table_name == 'data' and conn.execute(
+                "select to_regclass('session_events') is not null"
+            ).scalar()
+            db_dtypes = dict(conn.execute(sql).fetchall())
         db_dialect = DBDialect.from_engine(engine)
         dtypes = {
-            x[0]: bach.types.get_dtype_from_db_dtype(db_dialect=db_dialect, db_dtype=x[1])
-            for x in res.fetchall()
+            name: bach.types.get_dtype_from_db_dtype(db_dialect=db_dialect, db_dtype=db_dtype)
+            for name, db_dtype in db_dtypes.items()
         }
 
         expected_columns = {'event_id': 'uuid',
@@ -137,12 +142,27 @@ class ModelHub():
                             'moment': 'timestamp',
                             'cookie_id': 'uuid',
                             'value': 'json'}
-        if dtypes != expected_columns:
+        # A data table with jsonb storage has the contexts that we need as separate columns. These are
+        # compared on their database type: the model hub registers its own series types for jsonb, so the
+        # dtype of a jsonb column is not necessarily 'jsonb'.
+        expected_db_columns_jsonb = {'event_id': 'uuid',
+                                     'day': 'date',
+                                     'moment': 'timestamp without time zone',
+                                     'cookie_id': 'uuid',
+                                     'value': 'jsonb',
+                                     'event_type': 'text',
+                                     'stack_event_types': 'jsonb',
+                                     'global_contexts': 'jsonb',
+                                     'location_stack': 'jsonb'}
+        extracted_columns = db_dtypes == expected_db_columns_jsonb
+        if dtypes != expected_columns and not extracted_columns:
             raise KeyError(f'Expected columns not in table {table_name}. Found: {dtypes}')
 
         model = sessionized_data_model(start_date=start_date,
                                        end_date=end_date,
-                                       table_name=table_name)
+                                       table_name=table_name,
+                                       extracted_columns=extracted_columns,
+                                       stored_sessions=stored_sessions)
         # The model returned by `sessionized_data_model()` has different columns than the underlying table.
         # Note that the order of index_dtype and dtypes matters, as we use it below to get the model_columns
         index_dtype = {'event_id': 'uuid'}
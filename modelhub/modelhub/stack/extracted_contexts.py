@@ -11,6 +11,17 @@ class ExtractedContexts(SqlModelBuilder):
         return _SQL
 
 
+class ExtractedContextsFromColumns(SqlModelBuilder):
+    """
+    Same as ExtractedContexts, but for a table that already has the extracted contexts as columns, as is the
+    case for a data table that was created with jsonb storage.
+    """
+
+    @property
+    def sql(self):
+        return _SQL_FROM_COLUMNS
+
+
 _SQL = \
     '''
     SELECT event_id,
@@ -24,3 +35,18 @@ _SQL = \
      FROM {table_name}
      {date_range}
      '''
+
+
+_SQL_FROM_COLUMNS = \
+    '''
+    SELECT event_id,
+            day,
+            moment,
+            cookie_id AS user_id,
+            global_contexts,
+            location_stack,
+            event_type,
+            stack_event_types
+     FROM {table_name}
+     {date_range}
+     '''
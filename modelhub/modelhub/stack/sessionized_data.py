@@ -11,6 +11,29 @@ class SessionizedData(SqlModelBuilder):
         return _SQL
 
 
+class StoredSessionizedData(SqlModelBuilder):
+    """
+    Same as SessionizedData, but reads the sessions from the session_events table that the backend maintains
+    if it was set up with sessions, instead of calculating them.
+
+    Events that are not in session_events, because they were stored before the backend maintained sessions,
+    are taken from unsessionized_data: a SessionizedData model on top of UnsessionizedEvents. Their
+    session_ids are negated, so that they cannot clash with the ids of stored sessions.
+    """
+
+    @property
+    def sql(self):
+        return _SQL_STORED
+
+
+class UnsessionizedEvents(SqlModelBuilder):
+    """ The rows of extracted_contexts that are not in the session_events table. """
+
+    @property
+    def sql(self):
+        return _SQL_UNSESSIONIZED
+
+
 _SQL = \
     '''
     with session_starts_{{id}} as (
@@ -48,3 +71,41 @@ _SQL = \
         row_number() over (partition by is_one_session order by moment, event_id) as session_hit_number
     from session_id_and_start_{{id}}
     '''
+
+
+_SQL_STORED = \
+    '''
+    select
+        c.*,
+        s.session_id,
+        s.session_hit_number
+    from {{extracted_contexts}} as c
+    inner join (
+        select event_id, session_id, session_hit_number
+        from session_events
+        {date_range}
+    ) as s on s.event_id = c.event_id
+    union all
+    select
+        event_id,
+        day,
+        moment,
+        user_id,
+        global_contexts,
+        location_stack,
+        event_type,
+        stack_event_types,
+        -session_id as session_id,
+        session_hit_number
+    from {{unsessionized_data}}
+    '''
+
+
+_SQL_UNSESSIONIZED = \
+    '''
+    select c.*
+    from {{extracted_contexts}} as c
+    where not exists (
+        select from session_events as s where s.event_id = c.event_id
+    )
+    '''
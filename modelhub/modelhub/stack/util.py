@@ -2,8 +2,8 @@
 Copyright 2021 Objectiv B.V.
 """
 from modelhub.stack.basic_features import BasicFeatures
-from modelhub.stack.extracted_contexts import ExtractedContexts
-from modelhub.stack.sessionized_data import SessionizedData
+from modelhub.stack.extracted_contexts import ExtractedContexts, ExtractedContextsFromColumns
+from modelhub.stack.sessionized_data import SessionizedData, StoredSessionizedData, UnsessionizedEvents
 
 from sql_models.model import SqlModel
 
@@ -23,14 +23,25 @@ def _get_date_range(start_date, end_date):
     return date_range
 
 
+def _get_extracted_contexts(date_range, table_name, extracted_columns):
+    if extracted_columns:
+        return ExtractedContextsFromColumns(date_range=date_range, table_name=table_name)
+    return ExtractedContexts(date_range=date_range, table_name=table_name)
+
+
 def basic_feature_model(session_gap_seconds=1800,
                         start_date=None,
                         end_date=None,
-                        table_name='data') -> SqlModel:
-    """ Give a linked BasicFeatures model"""
+                        table_name='data',
+                        extracted_columns=False) -> SqlModel:
+    """
+    Give a linked BasicFeatures model
+    If extracted_columns is True, the table should have the extracted contexts as columns, as is the case
+    for a data table that was created with jsonb storage.
+    """
     date_range = _get_date_range(start_date, end_date)
 
-    extracted_contexts = ExtractedContexts(date_range=date_range, table_name=table_name)
+    extracted_contexts = _get_extracted_contexts(date_range, table_name, extracted_columns)
     return BasicFeatures.build(
         sessionized_data=SessionizedData(
             session_gap_seconds=session_gap_seconds,
@@ -42,11 +53,29 @@ def basic_feature_model(session_gap_seconds=1800,
 def sessionized_data_model(session_gap_seconds=1800,
                            start_date=None,
                            end_date=None,
-                           table_name='data') -> SqlModel:
-    """ Give a linked SessionizedData model"""
+                           table_name='data',
+                           extracted_columns=False,
+                           stored_sessions=False) -> SqlModel:
+    """
+    Give a linked SessionizedData model
+    If extracted_columns is True, the table should have the extracted contexts as columns, see
+    basic_feature_model()
+    If stored_sessions is True, the sessions are read from the session_events table. session_gap_seconds
+    is then only used for events that are not in session_events, see StoredSessionizedData.
+    """
     date_range = _get_date_range(start_date, end_date)
 
-    extracted_contexts = ExtractedContexts(date_range=date_range, table_name=table_name)
+    extracted_contexts = _get_extracted_contexts(date_range, table_name, extracted_columns)
+    if stored_sessions:
+        unsessionized_data = SessionizedData.build(
+            session_gap_seconds=session_gap_seconds,
+            extracted_contexts=UnsessionizedEvents.build(extracted_contexts=extracted_contexts)
+        )
+        return StoredSessionizedData.build(
+            date_range=date_range,
+            extracted_contexts=extracted_contexts,
+            unsessionized_data=unsessionized_data
+        )
     return SessionizedData.build(
             session_gap_seconds=session_gap_seconds,
             extracted_contexts=extracted_contexts
@@ -83,3 +83,91 @@ def get_objectiv_dataframe_test(time_aggregation=None):
     modelhub = ModelHub(**kwargs)
 
     return modelhub.get_objectiv_dataframe(DB_TEST_URL, table_name='objectiv_data'), modelhub
+
+
+def get_objectiv_dataframe_test_jsonb(time_aggregation=None):
+    """
+    Same as get_objectiv_dataframe_test(), but the data is in a table with the layout that the backend uses
+    for jsonb storage (see db_init --jsonb): the value is jsonb, and the event type, stack event types, global
+    contexts and location stack are separate columns.
+    """
+    get_objectiv_dataframe_test()
+    sql = """
+    drop table if exists objectiv_data_jsonb;
+
+    create table objectiv_data_jsonb as
+    select
+        event_id,
+        day,
+        moment,
+        cookie_id,
+        value::jsonb as value,
+        value->>'_type' as event_type,
+        (value->'_types')::jsonb as stack_event_types,
+        (value->'global_contexts')::jsonb as global_contexts,
+        (value->'location_stack')::jsonb as location_stack
+    from objectiv_data;
+
+    alter table objectiv_data_jsonb
+        owner to objectiv
+    """
+    run_query(sqlalchemy.create_engine(DB_TEST_URL), sql)
+
+    kwargs = {}
+    if time_aggregation:
+        kwargs = {'time_aggregation': time_aggregation}
+    modelhub = ModelHub(**kwargs)
+
+    return modelhub.get_objectiv_dataframe(DB_TEST_URL, table_name='objectiv_data_jsonb'), modelhub
+
+
+def get_objectiv_dataframe_test_stored_sessions(session_events, time_aggregation=None):
+    """
+    Same as get_objectiv_dataframe_test(), but the data is in a table called data, next to a session_events
+    table with the given sessions, as the backend maintains if the database was set up with sessions
+    (see db_init --sessions).
+    :param session_events: list of (event_id, session_id, session_hit_number) tuples. Events of the test
+        data that are not in this list are not in the session_events table.
+    """
+    get_objectiv_dataframe_test()
+    sql = """
+    drop table if exists data;
+    drop table if exists session_events;
+
+    create table data as select * from objectiv_data;
+
+    create table session_events (
+        event_id uuid not null,
+        day date not null,
+        moment timestamp not null,
+        cookie_id uuid not null,
+        session_id bigint,
+        session_hit_number bigint,
+        primary key(event_id)
+    );
+
+    alter table data
+        owner to objectiv;
+    alter table session_events
+        owner to objectiv
+    """
+    run_query(sqlalchemy.create_engine(DB_TEST_URL), sql)
+    if session_events:
+        values = ', '.join(
+            f"('{event_id}'::uuid, {session_id}, {session_hit_number})"
+            for event_id, session_id, session_hit_number in session_events
+        )
+        run_query(sqlalchemy.create_engine(DB_TEST_URL), f"""
+            insert into session_events(event_id, day, moment, cookie_id, session_id, session_hit_number)
+            select d.event_id, d.day, d.moment, d.cookie_id, s.session_id, s.session_hit_number
+            from data as d
+            inner join (values {values}) as s(event_id, session_id, session_hit_number)
+                on s.event_id = d.event_id
+        """)
+
+    kwargs = {}
+    if time_aggregation:
+        kwargs = {'time_aggregation': time_aggregation}
+    modelhub = ModelHub(**kwargs)
+
+    return modelhub.get_objectiv_dataframe(DB_TEST_URL, table_name='data'), modelhub
@@ -0,0 +1,46 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+
+# Any import from from modelhub initializes all the types, do not remove
+from modelhub import __version__
+import sqlalchemy
+from tests_modelhub.functional.modelhub.data_and_utils import get_objectiv_dataframe_test, \
+    get_objectiv_dataframe_test_jsonb, DB_TEST_URL
+from tests.functional.bach.test_data_and_utils import assert_equals_data, run_query
+
+
+def test_get_objectiv_dataframe_jsonb():
+    df_json, _ = get_objectiv_dataframe_test()
+    df_jsonb, _ = get_objectiv_dataframe_test_jsonb()
+
+    # The jsonb layout is read with ExtractedContextsFromColumns instead of extracting the contexts from the
+    # value column. That should give exactly the same data.
+    assert df_jsonb.dtypes == df_json.dtypes
+    df_json = df_json.sort_values('event_id')
+    expected = run_query(sqlalchemy.create_engine(DB_TEST_URL), df_json.view_sql())
+    assert_equals_data(
+        df_jsonb,
+        expected_columns=list(expected.keys()),
+        expected_data=[list(row) for row in expected],
+        order_by='event_id'
+    )
+
+
+def test_get_objectiv_dataframe_jsonb_model():
+    df, modelhub = get_objectiv_dataframe_test_jsonb(time_aggregation='YYYY-MM-DD')
+
+    # Models work on the stored event types, as they do on the ones extracted from the value column
+    s = modelhub.aggregate.unique_users(df)
+    assert_equals_data(
+        s,
+        expected_columns=['time_aggregation', 'unique_users'],
+        expected_data=[
+            ['2021-11-29', 1],
+            ['2021-11-30', 2],
+            ['2021-12-01', 1],
+            ['2021-12-02', 1],
+            ['2021-12-03', 1]
+        ],
+        order_by='time_aggregation'
+    )
@@ -0,0 +1,76 @@
+"""
+Copyright 2022 Objectiv B.V.
+"""
+
+# Any import from from modelhub initializes all the types, do not remove
+from modelhub import __version__
+import sqlalchemy
+from tests_modelhub.functional.modelhub.data_and_utils import get_objectiv_dataframe_test, \
+    get_objectiv_dataframe_test_stored_sessions, DB_TEST_URL
+from tests.functional.bach.test_data_and_utils import assert_equals_data, run_query
+from uuid import UUID
+
+
+def test_stored_sessions_match_computed_sessions():
+    df, _ = get_objectiv_dataframe_test()
+    columns = ['user_id', 'moment', 'session_id', 'session_hit_number']
+    computed = [
+        list(row) for row in
+        run_query(sqlalchemy.create_engine(DB_TEST_URL), df[columns].sort_values('event_id').view_sql())
+    ]
+
+    # The backend numbers its sessions differently than SessionizedData does
+    session_events = [
+        (event_id, session_id + 100, session_hit_number)
+        for event_id, _, _, session_id, session_hit_number in computed
+    ]
+    df_stored, _ = get_objectiv_dataframe_test_stored_sessions(session_events)
+
+    assert df_stored.dtypes == df.dtypes
+    assert_equals_data(
+        df_stored[columns],
+        expected_columns=['event_id'] + columns,
+        expected_data=[
+            [event_id, user_id, moment, session_id + 100, session_hit_number]
+            for event_id, user_id, moment, session_id, session_hit_number in computed
+        ],
+        order_by='event_id'
+    )
+
+
+def test_stored_sessions_fallback():
+    # Events 309 and 310 were stored before the backend maintained sessions, so they are not in
+    # session_events. Their sessions are calculated, with negative ids.
+    session_events = [
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac301'), 13, 1),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac302'), 13, 2),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac303'), 13, 3),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac304'), 12, 1),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac305'), 14, 1),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac306'), 14, 2),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac307'), 15, 1),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac308'), 15, 2),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac311'), 11, 1),
+        (UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac312'), 11, 2),
+    ]
+    df, _ = get_objectiv_dataframe_test_stored_sessions(session_events)
+
+    assert_equals_data(
+        df[['session_id', 'session_hit_number']],
+        expected_columns=['event_id', 'session_id', 'session_hit_number'],
+        expected_data=[
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac301'), 13, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac302'), 13, 2],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac303'), 13, 3],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac304'), 12, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac305'), 14, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac306'), 14, 2],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac307'), 15, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac308'), 15, 2],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac309'), -1, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac310'), -2, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac311'), 11, 1],
+            [UUID('12b55ed5-4295-4fc1-bf1f-88d64d1ac312'), 11, 2],
+        ],
+        order_by='event_id'
+    )
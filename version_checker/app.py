@@ -1,5 +1,8 @@
+import atexit
+import queue
 import uuid
 import os
+import threading
 
 from flask import Flask, Response, Request
 import flask
@@ -10,7 +13,7 @@ import json
 import semver
 import requests
 
-from typing import Generator, Dict
+from typing import Generator, Dict, Optional, Tuple
 import time
 
 from objectiv_backend.schema.schema import make_event_from_dict, AbstractEvent
@@ -21,6 +24,22 @@ TRACKER_URL = os.environ.get('OBJECTIV_TRACKER_URL', 'http://localhost:8081')
 # base url to PYPI index, use localhost for local proxy cache
 PYPI_BASE_URL = os.environ.get('OBJECTIV_PYPI_BASE_URL', 'http://localhost')
 
+# number of seconds that the current version of a package is cached, before it's looked up again
+VERSION_CACHE_SECONDS = float(os.environ.get('OBJECTIV_VERSION_CACHE_SECONDS', 300))
+# number of seconds before a failed lookup is retried
+VERSION_RETRY_SECONDS = 10
+# maximum number of seconds a request waits for the first lookup of a package
+VERSION_LOOKUP_TIMEOUT_SECONDS = 10
+
+# number of threads per process that send tracked events to the tracker
+TRACKER_THREADS = int(os.environ.get('OBJECTIV_TRACKER_THREADS', 4))
+# maximum number of seconds to wait for the tracker to accept an event
+TRACKER_TIMEOUT_SECONDS = 5
+# maximum number of events waiting to be sent, if the tracker can't keep up new events are dropped
+TRACKER_MAX_PENDING_EVENTS = 10_000
+# maximum number of seconds to wait for pending events to be sent when the process exits
+TRACKER_EXIT_TIMEOUT_SECONDS = 5
+
 
 def get_current_version(package: str) -> str:
     """
@@ -33,7 +52,7 @@ def get_current_version(package: str) -> str:
     headers = {
         'Content-Type': 'application/json'
     }
-    response = requests.get(url=url, headers=headers)
+    response = requests.get(url=url, headers=headers, timeout=VERSION_LOOKUP_TIMEOUT_SECONDS)
 
     if response.status_code == 200:
         data = response.json()
@@ -44,6 +63,65 @@ def get_current_version(package: str) -> str:
     return None
 
 
+class VersionCache:
+    """
+    In-process cache of the current versions of packages, so requests are answered from memory.
+
+    A version is looked up again after VERSION_CACHE_SECONDS. There is at most one lookup per package in
+    flight: it runs in a background thread, and in the meantime requests get the previous version. Only
+    requests for a package that was never looked up wait for the lookup to finish.
+    """
+
+    def __init__(self, ttl_seconds: float = VERSION_CACHE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # package -> (version, moment after which it should be looked up again)
+        self._versions: Dict[str, Tuple[Optional[str], float]] = {}
+        # package -> event that is set when the lookup in flight finishes
+        self._lookups: Dict[str, threading.Event] = {}
+
+    def get(self, package: str) -> Optional[str]:
+        """
+        Get the current version of a package
+        :param package: str - name of package
+        :return: str - version if available
+        """
+        with self._lock:
+            cached = self._versions.get(package)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+            lookup = self._lookups.get(package)
+            if lookup is None:
+                lookup = threading.Event()
+                self._lookups[package] = lookup
+                threading.Thread(target=self._lookup, args=(package, lookup), daemon=True).start()
+        if cached is not None:
+            return cached[0]
+        lookup.wait(timeout=VERSION_LOOKUP_TIMEOUT_SECONDS)
+        with self._lock:
+            cached = self._versions.get(package)
+        return cached[0] if cached is not None else None
+
+    def _lookup(self, package: str, lookup: threading.Event):
+        version = None
+        try:
+            version = get_current_version(package=package)
+        except Exception as exc:
+            # not only RequestException: an unexpected response, e.g. `{"info": null}`, raises a TypeError
+            print(f'Could not get current version of {package}: {exc}')
+        finally:
+            # always finish the lookup, otherwise the package would stay in-flight forever
+            with self._lock:
+                if version is not None:
+                    self._versions[package] = (version, time.monotonic() + self.ttl_seconds)
+                else:
+                    # keep the last known version, if any, and retry soon
+                    previous = self._versions.get(package, (None, 0.0))[0]
+                    self._versions[package] = (previous, time.monotonic() + VERSION_RETRY_SECONDS)
+                del self._lookups[package]
+            lookup.set()
+
+
 def parse_payload(request: Request) -> Generator:
     """
     Parse Post payload, should be of the form package:version
@@ -79,7 +157,10 @@ def check_version() -> Response:
         for package in data:
             if package['name'] not in packages_to_check:
                 continue
-            current_version = get_current_version(package=package['name'])
+            current_version = get_version_cache().get(package=package['name'])
+            if current_version is None:
+                # PyPI couldn't be reached, so we don't know
+                continue
 
             try:
                 update_available = semver.compare(current_version, package['version']) > 0
@@ -94,18 +175,14 @@ def check_version() -> Response:
     if packages:
         # only try to track if this request contains a valid payload
         event = make_event()
-        try:
-            user_agent = str(request.user_agent)
-
-            for package in packages:
-                if package == 'objectiv-modelhub':
-                    version = packages[package]['local_version']
-                    user_agent += f' {package}/{version}'
-            track_event(event, user_agent)
-
-        except requests.exceptions.RequestException as re:
-            # this shouldn't happen, but we continue, as we can still return version info
-            print(f'Could not send event: {re}')
+        user_agent = str(request.user_agent)
+
+        for package in packages:
+            if package == 'objectiv-modelhub':
+                version = packages[package]['local_version']
+                user_agent += f' {package}/{version}'
+        # the event is sent in the background, so we don't wait for the collector
+        get_event_tracker().add(event, user_agent)
     else:
         print('error:Could not process request')
 
@@ -146,7 +223,8 @@ def make_event() -> AbstractEvent:
 
 def track_event(event: AbstractEvent, user_agent: str):
     """
-    Post event to collector
+    Post event to collector. Every event gets its own request, as the collector gives each request without
+    a cookie a new cookie id: events in one request would be counted as a single user.
     :param event: AbstractEvent - event to be sent to collector
     :param user_agent: str - user agent to use in request
     :return: None
@@ -160,7 +238,89 @@ def track_event(event: AbstractEvent, user_agent: str):
         'events': [event],
         'transport_time': int(time.time()*1000)
     }
-    requests.post(TRACKER_URL, data=json.dumps(data), headers=headers)
+    requests.post(TRACKER_URL, data=json.dumps(data), headers=headers, timeout=TRACKER_TIMEOUT_SECONDS)
+
+
+class EventTracker:
+    """
+    Sends events to the collector with a pool of background threads, so requests don't wait for the
+    collector. Each event is sent in its own request, see track_event().
+    """
+
+    def __init__(self, thread_count: int = TRACKER_THREADS):
+        self._queue: queue.Queue = queue.Queue(maxsize=TRACKER_MAX_PENDING_EVENTS)
+        for _ in range(thread_count):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, event: AbstractEvent, user_agent: str):
+        """
+        Queue event to be sent to collector
+        :param event: AbstractEvent - event to be sent to collector
+        :param user_agent: str - user agent to use in request
+        :return: None
+        """
+        try:
+            self._queue.put_nowait((event, user_agent))
+        except queue.Full:
+            print('Too many pending events, dropping event')
+
+    def flush(self, timeout_seconds: float = TRACKER_EXIT_TIMEOUT_SECONDS) -> bool:
+        """
+        Wait until all pending events are sent, or timeout_seconds have passed.
+        :return: bool - True if all events were sent
+        """
+        deadline = time.monotonic() + timeout_seconds
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(timeout=remaining)
+        return True
+
+    def _run(self):
+        while True:
+            event, user_agent = self._queue.get()
+            try:
+                track_event(event, user_agent)
+            except requests.exceptions.RequestException as re:
+                # the events are only for statistics, so we don't retry
+                print(f'Could not send event: {re}')
+            finally:
+                self._queue.task_done()
+
+
+# The threads don't survive a fork, so we keep one instance per process.
+_VERSION_CACHE: Optional[VersionCache] = None
+_EVENT_TRACKER: Optional[EventTracker] = None
+_INSTANCES_PID: Optional[int] = None
+_INSTANCES_LOCK = threading.Lock()
+
+
+def _init_instances():
+    global _VERSION_CACHE, _EVENT_TRACKER, _INSTANCES_PID
+    with _INSTANCES_LOCK:
+        if _INSTANCES_PID != os.getpid():
+            _VERSION_CACHE = VersionCache()
+            _EVENT_TRACKER = EventTracker()
+            _INSTANCES_PID = os.getpid()
+            atexit.register(_EVENT_TRACKER.flush)
+
+
+def get_version_cache() -> VersionCache:
+    """ Get the VersionCache of the current process. """
+    if _INSTANCES_PID != os.getpid():
+        _init_instances()
+    assert _VERSION_CACHE is not None  # help out mypy
+    return _VERSION_CACHE
+
+
+def get_event_tracker() -> EventTracker:
+    """ Get the EventTracker of the current process. """
+    if _INSTANCES_PID != os.getpid():
+        _init_instances()
+    assert _EVENT_TRACKER is not None  # help out mypy
+    return _EVENT_TRACKER
 
 
 def create_app() -> Flask:
@@ -0,0 +1,229 @@
+"""
+Copyright 2022 Objectiv B.V.
+
+Tests of the version checker against local stand-ins for the PyPI index and the collector.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+
+class FakeServer:
+    """ Local HTTP server. Requests wait while `blocked` is cleared. """
+
+    def __init__(self):
+        self.requests = []
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def handle(self, handler: BaseHTTPRequestHandler):
+        self.unblocked.wait(timeout=5)
+        self.respond(handler)
+
+    def respond(self, handler: BaseHTTPRequestHandler):
+        raise NotImplementedError()
+
+    def close(self):
+        self.unblocked.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakePypi(FakeServer):
+    """
+    Serves the current version of each package, or a 500 error if `failing` is set. A version of None is
+    served as `{"info": null}`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.versions = {'objectiv-bach': '0.0.2', 'objectiv-modelhub': '0.0.1'}
+        self.failing = False
+
+    def respond(self, handler):
+        package = handler.path.split('/')[2]
+        self.requests.append(package)
+        if self.failing:
+            handler.send_error(500)
+            return
+        version = self.versions[package]
+        info = {'version': version} if version is not None else None
+        body = json.dumps({'info': info}).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class FakeCollector(FakeServer):
+    """ Keeps the user agent and the events of each request. """
+
+    def respond(self, handler):
+        body = handler.rfile.read(int(handler.headers['Content-Length']))
+        self.requests.append((handler.headers['User-Agent'], json.loads(body)['events']))
+        handler.send_response(200)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+
+
+@pytest.fixture
+def pypi(monkeypatch):
+    pypi = FakePypi()
+    monkeypatch.setattr(app, 'PYPI_BASE_URL', pypi.url)
+    yield pypi
+    pypi.close()
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    collector = FakeCollector()
+    monkeypatch.setattr(app, 'TRACKER_URL', collector.url)
+    yield collector
+    collector.close()
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timeout'
+        time.sleep(0.01)
+
+
+def test_version_cache_single_lookup(pypi):
+    cache = app.VersionCache()
+    pypi.unblocked.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('objectiv-bach'))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    pypi.unblocked.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert results == ['0.0.2'] * 5
+    # All requests waited for the same lookup
+    assert pypi.requests == ['objectiv-bach']
+    assert cache.get('objectiv-bach') == '0.0.2'
+    assert pypi.requests == ['objectiv-bach']
+
+
+def test_version_cache_stale_while_refreshing(pypi):
+    cache = app.VersionCache(ttl_seconds=0.1)
+    assert cache.get('objectiv-bach') == '0.0.2'
+    pypi.versions['objectiv-bach'] = '0.0.3'
+    pypi.unblocked.clear()
+    time.sleep(0.2)
+
+    # The version expired, but requests get the previous version while it's looked up
+    start = time.monotonic()
+    assert cache.get('objectiv-bach') == '0.0.2'
+    assert cache.get('objectiv-bach') == '0.0.2'
+    assert time.monotonic() - start < 1
+    pypi.unblocked.set()
+    _wait_for(lambda: cache.get('objectiv-bach') == '0.0.3')
+    assert pypi.requests == ['objectiv-bach', 'objectiv-bach']
+
+
+def test_version_cache_retry_after_failure(pypi, monkeypatch):
+    monkeypatch.setattr(app, 'VERSION_RETRY_SECONDS', 0.1)
+    cache = app.VersionCache(ttl_seconds=0.1)
+    pypi.failing = True
+    assert cache.get('objectiv-bach') is None
+    # Not looked up again before VERSION_RETRY_SECONDS
+    assert cache.get('objectiv-bach') is None
+    assert pypi.requests == ['objectiv-bach']
+
+    pypi.failing = False
+    _wait_for(lambda: cache.get('objectiv-bach') == '0.0.2')
+
+    # If a later lookup fails, the last known version is kept
+    pypi.failing = True
+    pypi.versions['objectiv-bach'] = '0.0.3'
+    time.sleep(0.2)
+    request_count = len(pypi.requests)
+    assert cache.get('objectiv-bach') == '0.0.2'
+    _wait_for(lambda: len(pypi.requests) > request_count)
+    assert cache.get('objectiv-bach') == '0.0.2'
+
+
+def test_version_cache_unexpected_response(pypi, monkeypatch):
+    monkeypatch.setattr(app, 'VERSION_RETRY_SECONDS', 0.1)
+    cache = app.VersionCache()
+    pypi.versions['objectiv-bach'] = None
+    assert cache.get('objectiv-bach') is None
+    # The failed lookup finished, so the package is looked up again after VERSION_RETRY_SECONDS
+    pypi.versions['objectiv-bach'] = '0.0.2'
+    _wait_for(lambda: cache.get('objectiv-bach') == '0.0.2')
+
+
+def test_event_tracker(collector):
+    tracker = app.EventTracker(thread_count=2)
+    events = [app.make_event() for _ in range(5)]
+    for index, event in enumerate(events):
+        tracker.add(event, f'agent-{index}')
+    assert tracker.flush()
+    # One request per event, so that the collector gives each its own cookie id
+    assert sorted(collector.requests, key=lambda request: request[0]) == [
+        (f'agent-{index}', [json.loads(json.dumps(event))]) for index, event in enumerate(events)
+    ]
+
+
+def test_event_tracker_timeout(collector, monkeypatch):
+    monkeypatch.setattr(app, 'TRACKER_TIMEOUT_SECONDS', 0.2)
+    tracker = app.EventTracker(thread_count=1)
+    collector.unblocked.clear()
+    tracker.add(app.make_event(), 'agent')
+    tracker.add(app.make_event(), 'agent')
+    assert not tracker.flush(timeout_seconds=0.1)
+    # The requests time out, so the tracker isn't stuck on an unresponsive collector
+    assert tracker.flush(timeout_seconds=5)
+
+
+def test_check_version(pypi, collector, monkeypatch):
+    cache = app.VersionCache()
+    tracker = app.EventTracker(thread_count=1)
+    monkeypatch.setattr(app, 'get_version_cache', lambda: cache)
+    monkeypatch.setattr(app, 'get_event_tracker', lambda: tracker)
+    client = app.app.test_client()
+    response = client.post('/check_version', data='objectiv-bach:0.0.1\nobjectiv-modelhub:0.0.1\nother:1.0',
+                           headers={'User-Agent': 'test'})
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).split('\n')
+    assert [line.split(':')[:3] for line in lines] == [
+        ['objectiv-bach', 'True', '0.0.2'], ['objectiv-modelhub', 'False', '0.0.1']
+    ]
+
+    assert tracker.flush()
+    assert [user_agent for user_agent, _ in collector.requests] == ['test objectiv-modelhub/0.0.1']
+
+    # Packages of which the current version is unknown are left out
+    pypi.failing = True
+    response = client.post('/check_version', data='objectiv-bach:0.0.1')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).split(':')[:3] == ['objectiv-bach', 'True', '0.0.2']
+    other_cache = app.VersionCache()
+    monkeypatch.setattr(app, 'get_version_cache', lambda: other_cache)
+    response = client.post('/check_version', data='objectiv-bach:0.0.1')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == ''